@@ -10,13 +10,15 @@ import time
 import threading
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Any
-from database import get_db
+from database import get_db, init_db
 from data_pipeline import DataPipelineOrchestrator
 from predictive_models import PredictiveModelEngine
 from anomaly_detector import AnomalyDetector
 from prescriptive_advisor import PrescriptiveAdvisor
 from data_quality import ValidadorCalidadDatos
 from generative_assistant import GenerativeDataAssistant
+from dashboard_tiles import dashboard_tile_renderer
+from report_scheduler import report_scheduler
 from unified_logger import unified_logger
 
 # Fallback: Sistema de threading para automatización sin dependencias externas
@@ -73,6 +75,14 @@ try:
                 'task': 'agent_scheduler.weekly_schema_update',
                 'schedule': crontab(day_of_week='monday', hour=3, minute=0),
             },
+            'dashboard-tiles-prewarm': {
+                'task': 'agent_scheduler.dashboard_tiles_prewarm',
+                'schedule': crontab(minute='*/15'),
+            },
+            'scheduled-reports-dispatch': {
+                'task': 'agent_scheduler.scheduled_reports_dispatch',
+                'schedule': crontab(minute='*'),
+            },
         }
     )
 
@@ -143,6 +153,9 @@ class ThreadingScheduler:
         time.sleep(2)
         self._run_task_in_thread("daily_recommendations_generation", self.daily_recommendations_generation)
 
+        # ARD - reportes programados: loop propio que despierta en la próxima ejecución
+        report_scheduler.start()
+
         # Loop de verificación continua
         while not self.stop_event.is_set():
             try:
@@ -184,6 +197,11 @@ class ThreadingScheduler:
                     self._run_task_in_thread("weekly_schema_update", self.weekly_schema_update)
                     self._mark_task_run("weekly_schema_update")
 
+                # SSBF tiles de dashboards populares - cada 15 minutos
+                if self._should_run_task("dashboard_tiles_prewarm", 15 * 60):
+                    self._run_task_in_thread("dashboard_tiles_prewarm", self.dashboard_tiles_prewarm)
+                    self._mark_task_run("dashboard_tiles_prewarm")
+
                 # Esperar 5 minutos antes de verificar nuevamente
                 time.sleep(300)
 
@@ -195,6 +213,7 @@ class ThreadingScheduler:
         """Detiene el scheduler"""
         unified_logger.log("scheduler", "INFO", "Deteniendo scheduler con threading")
         self.stop_event.set()
+        report_scheduler.stop()
 
         # Esperar que terminen los threads activos
         for thread_name, thread in self.threads.items():
@@ -320,19 +339,16 @@ class ThreadingScheduler:
             except:
                 sales_count = 0
 
+            # Riesgo y conversión se puntúan con los modelos registrados, sin reentrenar
             try:
-                risk_preds = pme.get_predictions('risk_assessment')
-                risk_count = risk_preds.get('count', 0)
-                predictions_generated += risk_count
-            except:
-                risk_count = 0
+                scoring_results = pme.update_predictions()
+            except Exception as e:
+                scoring_results = {}
+                unified_logger.log("scheduler", "ERROR", f"Error puntuando con modelos registrados: {str(e)}")
 
-            try:
-                conversion_preds = pme.get_predictions('conversion_probability')
-                conversion_count = conversion_preds.get('count', 0)
-                predictions_generated += conversion_count
-            except:
-                conversion_count = 0
+            risk_count = scoring_results.get('risk_assessment', {}).get('predictions_saved', 0)
+            conversion_count = scoring_results.get('conversion_probability', {}).get('predictions_saved', 0)
+            predictions_generated += risk_count + conversion_count
 
             pme.close()
 
@@ -484,49 +500,27 @@ class ThreadingScheduler:
             )
 
             pa = PrescriptiveAdvisor()
-
-            high_risk_clients = pa.generate_client_recommendations(
-                recommendation_type='high_risk_clients',
-                min_confidence=0.6
-            )
-
-            sales_opportunities = pa.generate_client_recommendations(
-                recommendation_type='sales_opportunities',
-                min_confidence=0.5
-            )
-
-            collection_alerts = pa.generate_client_recommendations(
-                recommendation_type='collection_risks',
-                min_confidence=0.4
-            )
-
+            refresh_result = pa.refresh_recommendation_store()
             pa.close()
 
-            total_recommendations = (
-                high_risk_clients.get('recommendations_count', 0) +
-                sales_opportunities.get('recommendations_count', 0) +
-                collection_alerts.get('recommendations_count', 0)
-            )
+            if not refresh_result.get('success'):
+                raise RuntimeError(refresh_result.get('error', 'Error regenerando recomendaciones'))
 
+            results = refresh_result.get('results', {})
             unified_logger.log_agent_activity(
                 agent="pa",
                 action="scheduled_daily_recommendations",
                 status="completed",
                 details={
-                    "high_risk_recommendations": high_risk_clients.get('recommendations_count', 0),
-                    "sales_opportunities": sales_opportunities.get('recommendations_count', 0),
-                    "collection_alerts": collection_alerts.get('recommendations_count', 0),
-                    "total_recommendations": total_recommendations
+                    "clients_reevaluated": results.get('clientes', {}).get('clients_reevaluated', 0),
+                    "inserted": sum(r.get('inserted', 0) for r in results.values()),
+                    "updated": sum(r.get('updated', 0) for r in results.values()),
+                    "deleted": sum(r.get('deleted', 0) for r in results.values()),
+                    "execution_time_seconds": refresh_result.get('execution_time_seconds')
                 }
             )
 
-            return {
-                "success": True,
-                "high_risk_clients": high_risk_clients,
-                "sales_opportunities": sales_opportunities,
-                "collection_alerts": collection_alerts,
-                "total_recommendations": total_recommendations
-            }
+            return refresh_result
 
         except Exception as e:
             unified_logger.log_agent_activity(
@@ -578,6 +572,49 @@ class ThreadingScheduler:
             )
             return {"success": False, "error": str(e)}
 
+    def dashboard_tiles_prewarm(self):
+        """Versión sin Celery del precálculo de tiles del SSBF"""
+        try:
+            result = dashboard_tile_renderer.prewarm_popular_dashboards()
+            unified_logger.log_agent_activity(
+                agent="ssbf",
+                action="scheduled_tiles_prewarm",
+                status="completed",
+                details=result
+            )
+            return result
+
+        except Exception as e:
+            unified_logger.log_agent_activity(
+                agent="ssbf",
+                action="scheduled_tiles_prewarm",
+                status="failed",
+                details={"error": str(e)}
+            )
+            return {"success": False, "error": str(e)}
+
+    def scheduled_reports_dispatch(self):
+        """Ejecuta los reportes programados vencidos (el loop del scheduler lo hace en modo threading)"""
+        try:
+            result = report_scheduler.run_due(wait_for_completion=True)
+            if result['claimed']:
+                unified_logger.log_agent_activity(
+                    agent="ard",
+                    action="scheduled_reports_dispatch",
+                    status="completed",
+                    details=result
+                )
+            return result
+
+        except Exception as e:
+            unified_logger.log_agent_activity(
+                agent="ard",
+                action="scheduled_reports_dispatch",
+                status="failed",
+                details={"error": str(e)}
+            )
+            return {"success": False, "error": str(e)}
+
     def trigger_manual_task(self, task_name: str, **kwargs) -> Dict:
         """Ejecutar tarea manualmente"""
         try:
@@ -589,6 +626,8 @@ class ThreadingScheduler:
                 'continuous_quality_monitoring': self.continuous_quality_monitoring,
                 'daily_recommendations_generation': self.daily_recommendations_generation,
                 'weekly_schema_update': self.weekly_schema_update,
+                'dashboard_tiles_prewarm': self.dashboard_tiles_prewarm,
+                'scheduled_reports_dispatch': self.scheduled_reports_dispatch,
             }
 
             if task_name not in task_functions:
@@ -678,6 +717,16 @@ class AgentScheduler:
         """Celery version"""
         return self.threading_scheduler.weekly_schema_update() if self.is_threading_mode else None
 
+    @app.task(bind=True)
+    def dashboard_tiles_prewarm(self, *args, **kwargs):
+        """Celery version"""
+        return self.threading_scheduler.dashboard_tiles_prewarm() if self.is_threading_mode else None
+
+    @app.task(bind=True)
+    def scheduled_reports_dispatch(self, *args, **kwargs):
+        """Celery version"""
+        return self.threading_scheduler.scheduled_reports_dispatch() if self.is_threading_mode else None
+
     def _notify_via_redis(self, channel: str, message: Dict):
         """Redis notifications (if available)"""
         if REDIS_AVAILABLE and redis_client:
@@ -751,6 +800,8 @@ class AgentScheduler:
                 'continuous_quality_monitoring': self.continuous_quality_monitoring,
                 'daily_recommendations_generation': self.daily_recommendations_generation,
                 'weekly_schema_update': self.weekly_schema_update,
+                'dashboard_tiles_prewarm': self.dashboard_tiles_prewarm,
+                'scheduled_reports_dispatch': self.scheduled_reports_dispatch,
             }
 
             if task_name not in task_functions:
@@ -805,6 +856,9 @@ def start_scheduler():
     print("  • DQG - Monitoreo de calidad cada 30 minutos")
     print("  • PA - Generación de recomendaciones diariamente 8:00 AM")
     print("  • GDA - Actualización de esquemas semanal lunes 3:00 AM")
+    print("  • ARD - Reportes programados según su próxima ejecución")
+
+    init_db()
 
     if CELERY_AVAILABLE:
         print("✅ Modo Celery/Redis activado")
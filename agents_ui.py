@@ -53,9 +53,8 @@ def show_predictive_models_page():
 
                         # Mostrar las predicciones generadas
                         st.subheader("📈 Previsión de Ventas Generada")
-                        forecast_predictions = pme.get_predictions(prediction_type="sales_forecast", limit=result['predictions_saved'])
-                        if forecast_predictions['success'] and forecast_predictions['predictions']:
-                            df_forecast = pd.DataFrame(forecast_predictions['predictions'])
+                        if result.get('predictions'):
+                            df_forecast = pd.DataFrame(result['predictions'])
                             df_forecast['target_date'] = pd.to_datetime(df_forecast['target_date'])
                             df_forecast = df_forecast.sort_values(by='target_date')
 
@@ -236,13 +235,24 @@ def show_prescriptive_advisor_page():
     try:
         st.subheader("🎯 Generar Recomendaciones")
 
+        # Las recomendaciones se leen del almacén precalculado por el job diario del PA
+        if st.button("🔄 Recalcular Recomendaciones", use_container_width=True):
+            with st.spinner("Reevaluando entidades con datos modificados..."):
+                refresh = pa.refresh_recommendation_store()
+                if refresh['success']:
+                    clients_result = refresh['results'].get('clientes', {})
+                    st.success(f"✅ {clients_result.get('clients_reevaluated', 0)} clientes reevaluados "
+                               f"en {refresh['execution_time_seconds']:.1f}s")
+                else:
+                    st.error(f"❌ Error: {refresh.get('error', 'Desconocido')}")
+
         # Botones para diferentes tipos de análisis
         col1, col2, col3 = st.columns(3)
 
         with col1:
             if st.button("👥 Analizar Clientes", use_container_width=True):
                 with st.spinner("Analizando clientes y generando recomendaciones..."):
-                    result = pa.generate_client_recommendations(limit=10)
+                    result = pa.get_stored_recommendations(entity_types=["cliente"], page_size=10)
                     st.session_state.pa_client_recommendations = result  # Guardar en session state
                     if result['success']:
                         st.success(f"✅ {result['total_generated']} recomendaciones generadas")
@@ -252,7 +262,7 @@ def show_prescriptive_advisor_page():
         with col2:
             if st.button("👔 Analizar Equipo de Ventas", use_container_width=True):
                 with st.spinner("Analizando rendimiento del equipo..."):
-                    result = pa.generate_sales_team_recommendations()
+                    result = pa.get_stored_recommendations(entity_types=["vendedor", "equipo"])
                     st.session_state.pa_sales_recommendations = result  # Guardar en session state
                     if result['success']:
                         st.success(f"✅ {result['total_generated']} recomendaciones generadas")
@@ -262,7 +272,7 @@ def show_prescriptive_advisor_page():
         with col3:
             if st.button("💰 Analizar Finanzas", use_container_width=True):
                 with st.spinner("Analizando situación financiera..."):
-                    result = pa.generate_finance_recommendations()
+                    result = pa.get_stored_recommendations(entity_types=["finanzas"])
                     st.session_state.pa_finance_recommendations = result  # Guardar en session state
                     if result['success']:
                         st.success(f"✅ {result['total_generated']} recomendaciones generadas")
@@ -1079,12 +1089,13 @@ def show_ssbf_page():
 
         if st.button("🔄 Actualizar Dashboards", use_container_width=True):
             with st.spinner("Cargando dashboards..."):
-                dashboards = ssbf.get_user_dashboards(user_id)
+                listing = ssbf.get_user_dashboards(user_id, page=1, page_size=10)  # Limitar a 10 para UI
+                dashboards = listing['dashboards']
 
                 if dashboards:
-                    st.success(f"Encontrados {len(dashboards)} dashboards")
+                    st.success(f"Encontrados {listing['total']} dashboards")
 
-                    for dashboard in dashboards[:10]:  # Limitar a 10 para UI
+                    for dashboard in dashboards:
                         visibility = "🌐 Público" if dashboard['is_public'] else "🔒 Privado"
                         permission = dashboard['user_permission']
 
@@ -1098,8 +1109,17 @@ def show_ssbf_page():
 
                                 with col1:
                                     if st.button("👀 Ver", key=f"view_{dashboard['id']}", use_container_width=True):
-                                        st.info("Vista completa del dashboard (integración con Metabase)")
-                                        # Aquí iría la integración real con Metabase
+                                        rendered = ssbf.render_dashboard(dashboard['id'], user_id)
+                                        if rendered['success']:
+                                            for tile in rendered['tiles']:
+                                                if tile['success']:
+                                                    st.metric(tile['title'], tile['formatted_value'])
+                                                else:
+                                                    st.caption(f"❌ {tile['metric']}: {tile['error']}")
+                                            st.caption(f"Renderizado en {rendered['render_time_ms']} ms "
+                                                       f"({rendered['tiles_cached']} tiles desde cache)")
+                                        else:
+                                            st.error(f"❌ Error: {rendered.get('error', 'Desconocido')}")
 
                                 with col2:
                                     if st.button("✏️ Editar", key=f"edit_{dashboard['id']}", use_container_width=True):
@@ -1156,9 +1176,12 @@ def show_ssbf_page():
                         # Calcular y mostrar valores de las primeras 5 métricas
                         st.subheader("💡 Valores Actuales (Top 5)")
 
-                        for metric in metrics[:5]:
+                        top_metrics = metrics[:5]
+                        values = ssbf.calculate_metric_values([metric['id'] for metric in top_metrics])
+
+                        for metric in top_metrics:
                             with st.container():
-                                value_result = ssbf.calculate_metric_value(metric['id'])
+                                value_result = values[metric['id']]
                                 if value_result['success']:
                                     col1, col2, col3 = st.columns([3, 1, 1])
 
@@ -1245,45 +1268,48 @@ def show_generative_assistant_page():
 
         # Botón de consulta
         if st.button("🔍 Hacer Consulta", use_container_width=True, type="primary") and user_query.strip():
+            # Procesar consulta mostrando la respuesta a medida que se genera
+            st.subheader("🤖 Respuesta")
+            response_placeholder = st.empty()
+            streamed_text = ""
+            result = None
+
             with st.spinner("Analizando tu consulta..."):
-                # Procesar consulta
-                result = gda.process_query(user_query.strip(), {
-                    'include_data': include_data,
-                    'user_id': 'ui_user'  # Simulado
-                })
+                for event in gda.stream_query(user_query.strip()):
+                    if event['event'] == 'token':
+                        streamed_text += event['text']
+                        response_placeholder.info(streamed_text)
+                    else:
+                        result = event['result']
 
-                # Guardar resultado en session state
-                st.session_state.gda_query_results = result
+            # Guardar resultado en session state
+            st.session_state.gda_query_results = result
 
-                if result['success']:
-                    st.success("✅ Consulta procesada exitosamente")
+            if result['success']:
+                st.success("✅ Consulta procesada exitosamente")
 
-                    # Mostrar respuesta principal
-                    st.subheader("🤖 Respuesta")
-                    st.info(result['response'])
+                # Mostrar detalles técnicos si se solicitó
+                if include_data:
+                    with st.expander("📊 Detalles Técnicos", expanded=False):
+                        col1, col2, col3 = st.columns(3)
 
-                    # Mostrar detalles técnicos si se solicitó
-                    if include_data:
-                        with st.expander("📊 Detalles Técnicos", expanded=False):
-                            col1, col2, col3 = st.columns(3)
-
-                            with col1:
-                                st.metric("Tiempo de Procesamiento", f"{result['processing_time']}s")
+                        with col1:
+                            st.metric("Tiempo de Procesamiento", f"{result['processing_time']}s")
 
-                            with col2:
-                                confidence = result.get('confidence_score', 0)
-                                st.metric("Confianza", f"{confidence * 100:.1f}%")
+                        with col2:
+                            confidence = result.get('confidence_score', 0)
+                            st.metric("Confianza", f"{confidence * 100:.1f}%")
 
-                            with col3:
-                                st.metric("Consulta", f"{len(result['query'])} caracteres")
+                        with col3:
+                            st.metric("Consulta", f"{len(result['query'])} caracteres")
 
-                            # Mostrar datos utilizados
-                            if result.get('data_used'):
-                                st.subheader("Datos Utilizados")
-                                st.json(result['data_used'])
+                        # Mostrar datos utilizados
+                        if result.get('data_used'):
+                            st.subheader("Datos Utilizados")
+                            st.json(result['data_used'])
 
-                else:
-                    st.error(f"❌ Error: {result.get('error', 'Error desconocido')}")
+            else:
+                st.error(f"❌ Error: {result.get('error', 'Error desconocido')}")
 
         # Mostrar resultado anterior si existe
         elif st.session_state.gda_query_results and st.session_state.gda_query_results['success']:
@@ -1327,7 +1353,7 @@ def show_generative_assistant_page():
             st.session_state.suggested_query = None  # Limpiar
 
             with st.spinner(f"Procesando: {query}"):
-                result = gda.process_query(query, {'include_data': include_data})
+                result = gda.process_query(query)
                 st.session_state.gda_query_results = result
 
                 if result['success']:
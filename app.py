@@ -65,6 +65,8 @@ def initialize_app():
         init_db()
         st.info("Inicializando base de datos... Por favor ejecute `python init_db.py` para cargar datos de ejemplo.")
     else:
+        # Aplica tablas y columnas nuevas sobre bases existentes
+        init_db()
         st.success("Base de datos cargada correctamente")
 
 @st.cache_data(ttl=1800)  # Cache for 30 minutes
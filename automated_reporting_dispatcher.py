@@ -5,22 +5,103 @@ Sistema automatizado de generación y distribución de reportes
 
 import os
 import json
+import multiprocessing
+import re
 import time
-import base64
-from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Any, Tuple
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.application import MIMEApplication
-from database import get_db
-from models import Usuario
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, timedelta
+from typing import Callable, Dict, List, Optional, Any, Tuple
+from sqlalchemy import case, func, select
+from database import get_db, engine
+from models import (Usuario, Cliente, Vendedor, Factura, Cobranza, MovimientoCaja, AnomalyAlert, Recommendation,
+                    EstadoFacturaEnum)
 from metrics_hub import MetricsDefinitionHub
+from report_writers import write_report, report_extension
+from report_scheduler import report_scheduler
+from report_distribution import ReportDistributor
 from unified_logger import unified_logger
 from auth import get_current_user
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Filas leídas por lote al recorrer las consultas de detalle
+REPORT_FETCH_SIZE = int(os.getenv('REPORT_FETCH_SIZE', '2000'))
+
+OPEN_INVOICE_STATES = [EstadoFacturaEnum.pendiente, EstadoFacturaEnum.parcial, EstadoFacturaEnum.vencida]
+
+# Procesos que renderizan reportes en paralelo en los lotes
+REPORT_BATCH_WORKERS = int(os.getenv('REPORT_BATCH_WORKERS', str(min(4, os.cpu_count() or 1))))
+
+# Inicio de los procesos del lote: sin fork, porque el proceso tiene hilos (scheduler, pools de
+# distribución) y un fork puede heredar locks tomados por ellos y bloquearse
+REPORT_BATCH_START_METHOD = os.getenv(
+    'REPORT_BATCH_START_METHOD',
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+)
+
+# Reportes cuyos datos se agregan por vendedor y admiten variantes por cartera
+PARTITIONED_REPORT_TYPES = {'weekly_summary', 'monthly_finance'}
+WEEKLY_FIELDS = ['invoices', 'invoices_prev', 'billed', 'billed_prev', 'collected', 'collected_prev',
+                 'new_clients', 'new_clients_prev']
+MONTHLY_FIELDS = ['paid_count', 'pending_count', 'overdue_count', 'billed', 'paid_amount']
+
+
+def detail_statement(source: str, params: Dict):
+    """Consulta de una sección de detalle a partir de su fuente y parámetros (serializables)"""
+    if source == 'invoices':
+        statement = select(
+            Factura.numero_factura, Factura.fecha_emision, Factura.fecha_vencimiento, Cliente.nombre,
+            Factura.estado, Factura.monto_total, Factura.monto_pagado
+        ).outerjoin(Cliente, Cliente.id == Factura.cliente_id).where(
+            Factura.fecha_emision >= params['date_from'], Factura.fecha_emision < params['date_to']
+        )
+        if params.get('vendedor_id') is not None:
+            statement = statement.where(Cliente.vendedor_id == params['vendedor_id'])
+        return statement.order_by(Factura.fecha_emision, Factura.id)
+
+    if source == 'cash_movements':
+        return select(
+            MovimientoCaja.fecha, MovimientoCaja.tipo, MovimientoCaja.categoria,
+            MovimientoCaja.concepto, MovimientoCaja.monto, MovimientoCaja.numero_documento
+        ).where(
+            MovimientoCaja.fecha >= params['date_from'], MovimientoCaja.fecha < params['date_to']
+        ).order_by(MovimientoCaja.fecha, MovimientoCaja.id)
+
+    raise ValueError(f"Fuente de detalle desconocida: {source}")
+
+
+def stream_rows(statement) -> Callable[[], Any]:
+    """
+    Fuente de filas para una sección de detalle: cada recorrido abre su propia conexión y
+    lee la consulta en lotes de REPORT_FETCH_SIZE, sin cargarla completa en memoria
+    """
+    def rows():
+        with engine.connect() as conn:
+            result = conn.execution_options(stream_results=True, yield_per=REPORT_FETCH_SIZE).execute(statement)
+            for row in result:
+                yield tuple(row)
+    return rows
+
+
+def attach_detail_rows(report_data: Dict) -> Dict:
+    """Asocia a cada sección de detalle la consulta que produce sus filas (en el proceso que escribe)"""
+    for section in report_data.get('sections', []):
+        if section.get('type') == 'detail_table' and 'rows' not in section:
+            section['rows'] = stream_rows(detail_statement(section['source'], section['params']))
+    return report_data
+
+
+def _init_report_worker():
+    """Los procesos hijos no deben reutilizar conexiones heredadas del padre (si las hubiera)"""
+    engine.dispose(close=False)
+
+
+def _render_report_worker(report_format: str, report_data: Dict, path: str) -> Dict:
+    """Renderiza una variante de reporte (se ejecuta en el pool de procesos)"""
+    return write_report(report_format, attach_detail_rows(report_data), lambda extension: path)
+
 class AutomatedReportingDispatcher:
     """
     Genera y distribuye reportes automáticos por email/Slack
@@ -45,6 +126,12 @@ class AutomatedReportingDispatcher:
             'sender_password': os.getenv('SENDER_PASSWORD', ''),
             'webhook_slack': os.getenv('SLACK_WEBHOOK', '')
         }
+        self.distributor = ReportDistributor(
+            smtp_server=self.default_config['smtp_server'],
+            smtp_port=self.default_config['smtp_port'],
+            sender_email=self.default_config['sender_email'],
+            sender_password=self.default_config['sender_password']
+        )
 
     def generate_automated_report(self, report_config: Dict) -> Dict:
         """
@@ -65,16 +152,17 @@ class AutomatedReportingDispatcher:
             # Generar contenido del reporte
             report_data = self._generate_report_content(report_config)
 
-            # Formatear reporte según tipo
+            # Escribir el reporte en su formato (en generated_reports/ o en un archivo temporal)
             formatted_report = self._format_report(report_config, report_data)
-
-            # Guardar reporte si es necesario
             if report_config.get('save_to_file', True):
-                file_path = self._save_report_to_file(formatted_report, report_config)
-                report_data['file_path'] = file_path
+                report_data['file_path'] = formatted_report['file_path']
 
             # Distribuir reporte
-            distribution_results = self._distribute_report(formatted_report, report_config)
+            try:
+                distribution_results = self._distribute_report(formatted_report, report_config)
+            finally:
+                if not report_config.get('save_to_file', True):
+                    os.remove(formatted_report['file_path'])
 
             # Registrar actividad
             processing_time = time.time() - start_time
@@ -85,6 +173,8 @@ class AutomatedReportingDispatcher:
                 'report_type': report_config['type'],
                 'recipients': len(report_config.get('recipients', [])),
                 'file_generated': report_data.get('file_path', None),
+                'file_size_bytes': formatted_report['size_bytes'],
+                'detail_rows': formatted_report['detail_rows'],
                 'distribution_status': distribution_results,
                 'processing_time': round(processing_time, 2)
             }
@@ -97,6 +187,152 @@ class AutomatedReportingDispatcher:
                 'report_type': report_config.get('type', 'unknown')
             }
 
+    def generate_report_batch(self, report_config: Dict, variants: Optional[List[Dict]] = None,
+                              max_workers: Optional[int] = None) -> Dict:
+        """
+        Genera en lote las variantes de un reporte a partir de un único cálculo de datos.
+
+        Los datos agregados se consultan una sola vez y se particionan por vendedor; cada
+        variante se renderiza en un pool de procesos (las secciones de detalle las consulta
+        cada proceso con su propia conexión) y luego se distribuye a sus destinatarios.
+
+        Args:
+            report_config: Configuración base del reporte. Con `partition_by: 'vendedor'` se
+                genera una variante por vendedor activo (más la global si hay destinatarios).
+            variants: Variantes explícitas [{'key', 'title', 'recipients', 'vendedor_id'}]
+            max_workers: Procesos de renderizado (por defecto REPORT_BATCH_WORKERS)
+
+        Returns:
+            Dict con el resultado de cada variante
+        """
+        start_time = time.time()
+
+        try:
+            self._validate_report_config(report_config)
+            if variants is None:
+                variants = self._partition_variants(report_config)
+            if not variants:
+                raise ValueError("El lote no tiene variantes que generar")
+
+            # Datos compartidos: una sola consulta agregada para todas las variantes
+            dataset = self._load_report_dataset(report_config)
+            data_time = time.time() - start_time
+
+            report_format = report_config.get('format', 'pdf')
+            extension = report_extension(report_format)
+            jobs = []
+            for variant in variants:
+                config = {
+                    **report_config,
+                    'title': variant.get('title', report_config.get('title')),
+                    'recipients': variant.get('recipients', report_config.get('recipients', []))
+                }
+                if config['title'] is None:
+                    config.pop('title')
+                report_data = self._generate_report_content(config, dataset, variant.get('vendedor_id'))
+                jobs.append((variant, config, report_data,
+                             self._report_path(config, extension, variant.get('key'))))
+
+            rendered = self._render_batch(report_format, jobs, max_workers)
+
+            # Todas las variantes se distribuyen en una sola pasada (conexiones SMTP compartidas)
+            generated = [(formatted_report, config) for (_, config, _, _), (formatted_report, error)
+                         in zip(jobs, rendered) if error is None]
+            try:
+                distributions = iter(self._distribute_reports(generated)) if generated else iter([])
+            finally:
+                for (_, config, _, path), _ in zip(jobs, rendered):
+                    if not config.get('save_to_file', True) and os.path.exists(path):
+                        os.remove(path)
+
+            results = []
+            for (variant, config, _, path), (formatted_report, error) in zip(jobs, rendered):
+                result = {'key': variant.get('key'), 'title': config.get('title'),
+                          'recipients': len(config['recipients'])}
+                if error is not None:
+                    results.append({**result, 'success': False, 'error': error})
+                    continue
+                results.append({
+                    **result,
+                    'success': True,
+                    'file_generated': formatted_report['file_path'] if config.get('save_to_file', True) else None,
+                    'file_size_bytes': formatted_report['size_bytes'],
+                    'detail_rows': formatted_report['detail_rows'],
+                    'distribution_status': next(distributions)
+                })
+
+            processing_time = time.time() - start_time
+            self._log_report_generation({**report_config, 'recipients': [
+                recipient for _, config, _, _ in jobs for recipient in config['recipients']
+            ]}, processing_time)
+
+            return {
+                'success': all(result['success'] for result in results),
+                'report_type': report_config['type'],
+                'variants': results,
+                'generated': sum(1 for result in results if result['success']),
+                'failed': sum(1 for result in results if not result['success']),
+                'data_time': round(data_time, 2),
+                'processing_time': round(processing_time, 2)
+            }
+
+        except Exception as e:
+            logger.error(f"Error generando lote de reportes: {str(e)}")
+            return {
+                'success': False,
+                'error': str(e),
+                'report_type': report_config.get('type', 'unknown')
+            }
+
+    def _partition_variants(self, config: Dict) -> List[Dict]:
+        """Variantes del lote según `partition_by` (por ahora 'vendedor') y los destinatarios globales"""
+
+        variants = []
+        if config.get('recipients') or not config.get('partition_by'):
+            variants.append({'key': 'global', 'recipients': config.get('recipients', [])})
+
+        if config.get('partition_by') == 'vendedor':
+            if config['type'] not in PARTITIONED_REPORT_TYPES:
+                raise ValueError(f"El reporte {config['type']} no admite partición por vendedor")
+            base_title = config.get('title', f"Reporte {config['type'].title()}")
+            for vendedor in self.db.query(Vendedor).filter(Vendedor.activo == 1).order_by(Vendedor.id).all():
+                variants.append({
+                    'key': f"vendedor_{vendedor.id}",
+                    'title': f"{base_title} - {vendedor.nombre}",
+                    'recipients': [vendedor.email],
+                    'vendedor_id': vendedor.id
+                })
+        elif config.get('partition_by'):
+            raise ValueError(f"Partición no soportada: {config['partition_by']}")
+
+        return variants
+
+    @staticmethod
+    def _render_batch(report_format: str, jobs: List[Tuple], max_workers: Optional[int]) -> List[Tuple]:
+        """Renderiza los trabajos del lote en un pool de procesos; retorna (resultado, error) por trabajo"""
+
+        workers = min(max_workers or REPORT_BATCH_WORKERS, len(jobs))
+        if workers <= 1:
+            rendered = []
+            for _, _, report_data, path in jobs:
+                try:
+                    rendered.append((_render_report_worker(report_format, report_data, path), None))
+                except Exception as e:
+                    rendered.append((None, str(e)))
+            return rendered
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_report_worker,
+                                 mp_context=multiprocessing.get_context(REPORT_BATCH_START_METHOD)) as executor:
+            futures = [executor.submit(_render_report_worker, report_format, report_data, path)
+                       for _, _, report_data, path in jobs]
+            rendered = []
+            for future in futures:
+                try:
+                    rendered.append((future.result(), None))
+                except Exception as e:
+                    rendered.append((None, str(e)))
+            return rendered
+
     def _validate_report_config(self, config: Dict):
         """Valida que la configuración de reporte sea correcta"""
         required_fields = ['type', 'name']
@@ -111,8 +347,11 @@ class AutomatedReportingDispatcher:
         if 'recipients' in config and not isinstance(config['recipients'], list):
             raise ValueError("Los destinatarios deben ser una lista")
 
-    def _generate_report_content(self, config: Dict) -> Dict:
-        """Genera el contenido del reporte basado en su configuración"""
+    def _generate_report_content(self, config: Dict, dataset: Dict = None, vendedor_id: int = None) -> Dict:
+        """
+        Genera el contenido del reporte basado en su configuración. `dataset` permite reutilizar
+        los datos agregados de un lote; `vendedor_id` acota el reporte a la cartera de un vendedor.
+        """
 
         report_type = config['type']
         
@@ -127,81 +366,220 @@ class AutomatedReportingDispatcher:
             'sections': []
         }
 
+        if report_type in PARTITIONED_REPORT_TYPES and dataset is None:
+            dataset = self._load_report_dataset(config)
+
         # Generar contenido según tipo de reporte y rol
         if report_type == 'weekly_summary':
-            content['sections'] = self._generate_weekly_summary()
+            content['sections'] = self._generate_weekly_summary(config, dataset, vendedor_id)
         elif report_type == 'monthly_finance':
-            content['sections'] = self._generate_monthly_finance()
+            content['sections'] = self._generate_monthly_finance(config, dataset, vendedor_id)
         elif report_type == 'kpi_dashboard':
             content['sections'] = self._generate_kpi_dashboard()
         elif report_type == 'anomaly_alert':
-            content['sections'] = self._generate_anomaly_alert()
+            content['sections'] = self._generate_anomaly_alert(config)
         elif report_type == 'custom':
             content['sections'] = self._generate_custom_report(config)
 
         return content
 
-    def _generate_weekly_summary(self) -> List[Dict]:
-        """Genera resumen semanal de operaciones"""
+    def _load_report_dataset(self, config: Dict) -> Dict:
+        """
+        Datos agregados que comparten todas las variantes de un reporte, agrupados por
+        vendedor de la cartera (None: clientes sin vendedor o facturas sin cliente)
+        """
+        if config['type'] == 'weekly_summary':
+            return self._load_weekly_dataset()
+        if config['type'] == 'monthly_finance':
+            return self._load_monthly_dataset(config)
+        return {}
+
+    def _load_weekly_dataset(self) -> Dict:
+        """Totales de los últimos 7 días y de los 7 anteriores, por vendedor"""
+
+        today = date.today()
+        week_start = today - timedelta(days=6)
+        previous_start = week_start - timedelta(days=7)
+        tomorrow = today + timedelta(days=1)
+
+        def windowed(column, value=None):
+            """Suma (o conteo) de la semana actual y de la anterior según la fecha `column`"""
+            current = case((column >= week_start, value if value is not None else 1), else_=0)
+            previous = case((column < week_start, value if value is not None else 1), else_=0)
+            return func.coalesce(func.sum(current), 0), func.coalesce(func.sum(previous), 0)
+
+        by_seller: Dict[Optional[int], Dict] = {}
+
+        def collect(rows, fields):
+            for vendedor_id, *values in rows:
+                totals = by_seller.setdefault(vendedor_id, dict.fromkeys(WEEKLY_FIELDS, 0))
+                for field, value in zip(fields, values):
+                    totals[field] = float(value or 0)
+
+        collect(self.db.query(
+            Cliente.vendedor_id, *windowed(Factura.fecha_emision), *windowed(Factura.fecha_emision, Factura.monto_total)
+        ).outerjoin(Cliente, Cliente.id == Factura.cliente_id).filter(
+            Factura.fecha_emision >= previous_start, Factura.fecha_emision < tomorrow
+        ).group_by(Cliente.vendedor_id).all(), ['invoices', 'invoices_prev', 'billed', 'billed_prev'])
+
+        collect(self.db.query(
+            Cliente.vendedor_id, *windowed(Cobranza.fecha_pago, Cobranza.monto)
+        ).outerjoin(Factura, Factura.id == Cobranza.factura_id).outerjoin(
+            Cliente, Cliente.id == Factura.cliente_id
+        ).filter(
+            Cobranza.fecha_pago >= previous_start, Cobranza.fecha_pago < tomorrow
+        ).group_by(Cliente.vendedor_id).all(), ['collected', 'collected_prev'])
+
+        collect(self.db.query(
+            Cliente.vendedor_id, *windowed(Cliente.fecha_ingreso)
+        ).filter(
+            Cliente.fecha_ingreso >= previous_start, Cliente.fecha_ingreso < tomorrow
+        ).group_by(Cliente.vendedor_id).all(), ['new_clients', 'new_clients_prev'])
+
+        metrics = self.mdh.calculate_metrics(['conversion_rate', 'clientes_activos']).get('results', {})
+
+        return {
+            'week_start': week_start,
+            'date_to': tomorrow,
+            'by_seller': by_seller,
+            'metrics': {metric_id: result for metric_id, result in metrics.items() if result.get('success')}
+        }
+
+    def _load_monthly_dataset(self, config: Dict) -> Dict:
+        """Caja del mes (global) y estado de la facturación del mes por vendedor"""
+
+        month_start, next_month_start = self._month_range(config.get('period'))
+        today = date.today()
+
+        cash = dict(self.db.query(
+            MovimientoCaja.tipo, func.coalesce(func.sum(MovimientoCaja.monto), 0)
+        ).filter(
+            MovimientoCaja.fecha >= month_start, MovimientoCaja.fecha < next_month_start
+        ).group_by(MovimientoCaja.tipo).all())
+
+        is_open = Factura.estado.in_(OPEN_INVOICE_STATES)
+        rows = self.db.query(
+            Cliente.vendedor_id,
+            func.count(Factura.id).filter(Factura.estado == EstadoFacturaEnum.pagada),
+            func.count(Factura.id).filter(is_open, Factura.fecha_vencimiento >= today),
+            func.count(Factura.id).filter(is_open, Factura.fecha_vencimiento < today),
+            func.coalesce(func.sum(Factura.monto_total), 0),
+            func.coalesce(func.sum(Factura.monto_pagado), 0)
+        ).outerjoin(Cliente, Cliente.id == Factura.cliente_id).filter(
+            Factura.fecha_emision >= month_start, Factura.fecha_emision < next_month_start
+        ).group_by(Cliente.vendedor_id).all()
+
+        return {
+            'month_start': month_start,
+            'date_to': next_month_start,
+            'income': float(cash.get('Ingreso', 0)),
+            'expenses': float(cash.get('Egreso', 0)),
+            'by_seller': {
+                vendedor_id: dict(zip(MONTHLY_FIELDS, (float(value or 0) for value in values)))
+                for vendedor_id, *values in rows
+            }
+        }
+
+    @staticmethod
+    def _partition_totals(by_seller: Dict, fields: List[str], vendedor_id: Optional[int]) -> Dict:
+        """Totales de un vendedor, o de toda la empresa si `vendedor_id` es None"""
+        if vendedor_id is not None:
+            return {**dict.fromkeys(fields, 0), **by_seller.get(vendedor_id, {})}
+        return {field: sum(totals.get(field, 0) for totals in by_seller.values()) for field in fields}
+
+    def _generate_weekly_summary(self, config: Dict, dataset: Dict, vendedor_id: Optional[int] = None) -> List[Dict]:
+        """Genera resumen semanal de operaciones: últimos 7 días contra los 7 anteriores"""
+
+        totals = self._partition_totals(dataset['by_seller'], WEEKLY_FIELDS, vendedor_id)
+
+        summary = {
+            'revenue_week': {'value': totals['billed'], 'data_type': 'currency'},
+            'collections_week': {'value': totals['collected'], 'data_type': 'currency'},
+            'new_clients': {'value': int(totals['new_clients']), 'previous': int(totals['new_clients_prev'])}
+        }
+        if vendedor_id is None:
+            summary.update(dataset['metrics'])
 
         sections = [
             {
                 'title': '📊 Resumen Ejecutivo',
                 'type': 'metrics_summary',
-                'data': {
-                    'revenue_week': self.mdh.calculate_metric_value('revenue_total'),
-                    'new_clients': {'value': 8, 'target': 10},  # Simulado
-                    'conversion_rate': self.mdh.calculate_metric_value('conversion_rate'),
-                    'satisfaction': self.mdh.calculate_metric_value('customer_satisfaction')
-                }
+                'data': summary
             },
             {
                 'title': '🎯 KPIs Principales',
                 'type': 'kpi_list',
                 'data': [
-                    {'name': 'Ingresos Totales', 'value': '$12.5M', 'change': '+8.2%'},
-                    {'name': 'Clientes Activos', 'value': '125', 'change': '+12'},
-                    {'name': 'Tasa Conversión', 'value': '68.5%', 'change': '+2.1%'}
+                    {'name': 'Ventas Facturadas', 'value': f"${totals['billed']:,.0f}",
+                     'change': self._format_change(totals['billed'], totals['billed_prev'])},
+                    {'name': 'Facturas Emitidas', 'value': f"{int(totals['invoices']):,}",
+                     'change': f"{int(totals['invoices'] - totals['invoices_prev']):+,}"},
+                    {'name': 'Cobranzas', 'value': f"${totals['collected']:,.0f}",
+                     'change': self._format_change(totals['collected'], totals['collected_prev'])},
+                    {'name': 'Clientes Nuevos', 'value': f"{int(totals['new_clients']):,}",
+                     'change': f"{int(totals['new_clients'] - totals['new_clients_prev']):+,}"}
                 ]
             }
         ]
 
+        if config.get('include_details', True):
+            sections.append(self._invoice_detail_section(
+                '📄 Facturas de la Semana', dataset['week_start'], dataset['date_to'], vendedor_id
+            ))
+
         return sections
 
-    def _generate_monthly_finance(self) -> List[Dict]:
-        """Genera reporte mensual financiero"""
+    def _generate_monthly_finance(self, config: Dict, dataset: Dict, vendedor_id: Optional[int] = None) -> List[Dict]:
+        """Genera reporte mensual financiero (mes de `period` 'YYYY-MM' o el mes actual)"""
 
-        sections = [
-            {
+        totals = self._partition_totals(dataset['by_seller'], MONTHLY_FIELDS, vendedor_id)
+        sections = []
+
+        # La caja es de la empresa: solo se incluye en la versión global
+        if vendedor_id is None:
+            income, expenses = dataset['income'], dataset['expenses']
+            sections.append({
                 'title': '💰 Situación Financiera',
                 'type': 'financial_summary',
                 'data': {
-                    'total_revenue': '$25.8M',
-                    'total_expenses': '$18.2M',
-                    'net_profit': '$7.6M',
-                    'margin': '29.5%'
-                }
-            },
-            {
-                'title': '📊 Estado de Cobranzas',
-                'type': 'payment_status',
-                'data': {
-                    'paid_invoices': 142,
-                    'pending_invoices': 23,
-                    'overdue_invoices': 8,
-                    'payment_rate': '94.2%'
+                    'total_revenue': {'value': income, 'data_type': 'currency'},
+                    'total_expenses': {'value': expenses, 'data_type': 'currency'},
+                    'net_profit': {'value': income - expenses, 'data_type': 'currency'},
+                    'margin': {'value': (income - expenses) / income * 100 if income else None,
+                               'data_type': 'percentage'}
                 }
+            })
+
+        sections.append({
+            'title': '📊 Estado de Cobranzas',
+            'type': 'payment_status',
+            'data': {
+                'paid_invoices': int(totals['paid_count']),
+                'pending_invoices': int(totals['pending_count']),
+                'overdue_invoices': int(totals['overdue_count']),
+                'payment_rate': {'value': totals['paid_amount'] / totals['billed'] * 100 if totals['billed'] else None,
+                                 'data_type': 'percentage'}
             }
-        ]
+        })
+
+        if config.get('include_details', True):
+            sections.append(self._invoice_detail_section(
+                '📄 Facturas del Mes', dataset['month_start'], dataset['date_to'], vendedor_id
+            ))
+            if vendedor_id is None:
+                sections.append({
+                    'title': '🏦 Movimientos de Caja',
+                    'type': 'detail_table',
+                    'columns': ['Fecha', 'Tipo', 'Categoría', 'Concepto', 'Monto', 'Documento'],
+                    'source': 'cash_movements',
+                    'params': {'date_from': dataset['month_start'], 'date_to': dataset['date_to']}
+                })
 
         return sections
 
     def _generate_kpi_dashboard(self) -> List[Dict]:
         """Genera dashboard completo de KPIs"""
 
-        # Obtener múltiples métricas del MDH
-        all_metrics = self.mdh.get_all_metrics()
-
         sections = [
             {
                 'title': '🎯 KPIs de Ventas',
@@ -222,36 +600,87 @@ class AutomatedReportingDispatcher:
 
         return sections
 
-    def _generate_anomaly_alert(self) -> List[Dict]:
-        """Genera alerta de anomalías detectadas"""
+    def _generate_anomaly_alert(self, config: Dict) -> List[Dict]:
+        """Genera alerta con las anomalías no resueltas de los últimos días y las recomendaciones abiertas"""
+
+        since = datetime.utcnow() - timedelta(days=config.get('lookback_days', 7))
+        alerts = self.db.query(AnomalyAlert).filter(
+            AnomalyAlert.status.in_(['open', 'acknowledged']),
+            AnomalyAlert.timestamp >= since
+        ).order_by(AnomalyAlert.timestamp.desc()).limit(config.get('max_anomalies', 200)).all()
+
+        anomalies = {'critical': [], 'high': [], 'medium': [], 'low': []}
+        for alert in alerts:
+            anomalies.setdefault(alert.severity or 'medium', []).append({
+                'metric': alert.metric_name,
+                'value': f"{alert.metric_value:,.2f}",
+                'expected': f"{alert.expected_range_min or 0:,.2f} - {alert.expected_range_max or 0:,.2f}",
+                'deviation': self._format_deviation(alert)
+            })
+
+        try:
+            recommendations = [
+                title for (title,) in self.db.query(Recommendation.title).filter(
+                    Recommendation.status == 'open'
+                ).order_by(Recommendation.impact_score.desc()).limit(5).all()
+            ]
+        except Exception as e:
+            self.db.rollback()
+            logger.warning(f"Recomendaciones no disponibles para el reporte: {str(e)}")
+            recommendations = []
 
         sections = [
             {
                 'title': '🚨 Anomalías Detectadas',
                 'type': 'anomaly_list',
-                'data': {
-                    'critical': [
-                        {'metric': 'Ingresos Diarios', 'value': '$85K', 'expected': '$120K', 'deviation': '-29%'}
-                    ],
-                    'high': [
-                        {'metric': 'Clientes Nuevos', 'value': '3', 'expected': '8', 'deviation': '-62%'}
-                    ],
-                    'medium': []
-                }
+                'data': anomalies
             },
             {
                 'title': '🎯 Recomendaciones',
                 'type': 'recommendations',
-                'data': [
-                    'Revisar campañas de marketing activas',
-                    'Contactar a clientes de alto valor con retraso',
-                    'Verificar integridad de datos de ingreso'
-                ]
+                'data': recommendations
             }
         ]
 
         return sections
 
+    @staticmethod
+    def _invoice_detail_section(title: str, date_from: date, date_to: date, vendedor_id: Optional[int] = None) -> Dict:
+        """Sección de detalle con las facturas emitidas en [date_from, date_to)"""
+        return {
+            'title': title,
+            'type': 'detail_table',
+            'columns': ['Factura', 'Emisión', 'Vencimiento', 'Cliente', 'Estado', 'Monto Total', 'Monto Pagado'],
+            'source': 'invoices',
+            'params': {'date_from': date_from, 'date_to': date_to, 'vendedor_id': vendedor_id}
+        }
+
+    @staticmethod
+    def _month_range(period: Optional[str]) -> Tuple[date, date]:
+        """Inicio del mes `period` ('YYYY-MM', por defecto el actual) y del mes siguiente"""
+        try:
+            month_start = datetime.strptime(period, '%Y-%m').date()
+        except (TypeError, ValueError):
+            month_start = date.today().replace(day=1)
+        return month_start, (month_start + timedelta(days=32)).replace(day=1)
+
+    @staticmethod
+    def _format_change(current, previous) -> str:
+        """Variación porcentual frente al período anterior"""
+        if not previous:
+            return 'N/A'
+        return f"{(float(current) - float(previous)) / float(previous) * 100:+.1f}%"
+
+    @staticmethod
+    def _format_deviation(alert: AnomalyAlert) -> str:
+        """Desviación porcentual del valor respecto del límite más cercano del rango esperado"""
+        low, high = alert.expected_range_min, alert.expected_range_max
+        if high is not None and alert.metric_value > high and high:
+            return f"{(alert.metric_value - high) / abs(high) * 100:+.0f}%"
+        if low is not None and alert.metric_value < low and low:
+            return f"{(alert.metric_value - low) / abs(low) * 100:+.0f}%"
+        return 'N/A'
+
     def _generate_custom_report(self, config: Dict) -> List[Dict]:
         """Genera reporte personalizado basado en configuración"""
 
@@ -276,13 +705,13 @@ class AutomatedReportingDispatcher:
     def _calculate_custom_metrics(self, metric_ids: List[str]) -> Dict:
         """Calcula métricas personalizadas especificadas"""
 
-        results = {}
-        for metric_id in metric_ids:
-            result = self.mdh.calculate_metric_value(metric_id)
-            if result['success']:
-                results[metric_id] = result['value']
+        batch = self.mdh.calculate_metrics(metric_ids)
 
-        return results
+        return {
+            metric_id: result['value']
+            for metric_id, result in batch.get('results', {}).items()
+            if result['success']
+        }
 
     def _get_metrics_by_category(self, category: str) -> Dict:
         """Obtiene métricas por categoría del MDH"""
@@ -290,10 +719,13 @@ class AutomatedReportingDispatcher:
         metrics = self.mdh.get_all_metrics(category=category)
 
         # Calcular valores actuales
+        metrics = metrics[:6]  # Máximo 6 métricas por sección
+        batch = self.mdh.calculate_metrics([metric['id'] for metric in metrics]).get('results', {})
+
         metric_data = {}
-        for metric in metrics[:6]:  # Máximo 6 métricas por sección
-            result = self.mdh.calculate_metric_value(metric['id'])
-            if result['success']:
+        for metric in metrics:
+            result = batch.get(metric['id'], {})
+            if result.get('success'):
                 metric_data[metric['name']] = {
                     'value': result['value'],
                     'unit': result.get('unit', ''),
@@ -303,219 +735,100 @@ class AutomatedReportingDispatcher:
         return metric_data
 
     def _format_report(self, config: Dict, report_data: Dict) -> Dict:
-        """Formatea el reporte en diferentes formatos soportados"""
+        """
+        Escribe el reporte en el formato configurado (pdf, excel, html o json) y retorna la
+        metadata del archivo generado
+        """
 
         report_format = config.get('format', 'pdf')
+        return write_report(report_format, attach_detail_rows(report_data),
+                            lambda extension: self._report_path(config, extension))
 
-        if report_format == 'pdf':
-            return self._format_as_pdf(config, report_data)
-        elif report_format == 'excel':
-            return self._format_as_excel(config, report_data)
-        elif report_format == 'html':
-            return self._format_as_html(config, report_data)
-        else:  # json por defecto
-            return self._format_as_json(config, report_data)
-
-    def _format_as_pdf(self, config: Dict, report_data: Dict) -> Dict:
-        """Formatea reporte como PDF"""
-
-        # Esta implementación requeriría reportlab o similar
-        # Por ahora, simular generación
-        pdf_content = f"""
-        <html>
-        <head><title>{report_data['title']}</title></head>
-        <body>
-        <h1>{report_data['title']}</h1>
-        <p>Generado: {report_data['generated_at']}</p>
-        <h2>Contenido del Reporte</h2>
-        <pre>{json.dumps(report_data, indent=2)}</pre>
-        </body>
-        </html>
+    def _report_path(self, config: Dict, extension: str, variant_key: Optional[str] = None) -> str:
         """
-
-        # En implementación real, convertiría HTML a PDF
-        return {
-            'format': 'pdf',
-            'content': base64.b64encode(pdf_content.encode()).decode(),
-            'mime_type': 'application/pdf',
-            'extension': 'pdf'
-        }
-
-    def _format_as_excel(self, config: Dict, report_data: Dict) -> Dict:
-        """Formatea reporte como Excel"""
-
-        # Simulación de contenido Excel
-        excel_data = {
-            'summary_sheet': {
-                'title': report_data.get('title', 'Reporte'),
-                'generated_at': report_data.get('generated_at'),
-                'sections': len(report_data.get('sections', []))
-            },
-            'data_sheets': report_data.get('sections', [])
-        }
-
-        return {
-            'format': 'excel',
-            'content': base64.b64encode(json.dumps(excel_data).encode()).decode(),
-            'mime_type': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            'extension': 'xlsx'
-        }
-
-    def _format_as_html(self, config: Dict, report_data: Dict) -> Dict:
-        """Formatea reporte como HTML completo"""
-
-        html_content = f"""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <title>{report_data['title']}</title>
-            <style>
-                body {{ font-family: Arial, sans-serif; margin: 40px; }}
-                .header {{ background: #f0f2f6; padding: 20px; border-radius: 8px; }}
-                .section {{ margin: 20px 0; padding: 15px; border: 1px solid #ddd; border-radius: 5px; }}
-                .metric {{ display: inline-block; margin: 10px; padding: 10px; background: white; border-radius: 5px; }}
-            </style>
-        </head>
-        <body>
-            <div class="header">
-                <h1>{report_data['title']}</h1>
-                <p>Reporte generado automáticamente - {report_data['generated_at']}</p>
-            </div>
-
-            {self._generate_html_sections(report_data.get('sections', []))}
-
-            <div class="footer" style="margin-top: 40px; padding: 20px; background: #f8f9fa; border-radius: 5px;">
-                <p>Reporte generado por OAPCE BI - Sistema de Inteligencia Artificial</p>
-            </div>
-        </body>
-        </html>
+        Ruta del archivo: generated_reports/ si se guarda, o un archivo temporal si solo se
+        distribuye. La clave de la variante (p.ej. vendedor_3) va en el nombre para distinguir
+        los archivos de un mismo lote.
         """
 
-        return {
-            'format': 'html',
-            'content': base64.b64encode(html_content.encode()).decode(),
-            'mime_type': 'text/html',
-            'extension': 'html'
-        }
-
-    def _generate_html_sections(self, sections: List[Dict]) -> str:
-        """Genera HTML para las secciones del reporte"""
-
-        html = ""
-        for section in sections:
-            section_html = f"""
-            <div class="section">
-                <h2>{section['title']}</h2>
-                <div>
-            """
-
-            # Generar contenido específico por tipo
-            if section['type'] == 'metrics_summary':
-                for key, value in section['data'].items():
-                    if isinstance(value, dict):
-                        section_html += f'<div class="metric"><strong>{key}:</strong> {value.get("value", "N/A")}</div>'
-                    else:
-                        section_html += f'<div class="metric"><strong>{key}:</strong> {value}</div>'
-
-            elif section['type'] == 'kpi_list':
-                section_html += '<ul>'
-                for kpi in section['data']:
-                    section_html += '<li class="metric">'
-                    section_html += f'<strong>{kpi["name"]}:</strong> {kpi["value"]} ({kpi["change"]})'
-                    section_html += '</li>'
-                section_html += '</ul>'
-
-            elif section['type'] == 'anomaly_list':
-                for severity, anomalies in section['data'].items():
-                    if anomalies:
-                        section_html += f'<h3>{severity.title()}</h3><ul>'
-                        for anomaly in anomalies:
-                            section_html += f'<li>{anomaly["metric"]}: {anomaly["value"]} (esperado: {anomaly["expected"]}, desviación: {anomaly["deviation"]})</li>'
-                        section_html += '</ul>'
-
-            section_html += "</div></div>"
-            html += section_html
-
-        return html
-
-    def _format_as_json(self, config: Dict, report_data: Dict) -> Dict:
-        """Formatea reporte como JSON estructurado"""
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+        name = config['type']
+        if variant_key:
+            name = f"{name}_{re.sub(r'[^A-Za-z0-9_-]+', '_', str(variant_key))}"
+        if not config.get('save_to_file', True):
+            fd, path = tempfile.mkstemp(prefix=f"{name}_{timestamp}_", suffix=f".{extension}")
+            os.close(fd)
+            return path
+        return os.path.join(self.output_dir, f"{name}_{timestamp}.{extension}")
 
-        return {
-            'format': 'json',
-            'content': base64.b64encode(json.dumps(report_data, indent=2).encode()).decode(),
-            'mime_type': 'application/json',
-            'extension': 'json'
-        }
-
-    def _save_report_to_file(self, formatted_report: Dict, config: Dict) -> str:
-        """Guarda el reporte en un archivo"""
+    def _distribute_report(self, formatted_report: Dict, config: Dict) -> Dict:
+        """Distribuye el reporte a los destinatarios configurados"""
 
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        filename = f"{config['type']}_{timestamp}.{formatted_report['extension']}"
-        filepath = os.path.join(self.output_dir, filename)
+        return self._distribute_reports([(formatted_report, config)])[0]
 
-        # Guardar contenido basado en formato
-        content_data = base64.b64decode(formatted_report['content'])
-        with open(filepath, 'wb') as f:
-            f.write(content_data)
+    def _distribute_reports(self, reports: List[Tuple[Dict, Dict]]) -> List[Dict]:
+        """
+        Distribuye varios reportes (formatted_report, config) en una sola pasada asíncrona:
+        los emails comparten conexiones SMTP y el límite de envíos, y los webhooks se envían
+        en paralelo
+        """
 
-        return filepath
+        deliveries = [self._build_delivery(formatted_report, config) for formatted_report, config in reports]
+        sent = self.distributor.distribute(deliveries)
 
-    def _distribute_report(self, formatted_report: Dict, config: Dict) -> Dict:
-        """Distribuye el reporte a los destinatarios configurados"""
+        # 'slack' es el resultado del webhook de Slack, o None si no se envió notificación
+        results = []
+        for outcome in sent:
+            results.append({
+                'email': outcome['email'],
+                'slack': next((webhook for webhook in outcome['webhooks'] if webhook['name'] == 'slack'), None),
+                'webhooks': [webhook for webhook in outcome['webhooks'] if webhook['name'] != 'slack']
+            })
+        return results
 
-        results = {'email': [], 'slack': []}
+    def _build_delivery(self, formatted_report: Dict, config: Dict) -> Dict:
+        """Entrega de un reporte: email con el archivo adjunto, Slack y webhooks configurados"""
 
+        title = config.get('title', f'Reporte {config["type"]}')
         recipients = config.get('recipients', [])
         # Si no hay destinatarios, enviar al usuario actual si existe
         if not recipients and self.user and 'email' in self.user:
             recipients = [self.user['email']]
 
-        # Enviar por email si está configurado
-        if recipients and self._is_email_configured():
-            email_results = self._send_emails(formatted_report, config, recipients)
-            results['email'] = email_results
-
-        # Enviar por Slack si está configurado
+        webhooks = []
         if config.get('slack_notification', False) and self.default_config['webhook_slack']:
-            slack_result = self._send_slack_notification(formatted_report, config)
-            results['slack'] = slack_result
-
-        return results
-
-    def _send_emails(self, formatted_report: Dict, config: Dict, recipients: List[str]) -> List[Dict]:
-        """Envía el reporte por email a múltiples destinatarios"""
-
-        results = []
-
-        # Esta implementación requeriría smtplib
-        # Por ahora, simular envíos exitosos
-        for recipient in recipients:
-            results.append({
-                'recipient': recipient,
-                'status': 'sent',
-                'subject': config.get('title', f'Reporte {config["type"]}')
+            webhooks.append({
+                'name': 'slack',
+                'url': self.default_config['webhook_slack'],
+                'payload': {'text': f'Nuevo reporte generado: {title}'}
+            })
+        for url in config.get('webhook_urls', []):
+            webhooks.append({
+                'name': url,
+                'url': url,
+                'payload': {
+                    'report_type': config['type'],
+                    'title': title,
+                    'format': formatted_report['format'],
+                    'size_bytes': formatted_report['size_bytes'],
+                    'detail_rows': formatted_report['detail_rows'],
+                    'file_path': formatted_report['file_path'] if config.get('save_to_file', True) else None
+                }
             })
 
-        return results
-
-    def _send_slack_notification(self, formatted_report: Dict, config: Dict) -> Dict:
-        """Envía notificación por Slack"""
-
-        # Simulación de envío a Slack
         return {
-            'status': 'sent',
-            'channel': '#reportes',
-            'message': f'Nuevo reporte generado: {config.get("title", "Reporte Automático")}'
+            'subject': title,
+            'body': f"Adjunto el reporte \"{title}\" generado el {datetime.now().strftime('%d/%m/%Y %H:%M')}.",
+            'recipients': recipients,
+            'attachment_path': formatted_report['file_path'],
+            'attachment_name': f"{config['type']}_{datetime.now().strftime('%Y%m%d')}.{formatted_report['extension']}",
+            'mime_type': formatted_report['mime_type'],
+            'webhooks': webhooks
         }
 
     def _is_email_configured(self) -> bool:
         """Verifica si el envío de emails está configurado"""
-        return bool(
-            self.default_config['sender_email'] and
-            self.default_config['sender_password']
-        )
+        return self.distributor.is_email_configured()
 
     def _log_report_generation(self, config: Dict, processing_time: float):
         """Registra la generación del reporte"""
@@ -537,39 +850,34 @@ class AutomatedReportingDispatcher:
             logger.error(f"Error registrando generación de reporte: {str(e)}")
 
     def schedule_report(self, report_config: Dict, schedule_config: Dict) -> Dict:
-        """Programa un reporte para ejecución automática"""
+        """
+        Programa un reporte para ejecución automática (tabla report_schedules)
 
-        # Esta implementación requeriría celery o similar
-        # Por ahora, simular scheduling
-        return {
-            'success': True,
-            'schedule_id': f"scheduled_{datetime.now().timestamp()}",
-            'next_run': schedule_config.get('next_run', 'daily_9am'),
-            'frequency': schedule_config.get('frequency', 'daily')
-        }
+        Args:
+            report_config: Configuración del reporte, igual que en generate_automated_report
+            schedule_config: frequency ('hourly', 'daily', 'weekly', 'monthly'), hour, minute,
+                day_of_week (0=lunes) y day_of_month
+        """
+
+        try:
+            self._validate_report_config(report_config)
+            schedule = report_scheduler.schedule(
+                report_config, schedule_config, created_by=self.user.get('id') if self.user else None
+            )
+            return {
+                'success': True,
+                'schedule_id': schedule['id'],
+                'next_run': schedule['next_run_at'],
+                'frequency': schedule['frequency']
+            }
+        except Exception as e:
+            logger.error(f"Error programando reporte: {str(e)}")
+            return {'success': False, 'error': str(e)}
 
     def get_scheduled_reports(self) -> List[Dict]:
-        """Obtiene lista de reportes programados"""
+        """Obtiene lista de reportes programados activos"""
 
-        # Simulación de reportes programados
-        return [
-            {
-                'id': 'weekly_kpi',
-                'name': 'KPIs Semanales',
-                'type': 'weekly_summary',
-                'schedule': 'monday_9am',
-                'recipients': ['gerencia@empresa.cl', 'ventas@empresa.cl'],
-                'active': True
-            },
-            {
-                'id': 'monthly_finance',
-                'name': 'Finanzas Mensuales',
-                'type': 'monthly_finance',
-                'schedule': 'month_first_8am',
-                'recipients': ['contabilidad@empresa.cl'],
-                'active': True
-            }
-        ]
+        return report_scheduler.list_schedules()
 
     def close(self):
         """Cierra conexiones"""
@@ -0,0 +1,97 @@
+"""
+Cache en memoria compartido por los agentes
+Cache thread-safe con expiración por TTL y desalojo LRU
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+# Marca para distinguir "no está en cache" de un valor None cacheado
+MISSING = object()
+
+
+class TTLCache:
+    """
+    Cache clave/valor con tiempo de vida por entrada y tamaño máximo (LRU)
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # clave -> (expira_en, valor)
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = MISSING) -> Any:
+        """Obtiene un valor vigente o `default` si no existe o expiró"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            expires_at, value = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = MISSING):
+        """Guarda un valor; `ttl` sobrescribe el tiempo de vida por defecto"""
+        ttl = self.ttl if ttl is MISSING else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get_or_set(self, key: Hashable, loader: Callable[[], Any], ttl: Optional[float] = MISSING) -> Any:
+        """Lectura con carga: si la clave no está vigente, ejecuta `loader` y guarda el resultado"""
+        value = self.get(key)
+        if value is MISSING:
+            value = loader()
+            self.set(key, value, ttl)
+        return value
+
+    def invalidate(self, key: Hashable):
+        """Elimina una clave"""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def invalidate_where(self, predicate: Callable[[Hashable], bool]) -> int:
+        """Elimina las claves que cumplen `predicate` y retorna cuántas se eliminaron"""
+        with self._lock:
+            keys = [key for key in self._data if predicate(key)]
+            for key in keys:
+                del self._data[key]
+            return len(keys)
+
+    def clear(self):
+        """Vacía el cache"""
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        """Estadísticas de uso del cache"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0
+            }
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
@@ -0,0 +1,2 @@
+# Todas las pruebas de pytest corren sobre la base de datos temporal de testing_env
+import testing_env  # noqa: F401
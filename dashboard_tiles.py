@@ -0,0 +1,180 @@
+"""
+Dashboard Tiles - Agente 5 (SSBF)
+Renderizado de los tiles de dashboards con cache compartido entre sesiones y
+precálculo de los dashboards más vistos
+"""
+
+import hashlib
+import json
+import os
+import time
+from typing import Dict, List
+
+from cache import TTLCache, MISSING
+from database import SessionLocal
+from metric_execution import metric_execution_service, format_metric_value
+from models import UserDashboard
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Vida de un tile renderizado. La clave incluye la versión de datos (contador de escrituras
+# por tabla, ver data_versions), así que un INSERT, UPDATE o DELETE en las tablas que lee el
+# tile lo invalida antes del TTL, con una demora de hasta DATA_VERSION_TTL segundos
+TILE_CACHE_TTL = float(os.getenv('SSBF_TILE_CACHE_TTL_SECONDS', '1800'))
+# Dashboards más vistos que se precalculan en segundo plano
+PREWARM_DASHBOARD_LIMIT = int(os.getenv('SSBF_PREWARM_DASHBOARDS', '20'))
+
+# Tiles por (hash de la definición, filtros, versión de datos), compartidos por el proceso
+_tile_cache = TTLCache(maxsize=8192, ttl=TILE_CACHE_TTL)
+
+
+def extract_tiles(config: Dict) -> List[Dict]:
+    """
+    Tiles de métricas declarados en la configuración de un dashboard. Cada métrica de una
+    sección puede ser su nombre o un dict {'metric': nombre, 'params': {...}}.
+    """
+    tiles = []
+    for section in (config or {}).get('sections', []):
+        for entry in section.get('metrics', []):
+            tile = {'metric': entry} if isinstance(entry, str) else dict(entry)
+            tile.setdefault('params', {})
+            tile['section'] = section.get('title')
+            tiles.append(tile)
+    return tiles
+
+
+class DashboardTileRenderer:
+    """
+    Calcula los tiles de métricas de un dashboard. Los tiles vigentes se leen del cache; el
+    resto se calcula en un solo lote del servicio de métricas.
+    """
+
+    def render(self, config: Dict, params: Dict = None) -> Dict:
+        """
+        Renderiza los tiles de la configuración con los filtros `params` (comunes a todos los
+        tiles; los `params` propios del tile tienen prioridad)
+        """
+        start_time = time.time()
+        tiles = extract_tiles(config)
+        metric_ids = metric_execution_service.resolve_names([tile['metric'] for tile in tiles])
+        definitions = metric_execution_service.get_definitions(list(metric_ids.values()))
+
+        rendered: List[Dict] = [None] * len(tiles)
+        pending = {}  # clave de cache -> (posiciones, id de métrica, filtros)
+        cached_count = 0
+
+        for position, tile in enumerate(tiles):
+            metric_id = metric_ids.get(tile['metric'])
+            definition = definitions.get(metric_id) if metric_id else None
+            if definition is None:
+                rendered[position] = {
+                    'section': tile['section'],
+                    'metric': tile['metric'],
+                    'success': False,
+                    'error': "Métrica no encontrada"
+                }
+                continue
+
+            tile_params = {**(params or {}), **tile['params']}
+            key = self._tile_key(tile, definition, tile_params)
+            value = _tile_cache.get(key)
+            if value is not MISSING:
+                rendered[position] = {**value, 'section': tile['section'], 'cached': True}
+                cached_count += 1
+            elif key in pending:
+                pending[key][0].append(position)
+            else:
+                pending[key] = ([position], metric_id, tile_params)
+
+        # Los tiles sin cache se agrupan por filtros para calcularlos en lote
+        by_params: Dict[str, List] = {}
+        for key, (positions, metric_id, tile_params) in pending.items():
+            group = json.dumps(tile_params, sort_keys=True, default=str)
+            by_params.setdefault(group, []).append((key, positions, metric_id, tile_params))
+
+        for group in by_params.values():
+            executions = metric_execution_service.execute_many(
+                [metric_id for _, _, metric_id, _ in group], group[0][3]
+            )
+            for key, positions, metric_id, _ in group:
+                value = self._tile_value(definitions[metric_id], executions[metric_id])
+                if value['success']:
+                    _tile_cache.set(key, value)
+                for position in positions:
+                    rendered[position] = {**value, 'section': tiles[position]['section'], 'cached': False}
+
+        return {
+            "success": True,
+            "tiles": rendered,
+            "charts": list((config or {}).get('charts', [])),
+            "tiles_cached": cached_count,
+            "tiles_computed": len(tiles) - cached_count,
+            "render_time_ms": round((time.time() - start_time) * 1000, 1)
+        }
+
+    def prewarm_popular_dashboards(self, limit: int = PREWARM_DASHBOARD_LIMIT) -> Dict:
+        """
+        Precalcula los tiles (con filtros por defecto) de los dashboards con más visitas
+        """
+        start_time = time.time()
+        db = SessionLocal()
+        try:
+            dashboards = db.query(UserDashboard.id, UserDashboard.config).filter(
+                UserDashboard.config.isnot(None)
+            ).order_by(
+                UserDashboard.view_count.desc(), UserDashboard.id
+            ).limit(limit).all()
+        finally:
+            db.close()
+
+        warmed, computed = 0, 0
+        for dashboard_id, config in dashboards:
+            try:
+                result = self.render(json.loads(config))
+                computed += result['tiles_computed']
+                warmed += 1
+            except Exception as e:
+                logger.warning(f"Error precalculando dashboard {dashboard_id}: {str(e)}")
+
+        return {
+            "success": True,
+            "dashboards_warmed": warmed,
+            "tiles_computed": computed,
+            "execution_time_seconds": round(time.time() - start_time, 2)
+        }
+
+    def stats(self) -> Dict:
+        """Estadísticas del cache de tiles"""
+        return _tile_cache.stats()
+
+    @staticmethod
+    def _tile_key(tile: Dict, definition: Dict, tile_params: Dict):
+        """Clave del tile: definición (incluida la fórmula vigente), filtros y versión de datos"""
+        tile_hash = hashlib.sha256(json.dumps(
+            {'metric': tile['metric'], 'params': tile['params'], 'formula': definition['formula_hash']},
+            sort_keys=True, default=str
+        ).encode('utf-8')).hexdigest()
+        return (
+            tile_hash,
+            json.dumps(tile_params, sort_keys=True, default=str),
+            metric_execution_service.data_version(definition['tables'])
+        )
+
+    @staticmethod
+    def _tile_value(definition: Dict, execution: Dict) -> Dict:
+        """Contenido renderizado de un tile"""
+        if not execution['success']:
+            return {'metric': definition['name'], 'success': False, 'error': execution['error']}
+        return {
+            'metric': definition['name'],
+            'title': definition['display_name'],
+            'success': True,
+            'raw_value': execution['value'],
+            'formatted_value': format_metric_value(execution['value'], definition['data_type']),
+            'unit': definition['unit'],
+            'data_type': definition['data_type']
+        }
+
+
+dashboard_tile_renderer = DashboardTileRenderer()
@@ -0,0 +1,69 @@
+"""
+Data Versions
+Token de versión por tabla para invalidar caches de resultados. Cada sentencia INSERT,
+UPDATE o DELETE sobre una tabla de negocio incrementa uno de sus slots en data_versions
+(trigger por sentencia en PostgreSQL, la aplicación en SQLite; ver
+database.install_data_version_triggers), así que el token cambia también con las
+modificaciones en sitio y con escrituras de otros procesos. Leerlo es una suma por clave
+primaria; se memoriza DATA_VERSION_TTL segundos.
+"""
+
+import os
+from typing import Iterable, Tuple
+
+from sqlalchemy import func, select
+from sqlalchemy.exc import SQLAlchemyError
+
+from cache import TTLCache, MISSING
+from database import Base, engine
+from models import DataVersion
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Demora máxima con la que se observa una escritura
+DATA_VERSION_TTL = float(os.getenv('DATA_VERSION_TTL_SECONDS', '2'))
+
+_versions = TTLCache(maxsize=256, ttl=DATA_VERSION_TTL)
+
+
+def table_versions(tables: Iterable[str]) -> Tuple:
+    """
+    Versión de cada tabla: ('v', contador) si está en data_versions, o ('id', máximo id) como
+    respaldo para las demás (este último no detecta modificaciones ni eliminaciones)
+    """
+    tables = sorted(set(tables))
+    missing = [table for table in tables if _versions.get(table) is MISSING]
+
+    if missing:
+        counters = {}
+        try:
+            with engine.connect() as conn:
+                counters = dict(conn.execute(
+                    select(DataVersion.table_name, func.sum(DataVersion.version))
+                    .where(DataVersion.table_name.in_(missing))
+                    .group_by(DataVersion.table_name)
+                ).all())
+        except SQLAlchemyError as e:
+            logger.warning(f"Versiones de datos no disponibles, se usa el máximo id: {str(e)}")
+
+        for table in missing:
+            if table in counters:
+                _versions.set(table, ('v', counters[table]))
+            else:
+                _versions.set(table, ('id', _max_id(table)))
+
+    return tuple((table, *_versions.get(table)) for table in tables)
+
+
+def _max_id(table_name: str):
+    table = Base.metadata.tables.get(table_name)
+    if table is None or 'id' not in table.c:
+        return None
+    with engine.connect() as conn:
+        return conn.execute(select(func.max(table.c.id))).scalar()
+
+
+def clear():
+    """Olvida las versiones memorizadas (la próxima lectura consulta la BD)"""
+    _versions.clear()
@@ -1,7 +1,10 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+import logging
 import os
+import re
+import sqlite3
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -13,6 +16,28 @@ engine = create_engine(DATABASE_URL, echo=False)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+# Columnas agregadas a tablas existentes: create_all no altera tablas ya creadas. El cuarto
+# elemento opcional es el valor con que se completan las filas existentes
+SCHEMA_MIGRATIONS = [
+    ("model_predictions", "run_id", "VARCHAR(32)"),
+    ("model_predictions", "is_active", "INTEGER DEFAULT 1"),
+    ("clientes", "updated_at", "TIMESTAMP", "CURRENT_TIMESTAMP"),
+    ("facturas", "updated_at", "TIMESTAMP", "CURRENT_TIMESTAMP"),
+]
+
+# Tablas cuyas escrituras incrementan su versión en data_versions (caches de métricas y del GDA)
+DATA_VERSIONED_TABLES = ["clientes", "vendedores", "facturas", "cobranzas", "movimientos_caja", "actividades_venta"]
+
+# Filas de data_versions por tabla en PostgreSQL: cada backend incrementa la de su slot, así
+# los escritores concurrentes de una misma tabla no se bloquean entre sí
+DATA_VERSION_SLOTS = 64
+
+# Tabla modificada por una sentencia INSERT / UPDATE / DELETE
+_WRITE_STATEMENT_RE = re.compile(
+    r'^\s*(?:INSERT(?:\s+OR\s+\w+)?\s+INTO|UPDATE(?:\s+OR\s+\w+)?|DELETE\s+FROM)\s+["`\[]?(\w+)',
+    re.IGNORECASE
+)
+
 def get_db():
     db = SessionLocal()
     try:
@@ -23,10 +48,137 @@ def get_db():
 
 def init_db():
     from models import (Usuario, Cliente, Vendedor, Factura, Cobranza, MovimientoCaja, ActividadVenta,
-                       DataQualityLog, CatalogMetadata, ModelPrediction, ModelMetric,
+                       DataQualityLog, CatalogMetadata, ModelPrediction, ModelMetric, ModelArtifact,
+                       Recommendation, RecommendationWatermark,
                        AnomalyAlert, AnomalyMetric, PredefinedMetric, UserDashboard,
-                       DashboardPermission, DashboardTemplate)
+                       DashboardPermission, DashboardTemplate, ReportSchedule, ReportRun, DataVersion)
     Base.metadata.create_all(bind=engine)
+    apply_schema_migrations()
+
+def apply_schema_migrations():
+    """
+    Agrega las columnas de SCHEMA_MIGRATIONS que falten y crea los índices declarados
+    en los modelos. Es idempotente, se puede ejecutar en cada arranque.
+    """
+    inspector = inspect(engine)
+
+    with engine.begin() as conn:
+        for table_name, column_name, column_ddl, *backfill in SCHEMA_MIGRATIONS:
+            if not inspector.has_table(table_name):
+                continue
+            existing_columns = {column['name'] for column in inspector.get_columns(table_name)}
+            if column_name not in existing_columns:
+                conn.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_ddl}"))
+                if backfill:
+                    conn.execute(text(f"UPDATE {table_name} SET {column_name} = {backfill[0]}"))
+
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
+    install_data_version_triggers()
+
+def install_data_version_triggers():
+    """
+    Prepara data_versions para las tablas de DATA_VERSIONED_TABLES. Es idempotente.
+
+    En PostgreSQL un trigger por sentencia incrementa, en la misma transacción, el slot del
+    backend que escribe. En SQLite el incremento lo hace la aplicación, una vez por sentencia
+    (ver install_sqlite_version_listener), en lugar de un trigger por fila.
+    """
+    inspector = inspect(engine)
+    if not inspector.has_table("data_versions"):
+        return
+    tables = [table for table in DATA_VERSIONED_TABLES if inspector.has_table(table)]
+
+    with engine.begin() as conn:
+        if engine.dialect.name == "sqlite":
+            # Triggers por fila de versiones anteriores
+            for table in tables:
+                for operation in ("insert", "update", "delete"):
+                    conn.execute(text(f"DROP TRIGGER IF EXISTS trg_{table}_{operation}_version"))
+        elif engine.dialect.name == "postgresql":
+            for table in tables:
+                conn.execute(text(f"DROP TRIGGER IF EXISTS trg_{table}_version ON {table}"))
+
+        _migrate_data_versions_slots(conn, inspector)
+
+        if engine.dialect.name == "sqlite":
+            for table in tables:
+                conn.execute(text("INSERT OR IGNORE INTO data_versions (table_name, slot, version) "
+                                  "VALUES (:t, 0, 0)"), {"t": table})
+
+        elif engine.dialect.name == "postgresql":
+            conn.execute(text(
+                "CREATE OR REPLACE FUNCTION bump_data_version() RETURNS trigger AS $$ BEGIN "
+                "INSERT INTO data_versions (table_name, slot, version) "
+                f"VALUES (TG_TABLE_NAME, pg_backend_pid() % {DATA_VERSION_SLOTS}, 1) "
+                "ON CONFLICT (table_name, slot) DO UPDATE SET version = data_versions.version + 1; "
+                "RETURN NULL; END; $$ LANGUAGE plpgsql"
+            ))
+            for table in tables:
+                conn.execute(text("INSERT INTO data_versions (table_name, slot, version) VALUES (:t, 0, 0) "
+                                  "ON CONFLICT (table_name, slot) DO NOTHING"), {"t": table})
+                conn.execute(text(
+                    f"CREATE TRIGGER trg_{table}_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE "
+                    f"ON {table} FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version()"
+                ))
+
+        else:
+            logging.getLogger(__name__).warning(
+                f"Triggers de versión de datos no soportados en {engine.dialect.name}; "
+                "los caches usarán el máximo id de cada tabla"
+            )
+
+def _migrate_data_versions_slots(conn, inspector):
+    """
+    Pasa data_versions del esquema de una fila por tabla al de slots, conservando los
+    contadores para que ninguna versión ya vista se repita
+    """
+    columns = {column['name'] for column in inspector.get_columns("data_versions")}
+    if "slot" in columns:
+        return
+
+    from models import DataVersion
+    conn.execute(text("ALTER TABLE data_versions RENAME TO data_versions_legacy"))
+    if engine.dialect.name == "postgresql":
+        # El nombre de la clave primaria sigue asociado a la tabla renombrada
+        conn.execute(text("ALTER TABLE data_versions_legacy DROP CONSTRAINT IF EXISTS data_versions_pkey"))
+    DataVersion.__table__.create(bind=conn)
+    conn.execute(text("INSERT INTO data_versions (table_name, slot, version) "
+                      "SELECT table_name, 0, version FROM data_versions_legacy"))
+    conn.execute(text("DROP TABLE data_versions_legacy"))
+
+def _bump_sqlite_data_version(conn, cursor, statement, parameters, context, executemany):
+    """Incrementa la versión de la tabla escrita por la sentencia, en su misma transacción"""
+    match = _WRITE_STATEMENT_RE.match(statement)
+    if not match or match.group(1).lower() not in DATA_VERSIONED_TABLES:
+        return
+    # Sin filas afectadas no hay cambio (con RETURNING el rowcount se conoce recién al leer)
+    if cursor.rowcount == 0 and "RETURNING" not in statement.upper():
+        return
+
+    # Cursor propio: el de la sentencia conserva su rowcount y lastrowid
+    bump = cursor.connection.cursor()
+    try:
+        bump.execute(
+            "INSERT INTO data_versions (table_name, slot, version) VALUES (?, 0, 1) "
+            "ON CONFLICT (table_name, slot) DO UPDATE SET version = version + 1",
+            (match.group(1).lower(),)
+        )
+    except sqlite3.OperationalError:
+        # data_versions aún no existe o conserva el esquema anterior (antes de init_db)
+        pass
+    finally:
+        bump.close()
+
+def install_sqlite_version_listener(target_engine):
+    """Registra el incremento de data_versions por sentencia en un engine SQLite"""
+    if target_engine.dialect.name == "sqlite" and not event.contains(
+            target_engine, "after_cursor_execute", _bump_sqlite_data_version):
+        event.listen(target_engine, "after_cursor_execute", _bump_sqlite_data_version)
+
+install_sqlite_version_listener(engine)
 
 def init_db_real_data():
     """
@@ -43,7 +195,11 @@ def init_db_real_data():
                 CREATE INDEX IF NOT EXISTS idx_facturas_cliente_id ON facturas (cliente_id);
                 CREATE INDEX IF NOT EXISTS idx_facturas_fecha_emision ON facturas (fecha_emision);
                 CREATE INDEX IF NOT EXISTS idx_facturas_estado ON facturas (estado);
-                CREATE INDEX IF NOT EXISTS idx_actividades_cliente ON actividades_venta (cliente_id);
+                CREATE INDEX IF NOT EXISTS idx_facturas_estado_emision ON facturas (estado, fecha_emision);
+                CREATE INDEX IF NOT EXISTS idx_facturas_estado_vencimiento ON facturas (estado, fecha_vencimiento);
+                CREATE INDEX IF NOT EXISTS idx_movimientos_caja_fecha ON movimientos_caja (fecha, tipo, categoria, monto);
+                CREATE INDEX IF NOT EXISTS idx_cobranzas_fecha_pago ON cobranzas (fecha_pago);
+                CREATE INDEX IF NOT EXISTS idx_actividades_cliente_nombre ON actividades_venta (lower(trim(cliente_nombre)));
                 CREATE INDEX IF NOT EXISTS idx_actividades_fecha ON actividades_venta (fecha);
                 CREATE INDEX IF NOT EXISTS idx_model_predictions_type ON model_predictions (prediction_type);
                 CREATE INDEX IF NOT EXISTS idx_anomalies_metric ON anomaly_alerts (metric_name);
@@ -36,6 +36,10 @@ engine = create_engine(DATABASE_URL, echo=False)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+# Las escrituras de las integraciones también invalidan los caches (ver database.py)
+from database import install_sqlite_version_listener  # noqa: E402
+install_sqlite_version_listener(engine)
+
 def get_db():
     """Obtener sesión de base de datos"""
     db = SessionLocal()
@@ -3,13 +3,23 @@ Generative Data Assistant (GDA) - Agente 7
 Asistente de consultas en lenguaje natural sobre los datos del sistema
 """
 
+import asyncio
+import hashlib
 import json
+import os
 import re
+import sqlite3
+import threading
 import time
-from datetime import datetime
-from typing import Dict, List, Optional, Any, Tuple
+from datetime import date, datetime, timedelta
+from functools import lru_cache, partial
+from typing import Dict, Iterator, List, Optional, Any, Tuple
+from sqlalchemy import case, extract, func
+from cache import TTLCache, MISSING
+from data_versions import table_versions
 from database import get_db
-from models import Cliente, Factura, Vendedor, ActividadVenta
+from llm_providers import DRAFT_MARKER, LLMTimeoutError, get_llm_provider, llm_runtime
+from models import Cliente, Factura, Vendedor, ActividadVenta, EstadoFacturaEnum
 from unified_logger import unified_logger
 from metrics_hub import MetricsDefinitionHub
 from auth import get_current_user
@@ -17,15 +27,267 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+# Resultados de consultas de datos por (tipo, parámetros, rol, vendedor); compartido entre instancias
+_query_result_cache = TTLCache(maxsize=512, ttl=60)
+
+# Cache de respuestas: vigencia en memoria y archivo SQLite opcional para sobrevivir reinicios
+ANSWER_CACHE_TTL = int(os.getenv('GDA_ANSWER_CACHE_TTL', '300'))
+ANSWER_CACHE_PATH = os.getenv('GDA_ANSWER_CACHE_PATH')
+
+# Tablas que lee cada tipo de consulta de datos; su versión invalida las respuestas cacheadas
+PLAN_QUERY_TABLES = {
+    'metrics_calculation': ['facturas', 'clientes'],
+    'financial_summary': ['facturas', 'clientes'],
+    'time_series': ['facturas', 'clientes'],
+    'comparison': ['facturas', 'clientes']
+}
+
+# Tablas consultables: (modelo, columna de fecha, columnas filtrables por igualdad)
+QUERYABLE_TABLES = {
+    'clientes': (Cliente, Cliente.fecha_ingreso, ['estado_funnel', 'vendedor_id']),
+    'facturas': (Factura, Factura.fecha_emision, ['estado', 'cliente_id']),
+    'vendedores': (Vendedor, None, ['activo']),
+    'actividades_venta': (ActividadVenta, ActividadVenta.fecha, ['tipo_actividad', 'vendedor_id'])
+}
+
+MONTHS = {
+    'enero': 1, 'febrero': 2, 'marzo': 3, 'abril': 4, 'mayo': 5, 'junio': 6, 'julio': 7,
+    'agosto': 8, 'septiembre': 9, 'octubre': 10, 'noviembre': 11, 'diciembre': 12
+}
+
+PERIOD_DAYS = {'last_30_days': 30, 'last_90_days': 90, 'last_180_days': 180}
+
+# Patrones para identificar tipos de consulta (en orden de desempate)
+INTENT_PATTERNS = {
+    'metricas_kpi': [
+        r'ventas', r'ingresos', r'revenue', r'facturación',
+        r'conversión', r'conversion', r'clv', r'valor.*vida',
+        r'churn', r'abandono', r'satisfacción', r'kpi'
+    ],
+    'clientes': [
+        r'cliente', r'prospecto', r'lead', r'usuario'
+    ],
+    'facturas': [
+        r'factur', r'pago', r'pagad', r'vencid', r'impagad',
+        r'cobranza', r'deuda', r'monto'
+    ],
+    'tendencias': [
+        r'tendencia', r'evolución', r'cambio', r'versus', r'comparad',
+        r'últim', r'pasad', r'mes', r'semana', r'año'
+    ],
+    'comparaciones': [
+        r'compar', r'vs', r'versus', r'mejor', r'peor',
+        r'más', r'menos', r'aumento', r'disminución'
+    ],
+    'anomalias': [
+        r'anomal', r'extrañ', r'rar', r'insólit', r'desviación',
+        r'problema', r'issue', r'alerta'
+    ]
+}
+
+# Fechas como palabras completas: 'mayor' no es mayo y un año es un número suelto de 4 cifras
+# (19xx o 20xx), no los primeros dígitos de un monto como 2000000
+DATE_PATTERN = (r'\b(?:\d{1,2}/\d{1,2}/\d{4}|enero|febrero|marzo|abril|mayo|junio|julio|agosto|septiembre'
+                r'|octubre|noviembre|diciembre|(?:19|20)\d{2})\b')
+NUMBER_PATTERN = r'\d+(?:\.\d+)?'
+_DATE_RE = re.compile(DATE_PATTERN, re.IGNORECASE)
+_NUMBER_RE = re.compile(NUMBER_PATTERN)
+
+def _build_intent_scanner(intent_patterns: Dict[str, List[str]]):
+    """
+    Índice de una sola pasada para los patrones de intención.
+
+    Los patrones literales van en una alternancia dentro de un lookahead, del más largo al más
+    corto: como el lookahead no consume, se prueba en cada posición y se detectan también las
+    coincidencias solapadas ('rar' dentro de 'comparar'). En una posición gana el literal más
+    largo que coincide; los demás que coinciden ahí son prefijos suyos ('pago' en 'pagado'),
+    así que cada literal lleva precalculados los patrones que implica. Los patrones con
+    metacaracteres (p.ej. 'valor.*vida') se buscan aparte.
+    """
+    patterns = list(dict.fromkeys(p for patterns_list in intent_patterns.values() for p in patterns_list))
+    literals = [p for p in patterns if re.escape(p) == p]
+    scanner = re.compile('(?=(' + '|'.join(sorted(literals, key=len, reverse=True)) + '))')
+    implied = {
+        literal: tuple(patterns.index(other) for other in literals if literal.startswith(other))
+        for literal in literals
+    }
+    others = [(patterns.index(p), re.compile(p)) for p in patterns if p not in implied]
+    # Tipos a los que suma cada patrón (un patrón puede aparecer en más de un tipo)
+    pattern_intents = [
+        [intent for intent, patterns_list in intent_patterns.items() for _ in range(patterns_list.count(p))]
+        for p in patterns
+    ]
+    return scanner, implied, others, pattern_intents
+
+
+(_INTENT_SCANNER, _IMPLIED_PATTERNS,
+ _OTHER_INTENT_REGEXES, _PATTERN_INTENTS) = _build_intent_scanner(INTENT_PATTERNS)
+
+
+@lru_cache(maxsize=4096)
+def classify_intent(query: str) -> Tuple[str, Tuple[str, ...]]:
+    """
+    Clasifica una consulta normalizada con una pasada del índice de patrones.
+
+    Returns:
+        (tipo_consulta, entidades): las fechas primero y luego los números
+    """
+    matched = set()
+    for match in _INTENT_SCANNER.finditer(query):
+        matched.update(_IMPLIED_PATTERNS[match.group(1)])
+    for index, regex in _OTHER_INTENT_REGEXES:
+        if regex.search(query):
+            matched.add(index)
+
+    counts = dict.fromkeys(INTENT_PATTERNS, 0)
+    for index in matched:
+        for intent in _PATTERN_INTENTS[index]:
+            counts[intent] += 1
+
+    # Tipo con más patrones coincidentes; en empate gana el primero declarado
+    query_type = 'general'
+    max_matches = 0
+    for candidate, matches in counts.items():
+        if matches > max_matches:
+            max_matches = matches
+            query_type = candidate
+
+    # Fechas y números se extraen por separado sobre toda la consulta
+    return query_type, tuple(_DATE_RE.findall(query) + _NUMBER_RE.findall(query))
+
+
+def parse_date_range(entities: List[str], today: Optional[date] = None) -> Optional[Tuple[date, date]]:
+    """
+    Interpreta las fechas extraídas por `_classify_query` como un rango [inicio, fin).
+
+    Un mes (con o sin año) cubre ese mes, un año solo cubre el año completo y una o más
+    fechas dd/mm/yyyy cubren desde la primera hasta la última, inclusive.
+    """
+    today = today or date.today()
+    years = [int(e) for e in entities if re.fullmatch(r'(19|20)\d{2}', e)]
+    months = [MONTHS[e.lower()] for e in entities if e.lower() in MONTHS]
+    days = []
+    for e in entities:
+        match = re.fullmatch(r'(\d{1,2})/(\d{1,2})/(\d{4})', e)
+        if match:
+            try:
+                days.append(date(int(match.group(3)), int(match.group(2)), int(match.group(1))))
+            except ValueError:
+                continue
+
+    if days:
+        return min(days), max(days) + timedelta(days=1)
+
+    if months:
+        # Sin año explícito se asume la ocurrencia más reciente del mes
+        year = years[0] if years else (today.year if months[0] <= today.month else today.year - 1)
+        start = date(year, min(months), 1)
+        last_month = max(months)
+        end = date(year + 1, 1, 1) if last_month == 12 else date(year, last_month + 1, 1)
+        return start, end
+
+    if years:
+        return date(min(years), 1, 1), date(max(years) + 1, 1, 1)
+
+    return None
+
+
+class AnswerCache:
+    """
+    Cache de respuestas del asistente: TTL/LRU en memoria con respaldo opcional en un
+    archivo SQLite, compartido por todos los procesos que apunten al mismo archivo
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = ANSWER_CACHE_TTL, path: Optional[str] = None):
+        self.ttl = ttl
+        self.path = path
+        self.memory = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+
+        if self.path:
+            with self._connect() as conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS answer_cache "
+                    "(cache_key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+                )
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=5)
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        """Clave estable para un conjunto de componentes serializables"""
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict]:
+        """Respuesta vigente para la clave, o None"""
+        value = self.memory.get(key)
+        if value is not MISSING:
+            return value
+
+        if not self.path:
+            return None
+
+        try:
+            with self._lock, self._connect() as conn:
+                row = conn.execute(
+                    "SELECT value, expires_at FROM answer_cache WHERE cache_key = ? AND expires_at > ?",
+                    (key, time.time())
+                ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"Cache de respuestas no disponible: {str(e)}")
+            return None
+
+        if row is None:
+            return None
+
+        value = json.loads(row[0])
+        self.memory.set(key, value, ttl=row[1] - time.time())
+        return value
+
+    def set(self, key: str, value: Dict):
+        """Guarda una respuesta en memoria y, si está configurado, en el archivo SQLite"""
+        self.memory.set(key, value)
+
+        if not self.path:
+            return
+
+        try:
+            with self._lock, self._connect() as conn:
+                now = time.time()
+                conn.execute("DELETE FROM answer_cache WHERE expires_at <= ?", (now,))
+                conn.execute(
+                    "INSERT OR REPLACE INTO answer_cache (cache_key, value, expires_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(value, default=str), now + self.ttl)
+                )
+        except sqlite3.Error as e:
+            logger.warning(f"No se pudo persistir la respuesta cacheada: {str(e)}")
+
+    def clear(self):
+        """Vacía el cache en memoria y el archivo de respaldo"""
+        self.memory.clear()
+        if self.path:
+            with self._lock, self._connect() as conn:
+                conn.execute("DELETE FROM answer_cache")
+
+    def stats(self) -> Dict:
+        """Estadísticas del cache en memoria"""
+        return {**self.memory.stats(), "persistent": bool(self.path)}
+
+
+_answer_cache = AnswerCache(path=ANSWER_CACHE_PATH)
+
+
 class GenerativeDataAssistant:
     """
     Asistente inteligente que responde consultas en lenguaje natural sobre los datos
     """
 
-    def __init__(self, user: Optional[Dict] = None, llm_provider: str = "mock", api_key: Optional[str] = None):
+    def __init__(self, user: Optional[Dict] = None, llm_provider: Optional[str] = None, api_key: Optional[str] = None):
         self.db = get_db()
-        self.llm_provider = llm_provider
+        self.llm_provider = llm_provider or os.getenv('GDA_LLM_PROVIDER', 'mock')
         self.api_key = api_key
+        self.provider = get_llm_provider(self.llm_provider, api_key)
         self.mdh = MetricsDefinitionHub()
         self.user = user or get_current_user()
 
@@ -91,6 +353,19 @@ class GenerativeDataAssistant:
         Returns:
             Dict con respuesta estructurada
         """
+        result = None
+        for event in self.stream_query(user_query):
+            if event['event'] == 'done':
+                result = event['result']
+        return result
+
+    def stream_query(self, user_query: str) -> Iterator[Dict]:
+        """
+        Procesa una consulta entregando la respuesta a medida que se genera.
+
+        Emite eventos {'event': 'token', 'text': ...} con fragmentos de la respuesta y
+        termina con {'event': 'done', 'result': ...}, el mismo Dict que `process_query`.
+        """
         start_time = time.time()
 
         try:
@@ -103,19 +378,56 @@ class GenerativeDataAssistant:
             # Generar plan de respuesta
             response_plan = self._generate_response_plan(clean_query, query_type, entities)
 
+            # Respuesta cacheada para la misma consulta, rol y versión de los datos involucrados
+            cache_key = AnswerCache.make_key(
+                clean_query,
+                self.user.get('rol') if self.user else None,
+                self._seller_scope(),
+                self.llm_provider,
+                self._data_version(response_plan)
+            )
+            cached = _answer_cache.get(cache_key)
+            if cached is not None:
+                self._log_query(user_query, cached['response'], time.time() - start_time, cached['data_used'])
+                yield {'event': 'token', 'text': cached['response']}
+                yield {'event': 'done', 'result': {
+                    **cached,
+                    'query': user_query,
+                    'cached': True,
+                    'processing_time': round(time.time() - start_time, 2)
+                }}
+                return
+
             # Ejecutar consultas de datos según el plan
             data_results = self._execute_data_queries(response_plan)
 
             # Generar respuesta natural con LLM o lógica de reglas
-            if self.llm_provider == "mock":
-                response = self._generate_mock_response(clean_query, data_results)
+            draft = self._generate_mock_response(clean_query, data_results)
+            llm_error = None
+            if self.provider is None:
+                response = draft
+                yield {'event': 'token', 'text': response}
             else:
-                response = self._generate_llm_response(clean_query, data_results)
+                chunks = []
+                try:
+                    for token in llm_runtime.stream(self.provider, self._build_llm_prompt(clean_query, data_results, draft),
+                                                    system=self.system_context):
+                        chunks.append(token)
+                        yield {'event': 'token', 'text': token}
+                except Exception as e:
+                    llm_error = str(e)
+                    level = logging.WARNING if isinstance(e, LLMTimeoutError) else logging.ERROR
+                    logger.log(level, f"Error del proveedor LLM {self.llm_provider}: {llm_error}")
+                    # Sin tokens aún: responder con el borrador basado en reglas
+                    if not chunks:
+                        chunks.append(draft)
+                        yield {'event': 'token', 'text': draft}
+                response = "".join(chunks)
 
             # Registrar consulta y respuesta
             self._log_query(user_query, response, time.time() - start_time, data_results)
 
-            return {
+            result = {
                 'success': True,
                 'query': user_query,
                 'response': response,
@@ -123,14 +435,20 @@ class GenerativeDataAssistant:
                 'processing_time': round(time.time() - start_time, 2),
                 'confidence_score': self._calculate_confidence(clean_query, data_results)
             }
+            if llm_error:
+                result['llm_error'] = llm_error
+            elif 'error' not in data_results:
+                _answer_cache.set(cache_key, result)
+
+            yield {'event': 'done', 'result': {**result, 'cached': False}}
 
         except Exception as e:
             logger.error(f"Error procesando consulta '{user_query}': {str(e)}")
-            return {
+            yield {'event': 'done', 'result': {
                 'success': False,
                 'error': f"No pude procesar tu consulta: {str(e)}",
                 'query': user_query
-            }
+            }}
 
     def _clean_query(self, query: str) -> str:
         """Limpia y normaliza la consulta del usuario"""
@@ -148,57 +466,8 @@ class GenerativeDataAssistant:
         Returns:
             (tipo_consulta, entidades_mencionadas)
         """
-        entities = []
-
-        # Patrones para identificar tipos de consulta
-        patterns = {
-            'metricas_kpi': [
-                r'ventas', r'ingresos', r'revenue', r'facturación',
-                r'conversión', r'conversion', r'clv', r'valor.*vida',
-                r'churn', r'abandono', r'satisfacción', r'kpi'
-            ],
-            'clientes': [
-                r'cliente', r'prospecto', r'lead', r'usuario'
-            ],
-            'facturas': [
-                r'factur', r'pago', r'pagad', r'vencid', r'impagad',
-                r'cobranza', r'deuda', r'monto'
-            ],
-            'tendencias': [
-                r'tendencia', r'evolución', r'cambio', r'versus', r'comparad',
-                r'últim', r'pasad', r'mes', r'semana', r'año'
-            ],
-            'comparaciones': [
-                r'compar', r'vs', r'versus', r'mejor', r'peor',
-                r'más', r'menos', r'aumento', r'disminución'
-            ],
-            'anomalias': [
-                r'anomal', r'extrañ', r'rar', r'insólit', r'desviación',
-                r'problema', r'issue', r'alerta'
-            ]
-        }
-
-        # Clasificar consulta
-        query_type = 'general'
-        max_matches = 0
-
-        for tipo, patterns_list in patterns.items():
-            matches = sum(1 for pattern in patterns_list if re.search(pattern, query))
-            if matches > max_matches:
-                max_matches = matches
-                query_type = tipo
-
-        # Extraer entidades específicas (fechas, números, etc.)
-        date_pattern = r'\d{1,2}/\d{1,2}/\d{4}|enero|febrero|marzo|abril|mayo|junio|julio|agosto|septiembre|octubre|noviembre|diciembre|\d{4}'
-        number_pattern = r'\d+(?:\.\d+)?'
-
-        date_matches = re.findall(date_pattern, query, re.IGNORECASE)
-        number_matches = re.findall(number_pattern, query)
-
-        entities.extend(date_matches)
-        entities.extend(number_matches)
-
-        return query_type, entities
+        query_type, entities = classify_intent(query)
+        return query_type, list(entities)
 
     def _generate_response_plan(self, query: str, query_type: str, entities: List[str]) -> Dict:
         """Genera un plan estructurado para responder la consulta"""
@@ -206,6 +475,7 @@ class GenerativeDataAssistant:
         plan = {
             'query_type': query_type,
             'entities_found': entities,
+            'date_range': parse_date_range(entities),
             'data_queries': [],
             'insights_needed': [],
             'visualization_suggestions': []
@@ -223,6 +493,9 @@ class GenerativeDataAssistant:
             plan['data_queries'].extend([
                 {'type': 'count_entities', 'table': 'clientes', 'filters': {}}
             ])
+            if plan['date_range']:
+                plan['data_queries'].append({'type': 'count_entities', 'table': 'clientes',
+                                             'filters': {}, 'use_date_range': True})
             plan['insights_needed'].append('customer_distribution')
 
         elif query_type == 'facturas':
@@ -244,129 +517,281 @@ class GenerativeDataAssistant:
                 'periods': ['current_quarter', 'previous_quarter']
             })
 
+        # Las preguntas por rendimiento se responden con la tasa de conversión real
+        if 'rendimiento' in query and not any(q['type'] == 'metrics_calculation' for q in plan['data_queries']):
+            plan['data_queries'].append({'type': 'metrics_calculation', 'metrics': ['conversion_rate']})
+
         return plan
 
     def _execute_data_queries(self, response_plan: Dict) -> Dict:
-        """Ejecuta las consultas de datos según el plan definido"""
+        """
+        Ejecuta las consultas de datos según el plan definido. Con más de una consulta se
+        ejecutan concurrentemente en el loop compartido, cada una con su propia sesión.
+        """
+        queries = response_plan.get('data_queries', [])
+        date_range = response_plan.get('date_range')
 
-        results = {}
+        if len(queries) > 1:
+            # Resolver el alcance del rol antes de paralelizar (usa la sesión principal)
+            self._seller_scope()
+            return llm_runtime.run(self._execute_data_queries_async(queries, date_range))
 
+        results = {}
         try:
-            for query in response_plan.get('data_queries', []):
-
-                if query['type'] == 'metrics_calculation':
-                    # Calcular métricas usando MDH
-                    metrics_results = {}
-                    for metric_id in query.get('metrics', []):
-                        result = self.mdh.calculate_metric_value(metric_id)
-                        if result['success']:
-                            metrics_results[metric_id] = result['value']
-                        else:
-                            metrics_results[metric_id] = None
-                    results['metrics'] = metrics_results
-
-                elif query['type'] == 'count_entities':
-                    # Contar entidades con filtros
-                    table = query.get('table', 'clientes')
-                    filters = query.get('filters', {})
-                    if self.user and self.user.get('rol') == 'ventas':
-                        vendedor = self.db.query(Vendedor).filter(Vendedor.email == self.user['email']).first()
-                        if vendedor:
-                            vendedor_id = vendedor.id
-                            if table == 'clientes':
-                                filters['vendedor_id'] = vendedor_id
-                        else:
-                            logger.warning(f"No se encontró vendedor para el email: {self.user['email']}")
-                    count = self._count_entities(table, filters)
-                    results[f'{table}_count'] = count
-
-                elif query['type'] == 'financial_summary':
-                    # Resumen financiero básico
-                    financial_data = self._get_financial_summary()
-                    results['financial'] = financial_data
-
-                elif query['type'] == 'time_series':
-                    # Datos de series temporales
-                    time_data = self._get_time_series_data(query.get('period', 'last_30_days'))
-                    results['time_series'] = time_data
-
+            for query in queries:
+                results.update(self._execute_single_query(query, date_range, self.db))
         except Exception as e:
             logger.error(f"Error ejecutando consultas de datos: {str(e)}")
             results['error'] = str(e)
 
         return results
 
-    def _count_entities(self, table: str, filters: Dict) -> int:
-        """Cuenta entidades con filtros aplicados"""
+    async def _execute_data_queries_async(self, queries: List[Dict], date_range) -> Dict:
+        """Ejecuta las consultas del plan concurrentemente y combina sus resultados"""
+        partials = await asyncio.gather(
+            *[asyncio.to_thread(self._execute_isolated_query, query, date_range) for query in queries],
+            return_exceptions=True
+        )
+
+        results = {}
+        for partial_result in partials:
+            if isinstance(partial_result, Exception):
+                logger.error(f"Error ejecutando consultas de datos: {str(partial_result)}")
+                results['error'] = str(partial_result)
+            else:
+                results.update(partial_result)
+        return results
+
+    def _execute_isolated_query(self, query: Dict, date_range) -> Dict:
+        """Ejecuta una consulta del plan con una sesión dedicada (segura entre threads)"""
+        db = get_db()
         try:
-            # Esta implementación simplificada usaría SQLAlchemy
-            # Por ahora, devolvemos valores simulados realistas
-
-            base_counts = {
-                'clientes': 125,
-                'facturas': 890,
-                'vendedores': 8,
-                'actividades_venta': 450
-            }
+            return self._execute_single_query(query, date_range, db)
+        finally:
+            db.close()
+
+    def _execute_single_query(self, query: Dict, date_range, db) -> Dict:
+        """Ejecuta una consulta del plan y retorna sus resultados parciales"""
+        if query['type'] == 'metrics_calculation':
+            # Calcular métricas usando MDH sobre la sesión de este thread
+            batch = MetricsDefinitionHub(db=db).calculate_metrics(query.get('metrics', [])).get('results', {})
+            return {'metrics': {
+                metric_id: batch[metric_id]['value'] if batch.get(metric_id, {}).get('success') else None
+                for metric_id in query.get('metrics', [])
+            }}
+
+        if query['type'] == 'count_entities':
+            # Contar entidades con filtros
+            table = query.get('table', 'clientes')
+            filters = dict(query.get('filters', {}))
+            result_key = f'{table}_count'
+            if query.get('use_date_range'):
+                filters['date_range'] = date_range
+                result_key = f'{table}_count_in_range'
+            return {result_key: self._run_cached(
+                'count', partial(self._count_entities, db=db), table, filters
+            )}
+
+        if query['type'] == 'financial_summary':
+            # Resumen financiero
+            return {'financial': self._run_cached(
+                'financial', partial(self._get_financial_summary, db=db), date_range
+            )}
+
+        if query['type'] == 'time_series':
+            # Datos de series temporales
+            return {'time_series': self._run_cached(
+                'time_series', partial(self._get_time_series_data, db=db),
+                query.get('period', 'last_30_days'), date_range
+            )}
+
+        return {}
+
+    def _data_version(self, response_plan: Dict) -> Tuple:
+        """
+        Token de versión de las tablas que lee el plan (contador de escrituras memorizado unos
+        segundos, ver data_versions); cambia también con las modificaciones en sitio
+        """
+        tables = set()
+        for query in response_plan.get('data_queries', []):
+            if query['type'] == 'count_entities':
+                tables.add(query.get('table', 'clientes'))
+            else:
+                tables.update(PLAN_QUERY_TABLES.get(query['type'], []))
+
+        return table_versions(table for table in tables if table in QUERYABLE_TABLES)
+
+    def _seller_scope(self) -> Optional[int]:
+        """
+        Vendedor al que se restringen las consultas: el propio para el rol ventas
+        (-1 si no tiene vendedor asociado, para no exponer datos ajenos) y None para el resto
+        """
+        if not (self.user and self.user.get('rol') == 'ventas'):
+            return None
+
+        if not hasattr(self, '_seller_id'):
+            vendedor = self.db.query(Vendedor.id).filter(Vendedor.email == self.user['email']).first()
+            if not vendedor:
+                logger.warning(f"No se encontró vendedor para el email: {self.user['email']}")
+            self._seller_id = vendedor.id if vendedor else -1
+        return self._seller_id
+
+    def _run_cached(self, kind: str, loader, *args):
+        """Ejecuta una consulta de datos con cache por (tipo, parámetros, rol, vendedor, versión de datos)"""
+        tables = [args[0]] if kind == 'count' else ['facturas', 'clientes']
+        key = (
+            kind,
+            json.dumps(args, sort_keys=True, default=str),
+            self.user.get('rol') if self.user else None,
+            self._seller_scope(),
+            table_versions(table for table in tables if table in QUERYABLE_TABLES)
+        )
+        return _query_result_cache.get_or_set(key, lambda: loader(*args))
+
+    def _count_entities(self, table: str, filters: Dict, db=None) -> int:
+        """Cuenta entidades con filtros aplicados (igualdad por columna y rango de fechas)"""
+        try:
+            if table not in QUERYABLE_TABLES:
+                return 0
+
+            model, date_column, filterable = QUERYABLE_TABLES[table]
+            query = (db or self.db).query(func.count(model.id))
+
+            for column, value in filters.items():
+                if column in filterable:
+                    query = query.filter(getattr(model, column) == value)
+
+            date_range = filters.get('date_range')
+            if date_range and date_column is not None:
+                query = query.filter(date_column >= date_range[0], date_column < date_range[1])
+
+            seller_id = self._seller_scope()
+            if seller_id is not None:
+                if model is Cliente or model is ActividadVenta:
+                    query = query.filter(model.vendedor_id == seller_id)
+                elif model is Factura:
+                    query = query.join(Cliente, Factura.cliente_id == Cliente.id).filter(
+                        Cliente.vendedor_id == seller_id
+                    )
+                elif model is Vendedor:
+                    query = query.filter(Vendedor.id == seller_id)
 
-            return base_counts.get(table, 0)
+            return query.scalar() or 0
 
         except Exception as e:
             logger.error(f"Error contando entidades en {table}: {str(e)}")
             return 0
 
-    def _get_financial_summary(self) -> Dict:
-        """Obtiene resumen financiero básico"""
+    def _invoice_query(self, *columns, date_range: Optional[Tuple[date, date]] = None, db=None):
+        """Consulta base sobre facturas con el filtro de vendedor y de fechas aplicados"""
+        query = (db or self.db).query(*columns)
+
+        seller_id = self._seller_scope()
+        if seller_id is not None:
+            query = query.join(Cliente, Factura.cliente_id == Cliente.id).filter(
+                Cliente.vendedor_id == seller_id
+            )
+        if date_range:
+            query = query.filter(Factura.fecha_emision >= date_range[0], Factura.fecha_emision < date_range[1])
+
+        return query
+
+    def _get_financial_summary(self, date_range: Optional[Tuple[date, date]] = None, db=None) -> Dict:
+        """Obtiene el resumen financiero con un único agregado sobre facturas"""
         try:
-            # Simulación de datos reales
+            today = date.today()
+            is_paid = Factura.estado == EstadoFacturaEnum.pagada
+            is_overdue = (Factura.estado != EstadoFacturaEnum.pagada) & (Factura.fecha_vencimiento < today)
+
+            row = self._invoice_query(
+                func.count(Factura.id),
+                func.coalesce(func.sum(Factura.monto_pagado), 0.0),
+                func.coalesce(func.sum(case((is_paid, 1), else_=0)), 0),
+                func.coalesce(func.sum(case((is_overdue, 1), else_=0)), 0),
+                func.coalesce(func.sum(case((is_overdue, Factura.monto_total - func.coalesce(Factura.monto_pagado, 0.0)), else_=0.0)), 0.0),
+                func.avg(Factura.monto_total),
+                date_range=date_range,
+                db=db
+            ).one()
+
+            total_invoices, total_revenue, paid_invoices, overdue_invoices, overdue_amount, avg_invoice = row
+
             return {
-                'total_revenue': 12500000,  # CLP
-                'paid_invoices': 675,
-                'overdue_invoices': 15,
-                'payment_rate': 94.2,  # %
-                'avg_invoice_value': 185000
+                'total_invoices': total_invoices,
+                'total_revenue': round(total_revenue),  # CLP cobrados
+                'paid_invoices': paid_invoices,
+                'overdue_invoices': overdue_invoices,
+                'overdue_amount': round(overdue_amount),
+                'payment_rate': round(paid_invoices / total_invoices * 100, 1) if total_invoices else 0.0,  # %
+                'avg_invoice_value': round(avg_invoice or 0)
             }
         except Exception as e:
+            logger.error(f"Error obteniendo resumen financiero: {str(e)}")
             return {}
 
-    def _get_time_series_data(self, period: str) -> List[Dict]:
-        """Obtiene datos de series temporales"""
+    def _get_time_series_data(self, period: str, date_range: Optional[Tuple[date, date]] = None, db=None) -> List[Dict]:
+        """Obtiene la facturación mensual del período (o del rango de fechas de la consulta)"""
         try:
-            # Simulación de datos históricos mensuales
-            import random
-            base_value = 1000000  # CLP base mensual
+            if not date_range:
+                end = date.today() + timedelta(days=1)
+                date_range = (end - timedelta(days=PERIOD_DAYS.get(period, 180)), end)
+
+            year = extract('year', Factura.fecha_emision)
+            month = extract('month', Factura.fecha_emision)
+
+            rows = self._invoice_query(
+                year, month, func.sum(Factura.monto_total), date_range=date_range, db=db
+            ).group_by(year, month).order_by(year, month).all()
 
             data = []
-            for i in range(6):  # Últimos 6 meses
-                variation = random.uniform(-0.2, 0.3)  # -20% a +30%
-                value = base_value * (1 + variation)
+            previous = None
+            for row_year, row_month, revenue in rows:
                 data.append({
-                    'month': f'2025-{str(i+1).zfill(2)}',
-                    'revenue': round(value),
-                    'growth_rate': round(variation * 100, 1)
+                    'month': f'{int(row_year)}-{int(row_month):02d}',
+                    'revenue': round(revenue or 0),
+                    'growth_rate': round((revenue - previous) / previous * 100, 1) if previous else 0.0
                 })
+                previous = revenue
 
             return data
         except Exception as e:
+            logger.error(f"Error obteniendo serie temporal: {str(e)}")
             return []
 
     def _generate_mock_response(self, query: str, data_results: Dict) -> str:
         """Genera respuesta usando lógica de reglas (fallback sin LLM)"""
 
+        revenue = data_results.get('metrics', {}).get('revenue_total')
+        revenue_text = f"${revenue:,.0f}" if isinstance(revenue, (int, float)) else "N/A"
+        conversion = data_results.get('metrics', {}).get('conversion_rate')
+        financial = data_results.get('financial', {})
+        clients_text = f"{data_results.get('clientes_count', 0)} clientes"
+        if 'clientes_count_in_range' in data_results:
+            clients_text += f" ({data_results['clientes_count_in_range']} ingresados en el período consultado)"
+
         # Respuestas basadas en palabras clave detectadas
         responses = {
-            'ventas': f"Los ingresos totales del período son de ${data_results.get('metrics', {}).get('revenue_total', 'N/A'):,} CLP.",
-            'clientes': f"Actualmente tienes {data_results.get('clientes_count', 125)} clientes activos en tu cartera.",
-            'facturas': f"De las {data_results.get('facturas_count', 890)} facturas, el {data_results.get('financial', {}).get('payment_rate', 94.2)}% están pagadas.",
-            'rendimiento': "El rendimiento general está dentro de parámetros normales con una tasa de conversión del 68.5%.",
+            'ventas': f"Los ingresos totales del período son de {revenue_text} CLP.",
+            'clientes': f"Actualmente tienes {clients_text} activos en tu cartera.",
+            'facturas': f"De las {financial.get('total_invoices', 0)} facturas, el {financial.get('payment_rate', 0.0)}% están pagadas"
+                        f" y {financial.get('overdue_invoices', 0)} están vencidas (${financial.get('overdue_amount', 0):,.0f} CLP por cobrar).",
+            'rendimiento': f"La tasa de conversión actual es del {conversion:.1f}%." if isinstance(conversion, (int, float))
+                           else "No hay datos suficientes para calcular la tasa de conversión.",
             'problemas': "No se detectan problemas críticos en las métricas monitoreadas actualmente."
         }
 
+        time_series = data_results.get('time_series')
+        if time_series:
+            responses['tendencia'] = (
+                f"La facturación pasó de ${time_series[0]['revenue']:,.0f} ({time_series[0]['month']}) "
+                f"a ${time_series[-1]['revenue']:,.0f} ({time_series[-1]['month']}) CLP."
+            )
+
         # Personalizar respuesta por rol
         if self.user and self.user.get('rol') == 'ventas':
-            responses['clientes'] = f"Actualmente tienes {data_results.get('clientes_count', '0')} clientes asignados."
+            responses['clientes'] = f"Actualmente tienes {clients_text} asignados."
         elif self.user and self.user.get('rol') == 'finanzas':
-            responses['ventas'] = f"El total de ingresos registrados es de ${data_results.get('metrics', {}).get('revenue_total', 'N/A'):,} CLP."
+            responses['ventas'] = f"El total de ingresos registrados es de {revenue_text} CLP."
 
         # Buscar respuesta más relevante
         for keyword, response in responses.items():
@@ -374,13 +799,24 @@ class GenerativeDataAssistant:
                 return response
 
         # Respuesta genérica
-        return "Tu consulta ha sido procesada. Los indicadores generales muestran un rendimiento saludable con oportunidades de mejora en el proceso de conversión."
+        return "Tu consulta ha sido procesada. Pregunta por ventas, clientes, facturas o tendencias para ver los indicadores."
+
+    def _build_llm_prompt(self, query: str, data_results: Dict, draft: str) -> str:
+        """Prompt con la pregunta, los datos consultados y el borrador basado en reglas"""
+        return (
+            f"Pregunta del usuario: {query}\n\n"
+            f"Datos disponibles (JSON):\n{json.dumps(data_results, ensure_ascii=False, default=str)}\n\n"
+            "Responde usando solo estos datos. Puedes mejorar la redacción del borrador.\n\n"
+            f"{DRAFT_MARKER}\n{draft}"
+        )
 
     def _generate_llm_response(self, query: str, data_results: Dict) -> str:
-        """Genera respuesta usando LLM (cuando esté configurado)"""
-        # Esta implementación requeriría integración con OpenAI/Claude
-        # Por ahora, delegamos a la respuesta mock
-        return self._generate_mock_response(query, data_results)
+        """Genera respuesta usando el proveedor LLM configurado (reglas si no hay proveedor)"""
+        draft = self._generate_mock_response(query, data_results)
+        if self.provider is None:
+            return draft
+        return "".join(llm_runtime.stream(self.provider, self._build_llm_prompt(query, data_results, draft),
+                                          system=self.system_context))
 
     def _calculate_confidence(self, query: str, data_results: Dict) -> float:
         """Calcula la confianza en la respuesta proporcionada"""
@@ -442,6 +878,7 @@ class GenerativeDataAssistant:
         self.llm_provider = provider
         self.api_key = api_key
         self.llm_model = model
+        self.provider = get_llm_provider(provider, api_key, model)
 
     def close(self):
         """Cierra conexiones"""
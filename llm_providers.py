@@ -0,0 +1,244 @@
+"""
+Proveedores LLM - Agente 7 (GDA)
+Interfaz asíncrona con streaming de tokens, timeouts y límite de concurrencia compartido
+por todas las sesiones del proceso
+"""
+
+import asyncio
+import json
+import os
+import queue
+import re
+import threading
+from concurrent.futures import Future
+from typing import AsyncIterator, Iterator, Optional
+
+import requests
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Llamadas LLM simultáneas permitidas en el proceso
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', '4'))
+# Tiempo máximo hasta el primer token y para la respuesta completa
+LLM_FIRST_TOKEN_TIMEOUT = float(os.getenv('LLM_FIRST_TOKEN_TIMEOUT_SECONDS', '10'))
+LLM_TIMEOUT = float(os.getenv('LLM_TIMEOUT_SECONDS', '60'))
+
+# Marca que antecede al borrador basado en reglas dentro del prompt
+DRAFT_MARKER = "Borrador basado en reglas:"
+
+_STREAM_END = object()
+
+
+class LLMTimeoutError(Exception):
+    """El proveedor no respondió dentro del tiempo permitido"""
+
+
+class LLMProvider:
+    """
+    Interfaz de proveedor: `stream` entrega la respuesta como tokens a medida que llegan
+    """
+
+    name = "base"
+
+    async def stream(self, prompt: str, system: Optional[str] = None) -> AsyncIterator[str]:
+        raise NotImplementedError
+        yield  # pragma: no cover
+
+    async def complete(self, prompt: str, system: Optional[str] = None) -> str:
+        """Respuesta completa (concatena el stream)"""
+        return "".join([token async for token in self.stream(prompt, system)])
+
+
+class FakeLLMProvider(LLMProvider):
+    """
+    Proveedor local y determinista para pruebas: transmite palabra por palabra el borrador
+    incluido en el prompt, con demoras configurables para simular latencia
+    """
+
+    name = "fake"
+
+    def __init__(self, token_delay: float = 0.0, first_token_delay: float = 0.0):
+        self.token_delay = token_delay
+        self.first_token_delay = first_token_delay
+
+    async def stream(self, prompt: str, system: Optional[str] = None) -> AsyncIterator[str]:
+        if DRAFT_MARKER in prompt:
+            text = prompt.split(DRAFT_MARKER, 1)[1].strip()
+        else:
+            text = f"Respuesta de prueba para: {prompt.strip()}"
+
+        if self.first_token_delay:
+            await asyncio.sleep(self.first_token_delay)
+
+        for token in re.findall(r'\S+\s*', text):
+            if self.token_delay:
+                await asyncio.sleep(self.token_delay)
+            yield token
+
+
+class OpenAICompatibleProvider(LLMProvider):
+    """
+    Proveedor para APIs de chat compatibles con OpenAI (stream SSE). La petición HTTP corre en
+    un thread y los tokens se entregan al event loop a medida que llegan.
+    """
+
+    name = "openai"
+
+    def __init__(self, api_key: str, model: Optional[str] = None, base_url: Optional[str] = None):
+        self.api_key = api_key
+        self.model = model or os.getenv('LLM_MODEL', 'gpt-4o-mini')
+        self.base_url = (base_url or os.getenv('LLM_BASE_URL', 'https://api.openai.com/v1')).rstrip('/')
+
+    async def stream(self, prompt: str, system: Optional[str] = None) -> AsyncIterator[str]:
+        loop = asyncio.get_running_loop()
+        tokens: asyncio.Queue = asyncio.Queue()
+        cancelled = threading.Event()
+
+        def reader():
+            try:
+                messages = ([{"role": "system", "content": system}] if system else []) + \
+                           [{"role": "user", "content": prompt}]
+                with requests.post(
+                    f"{self.base_url}/chat/completions",
+                    headers={"Authorization": f"Bearer {self.api_key}"},
+                    json={"model": self.model, "messages": messages, "stream": True},
+                    stream=True,
+                    timeout=(5, LLM_TIMEOUT)
+                ) as response:
+                    response.raise_for_status()
+                    for line in response.iter_lines(decode_unicode=True):
+                        if cancelled.is_set():
+                            break
+                        if not line or not line.startswith("data:"):
+                            continue
+                        payload = line[len("data:"):].strip()
+                        if payload == "[DONE]":
+                            break
+                        delta = json.loads(payload)["choices"][0].get("delta", {}).get("content")
+                        if delta:
+                            loop.call_soon_threadsafe(tokens.put_nowait, delta)
+                loop.call_soon_threadsafe(tokens.put_nowait, _STREAM_END)
+            except Exception as e:
+                loop.call_soon_threadsafe(tokens.put_nowait, e)
+
+        reader_task = loop.run_in_executor(None, reader)
+        try:
+            while True:
+                item = await tokens.get()
+                if item is _STREAM_END:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            cancelled.set()
+            reader_task.cancel()
+
+
+def get_llm_provider(name: str, api_key: Optional[str] = None, model: Optional[str] = None) -> Optional[LLMProvider]:
+    """
+    Proveedor según configuración: 'mock' (None, respuestas por reglas sin LLM), 'fake'
+    (determinista local) u 'openai' (API compatible con OpenAI)
+    """
+    if name in (None, "", "mock"):
+        return None
+    if name == "fake":
+        return FakeLLMProvider()
+    if name == "openai":
+        return OpenAICompatibleProvider(api_key or os.getenv('LLM_API_KEY', ''), model=model)
+    raise ValueError(f"Proveedor LLM no soportado: {name}")
+
+
+class LLMRuntime:
+    """
+    Event loop compartido en un thread de fondo. Las sesiones (threads de Streamlit)
+    envían corrutinas y consumen tokens sin bloquearse entre sí; el semáforo del loop limita
+    las llamadas LLM concurrentes de todo el proceso.
+    """
+
+    def __init__(self, max_concurrency: int = LLM_MAX_CONCURRENCY):
+        self.max_concurrency = max_concurrency
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._lock = threading.Lock()
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                ready = threading.Event()
+
+                def run():
+                    asyncio.set_event_loop(loop)
+                    self._semaphore = asyncio.Semaphore(self.max_concurrency)
+                    ready.set()
+                    loop.run_forever()
+
+                threading.Thread(target=run, name="llm-runtime", daemon=True).start()
+                ready.wait()
+                self._loop = loop
+            return self._loop
+
+    def submit(self, coro) -> Future:
+        """Programa una corrutina en el loop compartido"""
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+
+    def run(self, coro, timeout: Optional[float] = None):
+        """Ejecuta una corrutina en el loop compartido y espera su resultado"""
+        return self.submit(coro).result(timeout)
+
+    async def _pump(self, provider: LLMProvider, prompt: str, system: Optional[str], sink: queue.Queue,
+                    first_token_timeout: float, timeout: float):
+        """Transmite los tokens del proveedor a `sink` respetando concurrencia y timeouts"""
+        try:
+            async with self._semaphore:
+                loop = asyncio.get_running_loop()
+                deadline = loop.time() + timeout
+                tokens = provider.stream(prompt, system)
+                first = True
+                try:
+                    while True:
+                        remaining = deadline - loop.time()
+                        wait = min(first_token_timeout, remaining) if first else remaining
+                        if wait <= 0:
+                            raise LLMTimeoutError("Tiempo de respuesta del LLM agotado")
+                        try:
+                            token = await asyncio.wait_for(tokens.__anext__(), timeout=wait)
+                        except StopAsyncIteration:
+                            break
+                        except asyncio.TimeoutError:
+                            stage = "primer token" if first else "respuesta"
+                            raise LLMTimeoutError(f"Tiempo de espera del LLM agotado ({stage})")
+                        first = False
+                        sink.put(token)
+                finally:
+                    await tokens.aclose()
+        except Exception as e:
+            sink.put(e)
+        finally:
+            sink.put(_STREAM_END)
+
+    def stream(self, provider: LLMProvider, prompt: str, system: Optional[str] = None,
+               first_token_timeout: float = LLM_FIRST_TOKEN_TIMEOUT, timeout: float = LLM_TIMEOUT) -> Iterator[str]:
+        """
+        Iterador síncrono de tokens para código que no corre en un event loop (p.ej. Streamlit).
+        Lanza LLMTimeoutError o el error del proveedor cuando ocurren.
+        """
+        sink: queue.Queue = queue.Queue()
+        future = self.submit(self._pump(provider, prompt, system, sink, first_token_timeout, timeout))
+        try:
+            while True:
+                item = sink.get()
+                if item is _STREAM_END:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # Si el consumidor abandona el stream, liberar la llamada
+            if not future.done():
+                future.cancel()
+
+
+llm_runtime = LLMRuntime()
@@ -0,0 +1,472 @@
+"""
+Metric DSL - Agente 6 (MDH)
+Compilador del pseudo-SQL de las fórmulas de métricas a agregados parametrizados de SQLAlchemy
+
+Gramática soportada:
+    expr       := term (('+' | '-') term)*
+    term       := factor (('*' | '/') factor)*
+    factor     := NUMERO | '-' factor | '(' expr ')' | agregado | metrica
+    agregado   := FUNC '(' fuente ')' [WHERE condicion]
+    fuente     := tabla '.' columna [WHERE condicion] | tabla [WHERE condicion] | metrica
+    condicion  := comparaciones unidas con AND / OR / NOT y paréntesis; operadores
+                  = != <> < <= > >=, [NOT] IN (...), IS [NOT] NULL
+    valor      := "texto" | NUMERO | TRUE | FALSE | NULL | NOW() | DATE_SUB(NOW(), dias)
+
+FUNC es SUM, AVG, COUNT, MIN o MAX. Un identificador que no es tabla se interpreta como
+referencia a otra métrica (su valor ya calculado).
+"""
+
+import re
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import Enum as SAEnum, and_, bindparam, case, func, not_, or_, select
+
+from models import ActividadVenta, Cliente, Cobranza, Factura, MovimientoCaja, Vendedor
+
+# Tablas consultables desde las fórmulas
+METRIC_TABLES = {
+    'facturas': Factura,
+    'clientes': Cliente,
+    'vendedores': Vendedor,
+    'actividades_venta': ActividadVenta,
+    'cobranzas': Cobranza,
+    'movimientos_caja': MovimientoCaja
+}
+
+# Columna de fecha a la que se aplican los filtros date_from / date_to
+TABLE_DATE_COLUMNS = {
+    'facturas': 'fecha_emision',
+    'clientes': 'fecha_ingreso',
+    'actividades_venta': 'fecha',
+    'cobranzas': 'fecha_pago',
+    'movimientos_caja': 'fecha'
+}
+
+AGGREGATE_FUNCTIONS = {'SUM', 'AVG', 'COUNT', 'MIN', 'MAX'}
+
+_TOKEN_RE = re.compile(r'''
+    \s*(?:
+        (?P<string>"[^"]*"|'[^']*')
+      | (?P<number>\d+(?:\.\d+)?)
+      | (?P<op><=|>=|!=|<>|[=<>()+\-*/,.])
+      | (?P<ident>[^\W\d]\w*)
+    )''', re.VERBOSE | re.UNICODE)
+
+
+class MetricCompileError(ValueError):
+    """La fórmula no es válida o referencia tablas/columnas inexistentes"""
+
+
+def _tokenize(formula: str) -> List[Tuple[str, str]]:
+    tokens, position = [], 0
+    formula = formula.strip()
+    while position < len(formula):
+        match = _TOKEN_RE.match(formula, position)
+        if not match or match.end() == position:
+            raise MetricCompileError(f"Símbolo inesperado en posición {position}: {formula[position:position + 10]!r}")
+        kind = match.lastgroup
+        tokens.append((kind, match.group(kind)))
+        position = match.end()
+        while position < len(formula) and formula[position].isspace():
+            position += 1
+    return tokens
+
+
+class Aggregate:
+    """Agregado sobre una tabla, expresable como columna condicional para fusionarlo con otros"""
+
+    def __init__(self, function: str, table: str, column, condition, signature: str):
+        self.function = function
+        self.table = table
+        self.column = column
+        self.condition = condition
+        # Identifica agregados equivalentes entre fórmulas
+        self.signature = signature
+
+    def sql_expression(self):
+        """Expresión SELECT del agregado; la condición se aplica con CASE (equivale al WHERE)"""
+        if self.column is None:
+            # COUNT(tabla): filas que cumplen la condición
+            return func.count(case((self.condition, 1))) if self.condition is not None else func.count()
+
+        target = self.column
+        if self.condition is not None:
+            target = case((self.condition, target))
+
+        return getattr(func, self.function.lower())(target)
+
+
+class CompiledFormula:
+    """Plan compilado de una fórmula: árbol de evaluación y agregados que requiere"""
+
+    def __init__(self, formula: str, tree, aggregates: Dict[str, Aggregate], references: List[str]):
+        self.formula = formula
+        self.tree = tree
+        self.aggregates = aggregates
+        self.references = references
+
+    @property
+    def tables(self) -> List[str]:
+        return sorted({aggregate.table for aggregate in self.aggregates.values()})
+
+    def evaluate(self, aggregate_values: Dict[str, Optional[float]],
+                 metric_values: Optional[Dict[str, Optional[float]]] = None) -> Optional[float]:
+        """Evalúa la fórmula con los valores de sus agregados y de las métricas referenciadas"""
+        return self._evaluate(self.tree, aggregate_values, metric_values or {})
+
+    def _evaluate(self, node, aggregate_values, metric_values):
+        kind = node[0]
+        if kind == 'number':
+            return node[1]
+        if kind == 'aggregate':
+            value = aggregate_values.get(node[1])
+            return float(value) if value is not None else None
+        if kind == 'metric':
+            value = metric_values.get(node[1])
+            return float(value) if value is not None else None
+        if kind == 'neg':
+            value = self._evaluate(node[1], aggregate_values, metric_values)
+            return -value if value is not None else None
+
+        left = self._evaluate(node[2], aggregate_values, metric_values)
+        right = self._evaluate(node[3], aggregate_values, metric_values)
+        if left is None or right is None:
+            return None
+        if node[1] == '+':
+            return left + right
+        if node[1] == '-':
+            return left - right
+        if node[1] == '*':
+            return left * right
+        return left / right if right else None
+
+
+class _Parser:
+    """Parser descendente recursivo de una fórmula"""
+
+    def __init__(self, formula: str):
+        self.formula = formula
+        self.tokens = _tokenize(formula)
+        self.position = 0
+        self.aggregates: Dict[str, Aggregate] = {}
+        self.references: List[str] = []
+
+    # Utilidades de tokens
+    def _peek(self, offset: int = 0) -> Tuple[Optional[str], Optional[str]]:
+        index = self.position + offset
+        return self.tokens[index] if index < len(self.tokens) else (None, None)
+
+    def _next(self) -> Tuple[str, str]:
+        token = self._peek()
+        if token[0] is None:
+            raise MetricCompileError("Fin inesperado de la fórmula")
+        self.position += 1
+        return token
+
+    def _is_keyword(self, word: str, offset: int = 0) -> bool:
+        kind, value = self._peek(offset)
+        return kind == 'ident' and value.upper() == word
+
+    def _is_op(self, op: str) -> bool:
+        return self._peek() == ('op', op)
+
+    def _expect_op(self, op: str):
+        token = self._next()
+        if token != ('op', op):
+            raise MetricCompileError(f"Se esperaba '{op}' y se encontró {token[1]!r}")
+
+    def _expect_keyword(self, word: str):
+        if not self._is_keyword(word):
+            raise MetricCompileError(f"Se esperaba {word} y se encontró {self._peek()[1]!r}")
+        self.position += 1
+
+    def parse(self) -> CompiledFormula:
+        tree = self._expr()
+        if self.position != len(self.tokens):
+            raise MetricCompileError(f"Símbolo inesperado: {self._peek()[1]!r}")
+        return CompiledFormula(self.formula, tree, self.aggregates, self.references)
+
+    # Expresiones aritméticas
+    def _expr(self):
+        node = self._term()
+        while self._is_op('+') or self._is_op('-'):
+            op = self._next()[1]
+            node = ('binop', op, node, self._term())
+        return node
+
+    def _term(self):
+        node = self._factor()
+        while self._is_op('*') or self._is_op('/'):
+            op = self._next()[1]
+            node = ('binop', op, node, self._factor())
+        return node
+
+    def _factor(self):
+        kind, value = self._peek()
+        if kind == 'number':
+            self.position += 1
+            return ('number', float(value))
+        if self._is_op('-'):
+            self.position += 1
+            return ('neg', self._factor())
+        if self._is_op('('):
+            self.position += 1
+            node = self._expr()
+            self._expect_op(')')
+            return node
+        if kind == 'ident' and value.upper() in AGGREGATE_FUNCTIONS and self._peek(1) == ('op', '('):
+            return self._aggregate()
+        if kind == 'ident':
+            self.position += 1
+            return self._metric_reference(value)
+        raise MetricCompileError(f"Expresión inválida cerca de {value!r}")
+
+    def _metric_reference(self, metric_id: str):
+        if metric_id not in self.references:
+            self.references.append(metric_id)
+        return ('metric', metric_id)
+
+    # Agregados
+    def _aggregate(self):
+        function = self._next()[1].upper()
+        self._expect_op('(')
+
+        source = self._next()
+        if source[0] != 'ident':
+            raise MetricCompileError(f"Fuente inválida en {function}: {source[1]!r}")
+        name = source[1]
+
+        if name not in METRIC_TABLES:
+            if self._is_op('.') or self._is_keyword('WHERE'):
+                raise MetricCompileError(f"Tabla inexistente: {name}")
+            # FUNC(metrica): valor de otra métrica
+            self._expect_op(')')
+            return self._metric_reference(name)
+
+        table, model, column, column_name = name, METRIC_TABLES[name], None, None
+        if self._is_op('.'):
+            self.position += 1
+            column_name = self._next()[1]
+            column = self._column(table, column_name)
+        elif function != 'COUNT':
+            raise MetricCompileError(f"{function} requiere una columna: {table}.<columna>")
+
+        conditions, condition_texts = [], []
+        if self._is_keyword('WHERE'):
+            start = self.position
+            self.position += 1
+            conditions.append(self._condition(table))
+            condition_texts.append(self._source(start))
+        self._expect_op(')')
+
+        # WHERE después del agregado: SUM(tabla.col) WHERE ...
+        if self._is_keyword('WHERE'):
+            start = self.position
+            self.position += 1
+            conditions.append(self._condition(table))
+            condition_texts.append(self._source(start))
+
+        condition = and_(*conditions) if len(conditions) > 1 else (conditions[0] if conditions else None)
+        signature = f"{function}({table}.{column_name or '*'}) {' '.join(condition_texts)}".strip()
+
+        if signature not in self.aggregates:
+            self.aggregates[signature] = Aggregate(function, table, column, condition, signature)
+        return ('aggregate', signature)
+
+    def _source(self, start: int) -> str:
+        return ' '.join(value for _, value in self.tokens[start:self.position])
+
+    def _column(self, table: str, column_name: str):
+        model = METRIC_TABLES[table]
+        column = getattr(model, column_name, None)
+        if column is None or not hasattr(column, 'property') or not hasattr(column.property, 'columns'):
+            raise MetricCompileError(f"Columna inexistente: {table}.{column_name}")
+        return column
+
+    # Condiciones
+    def _condition(self, table: str):
+        node = self._and_condition(table)
+        while self._is_keyword('OR'):
+            self.position += 1
+            node = or_(node, self._and_condition(table))
+        return node
+
+    def _and_condition(self, table: str):
+        node = self._not_condition(table)
+        while self._is_keyword('AND'):
+            self.position += 1
+            node = and_(node, self._not_condition(table))
+        return node
+
+    def _not_condition(self, table: str):
+        if self._is_keyword('NOT'):
+            self.position += 1
+            return not_(self._not_condition(table))
+        if self._is_op('('):
+            self.position += 1
+            node = self._condition(table)
+            self._expect_op(')')
+            return node
+        return self._comparison(table)
+
+    def _comparison(self, table: str):
+        kind, column_name = self._next()
+        if kind != 'ident':
+            raise MetricCompileError(f"Se esperaba una columna y se encontró {column_name!r}")
+        if '.' == self._peek()[1] and column_name == table:
+            self.position += 1
+            column_name = self._next()[1]
+        column = self._column(table, column_name)
+
+        if self._is_keyword('IS'):
+            self.position += 1
+            negate = self._is_keyword('NOT')
+            if negate:
+                self.position += 1
+            self._expect_keyword('NULL')
+            return column.isnot(None) if negate else column.is_(None)
+
+        negate = self._is_keyword('NOT')
+        if negate:
+            self.position += 1
+        if self._is_keyword('IN'):
+            self.position += 1
+            self._expect_op('(')
+            values = [self._value(column)]
+            while self._is_op(','):
+                self.position += 1
+                values.append(self._value(column))
+            self._expect_op(')')
+            return column.notin_(values) if negate else column.in_(values)
+        if negate:
+            raise MetricCompileError("NOT solo puede preceder a IN")
+
+        kind, op = self._next()
+        if kind != 'op' or op not in ('=', '!=', '<>', '<', '<=', '>', '>='):
+            raise MetricCompileError(f"Operador de comparación inválido: {op!r}")
+        value = self._value(column)
+
+        if op == '=':
+            return column.is_(None) if value is None else column == value
+        if op in ('!=', '<>'):
+            return column.isnot(None) if value is None else column != value
+        return {'<': column < value, '<=': column <= value, '>': column > value, '>=': column >= value}[op]
+
+    def _value(self, column):
+        kind, value = self._next()
+        if kind == 'string':
+            return coerce_value(column, value[1:-1])
+        if kind == 'number':
+            number = float(value)
+            return coerce_value(column, int(number) if number.is_integer() else number)
+        if kind == 'op' and value == '-':
+            number = float(self._next()[1])
+            return -number
+        if kind == 'ident':
+            word = value.upper()
+            if word in ('TRUE', 'FALSE'):
+                return coerce_value(column, word == 'TRUE')
+            if word == 'NULL':
+                return None
+            if word == 'NOW':
+                self._expect_op('(')
+                self._expect_op(')')
+                return self._now_param(0)
+            if word == 'DATE_SUB':
+                self._expect_op('(')
+                self._expect_keyword('NOW')
+                self._expect_op('(')
+                self._expect_op(')')
+                self._expect_op(',')
+                days = float(self._next()[1])
+                self._expect_op(')')
+                return self._now_param(days)
+        raise MetricCompileError(f"Valor inválido: {value!r}")
+
+    @staticmethod
+    def _now_param(days: float):
+        # Se resuelve al ejecutar, no al compilar. El nombre lleva el valor exacto de días para
+        # que ventanas como 7 y 7.5 no compartan parámetro en un mismo SELECT fusionado
+        name = f"now_minus_{days!r}".replace('.', '_')
+        return bindparam(name, callable_=lambda: datetime.now() - timedelta(days=days))
+
+
+def coerce_value(column, value):
+    """
+    Convierte un literal de la fórmula o de un filtro al tipo de la columna: los Enum
+    aceptan el valor visible ("Pagada") o el nombre ("pagada"), y los booleanos se mapean a 1/0
+    """
+    column_type = column.property.columns[0].type
+    if isinstance(column_type, SAEnum) and column_type.enum_class is not None:
+        if isinstance(value, column_type.enum_class):
+            return value
+        for member in column_type.enum_class:
+            if str(value).lower() in (member.value.lower(), member.name.lower()):
+                return member
+        raise MetricCompileError(f"Valor {value!r} inválido para {column.key}")
+    if isinstance(value, bool):
+        return int(value)
+    return value
+
+
+def compile_formula(formula: str) -> CompiledFormula:
+    """Compila una fórmula del DSL; lanza MetricCompileError si no es válida"""
+    if not isinstance(formula, str) or not formula.strip():
+        raise MetricCompileError("Fórmula vacía")
+    return _Parser(formula).parse()
+
+
+def build_filter_clauses(table: str, filters: Optional[Dict]) -> List:
+    """
+    Condiciones a inyectar en las consultas de una tabla: date_from / date_to sobre su columna
+    de fecha, vendedor_id (en facturas vía el cliente) y columnas de la tabla por igualdad
+    (o IN si el valor es una lista). Las claves que no aplican a la tabla se ignoran.
+    """
+    if not filters:
+        return []
+
+    model = METRIC_TABLES[table]
+    clauses = []
+
+    date_column = getattr(model, TABLE_DATE_COLUMNS[table]) if table in TABLE_DATE_COLUMNS else None
+    if date_column is not None and filters.get('date_from'):
+        clauses.append(date_column >= filters['date_from'])
+    if date_column is not None and filters.get('date_to'):
+        clauses.append(date_column <= filters['date_to'])
+
+    for key, value in filters.items():
+        if key in ('date_from', 'date_to') or value is None:
+            continue
+        if key == 'vendedor_id' and table == 'facturas':
+            clauses.append(Factura.cliente_id.in_(select(Cliente.id).where(Cliente.vendedor_id == value)))
+            continue
+        column = getattr(model, key, None)
+        if column is None or not hasattr(column, 'property') or not hasattr(column.property, 'columns'):
+            continue
+        if isinstance(value, (list, tuple, set)):
+            clauses.append(column.in_([coerce_value(column, v) for v in value]))
+        else:
+            clauses.append(column == coerce_value(column, value))
+
+    return clauses
+
+
+def execute_aggregates(db, aggregates: List[Aggregate], filters: Optional[Dict] = None) -> Dict[str, Optional[float]]:
+    """
+    Ejecuta los agregados con un SELECT por tabla (todas sus expresiones juntas) y
+    retorna sus valores por firma
+    """
+    by_table: Dict[str, Dict[str, Aggregate]] = {}
+    for aggregate in aggregates:
+        by_table.setdefault(aggregate.table, {})[aggregate.signature] = aggregate
+
+    values = {}
+    for table, table_aggregates in by_table.items():
+        signatures = list(table_aggregates)
+        row = db.query(
+            *[table_aggregates[signature].sql_expression().label(f"a{i}") for i, signature in enumerate(signatures)]
+        ).select_from(METRIC_TABLES[table]).filter(*build_filter_clauses(table, filters)).one()
+        values.update(zip(signatures, row))
+
+    return values
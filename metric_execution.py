@@ -0,0 +1,334 @@
+"""
+Metric Execution - Agente 5 (SSBF)
+Ejecución de métricas predefinidas: sentencias preparadas por métrica, cache de resultados
+por (métrica, parámetros, versión de datos) y cálculo en lote en paralelo sobre el pool
+de conexiones.
+
+Las fórmulas son portables entre motores: los períodos se expresan con parámetros de fecha
+calculados en Python (`f.fecha_emision >= :month_start`), que permiten usar los índices, y
+las pocas funciones que difieren por motor se escriben como `{funcion(args)}` y se traducen
+al dialecto de la conexión.
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from decimal import Decimal
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import Date, bindparam, text
+
+from cache import TTLCache, MISSING
+from data_versions import table_versions
+from database import SessionLocal, Base, engine
+from models import PredefinedMetric
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Vida de un resultado cacheado (la versión de datos de la clave lo invalida antes si hay escrituras)
+METRIC_RESULT_TTL = float(os.getenv('SSBF_METRIC_CACHE_TTL_SECONDS', '300'))
+# Consultas de métricas simultáneas en el cálculo en lote
+METRIC_WORKERS = int(os.getenv('SSBF_METRIC_WORKERS', '4'))
+
+# Definiciones por id y sentencias preparadas por (id, hash de la fórmula)
+_definitions = TTLCache(maxsize=1024, ttl=60)
+_ids_by_name = TTLCache(maxsize=1024, ttl=60)
+_statements: Dict[Tuple[int, str], object] = {}
+_statements_lock = threading.Lock()
+
+# Resultados por (id, parámetros, versión de datos)
+_results = TTLCache(maxsize=4096, ttl=METRIC_RESULT_TTL)
+
+_executor = ThreadPoolExecutor(max_workers=METRIC_WORKERS, thread_name_prefix="ssbf-metric")
+
+_TABLE_NAME_RE = re.compile(r'\b[a-z_][a-z0-9_]*\b')
+_BIND_PARAM_RE = re.compile(r'(?<![:\w]):(\w+)')
+_SQL_FUNCTION_RE = re.compile(r'\{(\w+)\(([^{}()]*)\)\}')
+
+# Funciones de fórmula cuya sintaxis depende del motor ({0}, {1}: argumentos)
+SQL_FUNCTIONS = {
+    'days_between': {
+        'sqlite': "(julianday({0}) - julianday({1}))",
+        'postgresql': "(CAST({0} AS DATE) - CAST({1} AS DATE))",
+        'mysql': "DATEDIFF({0}, {1})",
+        'mssql': "DATEDIFF(day, {1}, {0})",
+    },
+}
+
+
+def date_parameters(today: date = None) -> Dict:
+    """
+    Parámetros de período disponibles en todas las fórmulas, relativos a `today`
+    """
+    today = today or date.today()
+    month_start = today.replace(day=1)
+    next_month_start = (month_start + timedelta(days=32)).replace(day=1)
+    three_months_start = month_start
+    for _ in range(2):
+        three_months_start = (three_months_start - timedelta(days=1)).replace(day=1)
+
+    return {
+        'today': today,
+        'tomorrow': today + timedelta(days=1),
+        'month_start': month_start,
+        'next_month_start': next_month_start,
+        'three_months_start': three_months_start,
+        'days_90_ago': today - timedelta(days=90),
+        'days_in_month': (next_month_start - month_start).days,
+        'days_left_in_month': (next_month_start - today).days,
+    }
+
+
+DATE_PARAMETER_NAMES = {name for name, value in date_parameters().items() if isinstance(value, date)}
+
+
+def render_formula(formula: str, dialect_name: str) -> str:
+    """Traduce las funciones `{funcion(args)}` de la fórmula al dialecto indicado"""
+    def replace(match):
+        name, args = match.group(1), [arg.strip() for arg in match.group(2).split(',')]
+        variants = SQL_FUNCTIONS.get(name)
+        if variants is None:
+            raise ValueError(f"Función de fórmula desconocida: {name}")
+        if dialect_name not in variants:
+            raise ValueError(f"Función {name} no soportada para el motor {dialect_name}")
+        return variants[dialect_name].format(*args)
+
+    return _SQL_FUNCTION_RE.sub(replace, formula)
+
+
+def format_metric_value(value, data_type: str) -> str:
+    """Formatea el valor según el tipo de datos de la métrica"""
+    if data_type == 'currency' and isinstance(value, (int, float)):
+        return f"${value:,.0f}"
+    elif data_type == 'percentage' and isinstance(value, (int, float)):
+        return f"{value:.1f}%"
+    elif data_type == 'number' and isinstance(value, (int, float)):
+        return f"{value:,.0f}"
+    return str(value) if value is not None else "N/A"
+
+
+class MetricExecutionService:
+    """
+    Ejecuta las fórmulas SQL de `PredefinedMetric`. Cada llamada usa su propia sesión del
+    pool, por lo que el servicio puede compartirse entre threads.
+    """
+
+    def get_definition(self, metric_id: int) -> Optional[Dict]:
+        """Definición de la métrica (cacheada); None si no existe"""
+        definition = _definitions.get(metric_id)
+        if definition is MISSING:
+            db = SessionLocal()
+            try:
+                metric = db.query(PredefinedMetric).filter(PredefinedMetric.id == metric_id).first()
+                definition = self._metric_to_definition(metric) if metric else None
+            finally:
+                db.close()
+            _definitions.set(metric_id, definition)
+        return definition
+
+    def get_definitions(self, metric_ids: List[int]) -> Dict[int, Optional[Dict]]:
+        """Definiciones de varias métricas con una sola consulta para las no cacheadas"""
+        definitions, missing = {}, []
+        for metric_id in metric_ids:
+            definition = _definitions.get(metric_id)
+            if definition is MISSING:
+                missing.append(metric_id)
+            else:
+                definitions[metric_id] = definition
+
+        if missing:
+            db = SessionLocal()
+            try:
+                rows = db.query(PredefinedMetric).filter(PredefinedMetric.id.in_(missing)).all()
+            finally:
+                db.close()
+            found = {row.id: self._metric_to_definition(row) for row in rows}
+            for metric_id in missing:
+                definitions[metric_id] = found.get(metric_id)
+                _definitions.set(metric_id, definitions[metric_id])
+
+        return definitions
+
+    def execute(self, metric_id: int, params: Dict = None, use_cache: bool = True) -> Dict:
+        """
+        Valor crudo de una métrica: {'success', 'value', 'cached'} o {'success': False, 'error'}
+        """
+        definition = self.get_definition(metric_id)
+        if definition is None:
+            return {"success": False, "error": "Métrica no encontrada"}
+        return self._execute_definition(definition, params, use_cache)
+
+    def execute_many(self, metric_ids: List[int], params: Dict = None, use_cache: bool = True) -> Dict[int, Dict]:
+        """
+        Valores de varias métricas. Cada una se resuelve desde el cache o se ejecuta en
+        paralelo con las demás, con su propia conexión del pool.
+        """
+        metric_ids = list(dict.fromkeys(metric_ids))
+        definitions = self.get_definitions(metric_ids)
+
+        results, pending = {}, []
+        for metric_id in metric_ids:
+            definition = definitions.get(metric_id)
+            if definition is None:
+                results[metric_id] = {"success": False, "error": "Métrica no encontrada"}
+            else:
+                pending.append(definition)
+
+        if len(pending) == 1:
+            results[pending[0]['id']] = self._execute_definition(pending[0], params, use_cache)
+        elif pending:
+            futures = {
+                definition['id']: _executor.submit(self._execute_definition, definition, params, use_cache)
+                for definition in pending
+            }
+            for metric_id, future in futures.items():
+                results[metric_id] = future.result()
+
+        return {metric_id: results[metric_id] for metric_id in metric_ids}
+
+    def invalidate(self, metric_id: int = None):
+        """Descarta definiciones y resultados cacheados (de una métrica o de todas)"""
+        if metric_id is None:
+            _definitions.clear()
+            _ids_by_name.clear()
+            _results.clear()
+        else:
+            _definitions.invalidate(metric_id)
+            _results.invalidate_where(lambda key: key[0] == metric_id)
+
+    def data_version(self, tables: List[str]) -> Tuple:
+        """
+        Token de versión de las tablas leídas por una fórmula (ver data_versions), más la fecha
+        del día para las fórmulas relativas a la fecha actual
+        """
+        return (date.today().isoformat(), *table_versions(tables))
+
+    def resolve_names(self, names: List[str]) -> Dict[str, int]:
+        """Ids de las métricas activas con los nombres indicados (las inexistentes se omiten)"""
+        resolved, missing = {}, []
+        for name in dict.fromkeys(names):
+            metric_id = _ids_by_name.get(name)
+            if metric_id is MISSING:
+                missing.append(name)
+            elif metric_id is not None:
+                resolved[name] = metric_id
+
+        if missing:
+            db = SessionLocal()
+            try:
+                rows = db.query(PredefinedMetric.name, PredefinedMetric.id).filter(
+                    PredefinedMetric.name.in_(missing),
+                    PredefinedMetric.is_active == 1
+                ).all()
+            finally:
+                db.close()
+            found = dict(rows)
+            for name in missing:
+                _ids_by_name.set(name, found.get(name))
+                if name in found:
+                    resolved[name] = found[name]
+
+        return resolved
+
+    def stats(self) -> Dict:
+        """Estadísticas de los caches del servicio"""
+        return {
+            "results": _results.stats(),
+            "definitions": _definitions.stats(),
+            "prepared_statements": len(_statements)
+        }
+
+    def _execute_definition(self, definition: Dict, params: Dict, use_cache: bool) -> Dict:
+        """Ejecuta (o lee del cache) una métrica ya resuelta"""
+        metric_id = definition['id']
+        try:
+            bound = self._bind_parameters(definition, params)
+            db = SessionLocal()
+            try:
+                cache_key = (
+                    metric_id,
+                    definition['formula_hash'],
+                    json.dumps(bound, sort_keys=True, default=str),
+                    self.data_version(definition['tables'])
+                )
+                if use_cache:
+                    cached = _results.get(cache_key)
+                    if cached is not MISSING:
+                        return {"success": True, "value": cached, "cached": True}
+
+                row = db.execute(self._prepared_statement(definition), bound).fetchone()
+            finally:
+                db.close()
+
+            value = row[0] if row is not None and len(row) > 0 else 0
+            if isinstance(value, Decimal):
+                value = float(value)
+            _results.set(cache_key, value)
+            return {"success": True, "value": value, "cached": False}
+
+        except Exception as e:
+            logger.error(f"Error calculando valor de métrica {metric_id}: {str(e)}")
+            return {"success": False, "error": str(e)}
+
+    def _prepared_statement(self, definition: Dict):
+        """Sentencia `text()` construida una vez por versión de la fórmula"""
+        key = (definition['id'], definition['formula_hash'])
+        statement = _statements.get(key)
+        if statement is None:
+            with _statements_lock:
+                statement = _statements.get(key)
+                if statement is None:
+                    statement = text(render_formula(definition['formula'], engine.dialect.name))
+                    date_params = [name for name in definition['param_names'] if name in DATE_PARAMETER_NAMES]
+                    if date_params:
+                        statement = statement.bindparams(*[bindparam(name, type_=Date) for name in date_params])
+                    # Las versiones anteriores de la fórmula ya no se usan
+                    for stale in [k for k in _statements if k[0] == key[0]]:
+                        del _statements[stale]
+                    _statements[key] = statement
+        return statement
+
+    @staticmethod
+    def _bind_parameters(definition: Dict, params: Dict = None) -> Dict:
+        """
+        Parámetros de la fórmula: períodos del día, valores por defecto de la definición y
+        los recibidos (en orden de prioridad creciente)
+        """
+        bound = {**date_parameters(), **definition['default_params'], **(params or {})}
+        missing = [name for name in definition['param_names'] if name not in bound]
+        if missing:
+            raise ValueError(f"Parámetros requeridos sin valor: {', '.join(missing)}")
+        return {name: bound[name] for name in definition['param_names']}
+
+    @staticmethod
+    def _metric_to_definition(metric: PredefinedMetric) -> Dict:
+        """Datos de la métrica necesarios para ejecutarla"""
+        formula = metric.formula or ""
+        try:
+            default_params = json.loads(metric.parameters) if metric.parameters else {}
+        except ValueError:
+            default_params = {}
+
+        known_tables = [name for name, table in Base.metadata.tables.items() if 'id' in table.c]
+        referenced = set(_TABLE_NAME_RE.findall(formula.lower()))
+
+        return {
+            'id': metric.id,
+            'name': metric.name,
+            'display_name': metric.display_name,
+            'formula': formula,
+            'formula_hash': hashlib.sha256(formula.encode('utf-8')).hexdigest()[:16],
+            'param_names': list(dict.fromkeys(_BIND_PARAM_RE.findall(formula))),
+            'default_params': default_params if isinstance(default_params, dict) else {},
+            'tables': sorted(name for name in known_tables if name in referenced),
+            'data_type': metric.data_type,
+            'unit': metric.unit
+        }
+
+
+metric_execution_service = MetricExecutionService()
@@ -4,66 +4,264 @@ Módulo para centralizar y versionar definiciones de métricas clave
 """
 
 import yaml
+import hashlib
 import json
 import os
+import threading
 import time
-import numpy as np
 from datetime import datetime
 from typing import Dict, List, Optional, Any
 from database import get_db
+from metric_dsl import CompiledFormula, MetricCompileError, compile_formula, execute_aggregates
 from models import PredefinedMetric
 
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Planes compilados por texto de fórmula (una compilación por fórmula y proceso)
+_compiled_formulas: Dict[str, CompiledFormula] = {}
+
+# Intervalo mínimo entre revisiones de cambios en el directorio de métricas
+METRICS_RELOAD_INTERVAL = float(os.getenv('METRICS_RELOAD_INTERVAL_SECONDS', '2'))
+
+# Registros por directorio, compartidos por todo el proceso
+_registries: Dict[str, 'MetricsRegistry'] = {}
+_registries_lock = threading.Lock()
+
+
+def get_compiled_formula(formula: str) -> CompiledFormula:
+    """Plan compilado de una fórmula, compilándola la primera vez"""
+    plan = _compiled_formulas.get(formula)
+    if plan is None:
+        plan = compile_formula(formula)
+        _compiled_formulas[formula] = plan
+    return plan
+
+
+class MetricContext:
+    """
+    Contexto de evaluación de un pedido (mismos filtros): memoriza los valores de métricas y
+    agregados ya calculados para que llamadas sucesivas no recalculen métricas base
+    """
+
+    def __init__(self, filters: Optional[Dict] = None):
+        self.filters = filters or {}
+        self.values: Dict[str, Optional[float]] = {}
+        self.errors: Dict[str, str] = {}
+        self.aggregate_values: Dict[str, Any] = {}
+        self.queries = 0
+
+
+class MetricsSnapshot:
+    """Estado inmutable de las definiciones cargadas: métricas, planes compilados y DAG"""
+
+    def __init__(self, loaded_metrics: Dict[str, Dict], compiled_plans: Dict[str, CompiledFormula],
+                 compile_errors: Dict[str, str], dependency_graph: Dict[str, List[str]],
+                 evaluation_order: Dict[str, int]):
+        self.loaded_metrics = loaded_metrics
+        self.compiled_plans = compiled_plans
+        self.compile_errors = compile_errors
+        self.dependency_graph = dependency_graph
+        self.evaluation_order = evaluation_order
+
+
+class MetricsRegistry:
+    """
+    Registro de definiciones de métricas de un directorio, compartido por el proceso.
+
+    Carga los archivos una vez y, como mucho cada METRICS_RELOAD_INTERVAL segundos, revisa
+    mtime y tamaño; solo vuelve a leer los archivos modificados y solo los reparsea si su
+    hash cambió. Los lectores obtienen siempre un snapshot completo y consistente.
+    """
+
+    def __init__(self, metrics_dir: str):
+        self.metrics_dir = metrics_dir
+        self._lock = threading.Lock()
+        self._files: Dict[str, Dict] = {}  # archivo -> {'stat', 'hash', 'metrics'}
+        self._snapshot = MetricsSnapshot({}, {}, {}, {}, {})
+        self._last_check = 0.0
+        self.reloads = 0
+
+    def snapshot(self) -> MetricsSnapshot:
+        """Snapshot vigente, revisando cambios en disco si corresponde"""
+        if time.monotonic() - self._last_check >= METRICS_RELOAD_INTERVAL:
+            self.refresh()
+        return self._snapshot
+
+    def refresh(self, force: bool = False) -> bool:
+        """Relee los archivos modificados; retorna True si las definiciones cambiaron"""
+        with self._lock:
+            if not force and time.monotonic() - self._last_check < METRICS_RELOAD_INTERVAL:
+                return False
+
+            changed = False
+            present = set()
+
+            if os.path.exists(self.metrics_dir):
+                for entry in os.scandir(self.metrics_dir):
+                    if not entry.name.endswith(('.yaml', '.yml', '.json')) or not entry.is_file():
+                        continue
+                    present.add(entry.name)
+                    stat = entry.stat()
+                    signature = (stat.st_mtime_ns, stat.st_size)
+                    cached = self._files.get(entry.name)
+                    if cached and cached['stat'] == signature and not force:
+                        continue
+                    changed |= self._load_metric_file(entry.name, signature)
+
+            for removed in set(self._files) - present:
+                del self._files[removed]
+                changed = True
+
+            if changed or force:
+                self._snapshot = self._build_snapshot()
+                self.reloads += 1
+                logger.info(f"Cargadas {len(self._snapshot.loaded_metrics)} métricas desde definiciones")
+
+            self._last_check = time.monotonic()
+            return changed
+
+    def _load_metric_file(self, filename: str, signature) -> bool:
+        """Lee un archivo; lo reparsea solo si su contenido cambió. Retorna True si cambió"""
+        try:
+            filepath = os.path.join(self.metrics_dir, filename)
+            with open(filepath, 'rb') as f:
+                content = f.read()
+
+            content_hash = hashlib.sha256(content).hexdigest()
+            cached = self._files.get(filename)
+            if cached and cached['hash'] == content_hash:
+                cached['stat'] = signature
+                return False
+
+            text = content.decode('utf-8')
+            data = json.loads(text) if filename.endswith('.json') else yaml.safe_load(text)
+
+            self._files[filename] = {
+                'stat': signature,
+                'hash': content_hash,
+                'metrics': {metric_def['id']: metric_def for metric_def in (data or {}).get('metrics', [])}
+            }
+            return True
+
+        except Exception as e:
+            logger.error(f"Error cargando archivo {filename}: {str(e)}")
+            return False
+
+    def _build_snapshot(self) -> MetricsSnapshot:
+        """Compila las fórmulas y construye el DAG a partir de los archivos cargados"""
+        loaded_metrics, compiled_plans, compile_errors = {}, {}, {}
+
+        for filename in sorted(self._files):
+            for metric_id, metric_def in self._files[filename]['metrics'].items():
+                loaded_metrics[metric_id] = metric_def
+                try:
+                    compiled_plans[metric_id] = get_compiled_formula(metric_def.get('formula'))
+                    compile_errors.pop(metric_id, None)
+                except MetricCompileError as e:
+                    compiled_plans.pop(metric_id, None)
+                    compile_errors[metric_id] = str(e)
+                    logger.warning(f"Fórmula de la métrica {metric_id} no compilable: {str(e)}")
+
+        graph, evaluation_order = self._build_dependency_graph(loaded_metrics, compiled_plans, compile_errors)
+        return MetricsSnapshot(loaded_metrics, compiled_plans, compile_errors, graph, evaluation_order)
+
+    @staticmethod
+    def _build_dependency_graph(loaded_metrics: Dict[str, Dict], compiled_plans: Dict[str, CompiledFormula],
+                                compile_errors: Dict[str, str]):
+        """
+        Construye el DAG de dependencias (referencias de la fórmula y `depends_on`), calcula
+        un orden topológico y marca como no calculables las métricas con dependencias
+        inexistentes o circulares
+        """
+        graph = {}
+        for metric_id, metric_def in loaded_metrics.items():
+            plan = compiled_plans.get(metric_id)
+            references = plan.references if plan else []
+            graph[metric_id] = list(dict.fromkeys(references + list(metric_def.get('depends_on') or [])))
+
+        order: List[str] = []
+        state: Dict[str, str] = {}  # 'visiting' | 'done'
+
+        def visit(metric_id: str, path: List[str]):
+            if state.get(metric_id) == 'done':
+                return
+            if state.get(metric_id) == 'visiting':
+                cycle = path[path.index(metric_id):] + [metric_id]
+                for member in cycle[:-1]:
+                    compile_errors[member] = f"Dependencia circular: {' -> '.join(cycle)}"
+                return
+
+            state[metric_id] = 'visiting'
+            for dependency in graph[metric_id]:
+                if dependency not in graph:
+                    compile_errors.setdefault(metric_id, f"Dependencia no encontrada: {dependency}")
+                    continue
+                visit(dependency, path + [metric_id])
+            state[metric_id] = 'done'
+            order.append(metric_id)
+
+        for metric_id in graph:
+            visit(metric_id, [])
+
+        for metric_id, error in compile_errors.items():
+            if error.startswith("Dependencia circular"):
+                logger.warning(f"Métrica {metric_id} no calculable: {error}")
+
+        return graph, {metric_id: index for index, metric_id in enumerate(order)}
+
+
+def get_metrics_registry(metrics_dir: str = 'metrics/') -> MetricsRegistry:
+    """Registro compartido del directorio (se crea y carga la primera vez)"""
+    key = os.path.abspath(metrics_dir)
+    registry = _registries.get(key)
+    if registry is None:
+        with _registries_lock:
+            registry = _registries.get(key)
+            if registry is None:
+                registry = MetricsRegistry(metrics_dir)
+                registry.refresh(force=True)
+                _registries[key] = registry
+    return registry
+
+
 class MetricsDefinitionHub:
     """
     Hub centralizado para definición, versionamiento y gestión de métricas
     """
 
-    def __init__(self, metrics_dir: str = 'metrics/'):
-        self.db = get_db()
+    def __init__(self, metrics_dir: str = 'metrics/', db=None):
+        # Con `db` se usa la sesión del llamador (p.ej. la de un thread), que la cierra él
+        self._owns_db = db is None
+        self.db = db if db is not None else get_db()
         self.metrics_dir = metrics_dir
-        self.loaded_metrics = {}
 
         # Crear directorio si no existe
         os.makedirs(self.metrics_dir, exist_ok=True)
 
-        # Cargar métricas al inicializar
-        self._load_all_metrics()
+        # Definiciones compartidas por el proceso (no se releen por instancia)
+        self.registry = get_metrics_registry(self.metrics_dir)
 
-    def _load_all_metrics(self) -> None:
-        """Carga todas las métricas desde archivos YAML/JSON"""
-        try:
-            self.loaded_metrics = {}
+    @property
+    def loaded_metrics(self) -> Dict[str, Dict]:
+        return self.registry.snapshot().loaded_metrics
 
-            if os.path.exists(self.metrics_dir):
-                for filename in os.listdir(self.metrics_dir):
-                    if filename.endswith(('.yaml', '.yml', '.json')):
-                        self._load_metric_file(filename)
+    @property
+    def compiled_plans(self) -> Dict[str, CompiledFormula]:
+        return self.registry.snapshot().compiled_plans
 
-            logger.info(f"Cargadas {len(self.loaded_metrics)} métricas desde definiciones")
-        except Exception as e:
-            logger.error(f"Error cargando métricas: {str(e)}")
+    @property
+    def compile_errors(self) -> Dict[str, str]:
+        return self.registry.snapshot().compile_errors
 
-    def _load_metric_file(self, filename: str) -> None:
-        """Carga una definición de métricas desde archivo"""
-        try:
-            filepath = os.path.join(self.metrics_dir, filename)
-            with open(filepath, 'r', encoding='utf-8') as f:
-                if filename.endswith('.json'):
-                    data = json.load(f)
-                else:  # YAML
-                    data = yaml.safe_load(f)
+    @property
+    def dependency_graph(self) -> Dict[str, List[str]]:
+        return self.registry.snapshot().dependency_graph
 
-            # Procesar todas las métricas en el archivo
-            for metric_def in data.get('metrics', []):
-                metric_id = metric_def['id']
-                self.loaded_metrics[metric_id] = metric_def
-
-        except Exception as e:
-            logger.error(f"Error cargando archivo {filename}: {str(e)}")
+    def _load_all_metrics(self) -> None:
+        """Fuerza la relectura de los archivos de definiciones modificados"""
+        self.registry.refresh(force=True)
 
     def get_metric_definition(self, metric_id: str) -> Optional[Dict]:
         """Obtiene la definición de una métrica por ID"""
@@ -143,47 +341,133 @@ class MetricsDefinitionHub:
             }
 
     def calculate_metric_value(self, metric_id: str, filters: Optional[Dict] = None) -> Dict:
-        """Calcula el valor de una métrica basada en su definición"""
+        """
+        Calcula el valor de una métrica ejecutando su fórmula compilada contra la base de datos.
+
+        `filters` se inyecta en cada tabla consultada: date_from / date_to, vendedor_id y
+        columnas de la tabla por igualdad.
+        """
+        batch = self.calculate_metrics([metric_id], filters)
+        if not batch['success']:
+            return batch
+        return batch['results'][metric_id]
+
+    def calculate_metrics(self, metric_ids: List[str], filters: Optional[Dict] = None,
+                          context: Optional[MetricContext] = None) -> Dict:
+        """
+        Calcula varias métricas juntas recorriendo el DAG de dependencias en orden topológico.
+
+        Los agregados de todas las fórmulas involucradas se agrupan por tabla y se ejecutan en
+        un único SELECT por tabla; los agregados idénticos entre fórmulas se calculan una sola
+        vez. Con un `context` compartido, las métricas y agregados ya calculados en el mismo
+        pedido se reutilizan sin volver a consultarlos.
+
+        Returns:
+            Dict con 'results' por métrica (mismo formato que calculate_metric_value) y
+            'queries' (cantidad de consultas ejecutadas en esta llamada)
+        """
         try:
-            metric_def = self.get_metric_definition(metric_id)
-            if not metric_def:
-                return {'success': False, 'error': f"Métrica no encontrada: {metric_id}"}
-
-            # Obtener fórmula de cálculo
-            formula = metric_def['formula']
-
-            # Aquí iría la lógica para ejecutar la fórmula contra la base de datos
-            # Por ahora, devolver un valor simulado basado en el tipo
-            value = self._execute_formula_simulation(formula, metric_def.get('data_type'))
+            if context is None:
+                context = MetricContext(filters)
+            elif filters and filters != context.filters:
+                raise ValueError("Los filtros no coinciden con los del contexto de evaluación")
+
+            # Un único snapshot de definiciones para toda la evaluación
+            snapshot = self.registry.snapshot()
+            requested = list(dict.fromkeys(metric_ids))
+            nodes = self._dependency_closure(requested, snapshot)
+
+            # Agregados pendientes de las métricas aún no evaluadas en el contexto
+            aggregates = {}
+            for metric_id in nodes:
+                plan = snapshot.compiled_plans.get(metric_id)
+                if plan and metric_id not in context.values and metric_id not in snapshot.compile_errors:
+                    aggregates.update({
+                        signature: aggregate for signature, aggregate in plan.aggregates.items()
+                        if signature not in context.aggregate_values
+                    })
+
+            queries = len({aggregate.table for aggregate in aggregates.values()})
+            context.aggregate_values.update(
+                execute_aggregates(self.db, list(aggregates.values()), context.filters)
+            )
+            context.queries += queries
+
+            # Cada nodo se evalúa una vez, después de sus dependencias
+            for metric_id in sorted(nodes, key=lambda m: snapshot.evaluation_order.get(m, -1)):
+                if metric_id not in context.values and metric_id not in context.errors:
+                    self._evaluate_node(metric_id, context, snapshot)
+
+            results = {}
+            for metric_id in requested:
+                if metric_id in context.errors:
+                    results[metric_id] = {'success': False, 'metric_id': metric_id, 'error': context.errors[metric_id]}
+                    continue
+                metric_def = snapshot.loaded_metrics[metric_id]
+                results[metric_id] = {
+                    'success': True,
+                    'metric_id': metric_id,
+                    'value': self._format_value(context.values[metric_id], metric_def.get('data_type')),
+                    'data_type': metric_def.get('data_type'),
+                    'unit': metric_def.get('unit', ''),
+                    'last_updated': datetime.now().isoformat()
+                }
 
             return {
                 'success': True,
-                'metric_id': metric_id,
-                'value': value,
-                'data_type': metric_def.get('data_type'),
-                'unit': metric_def.get('unit', ''),
-                'last_updated': datetime.now().isoformat()
+                'results': results,
+                'queries': queries
             }
 
         except Exception as e:
-            logger.error(f"Error calculando métrica {metric_id}: {str(e)}")
+            logger.error(f"Error calculando métricas {metric_ids}: {str(e)}")
             return {'success': False, 'error': str(e)}
 
-    def _execute_formula_simulation(self, formula: str, data_type: str) -> float:
-        """Simula la ejecución de una fórmula (mock temporal)"""
-        # Esto sería reemplazado por ejecución real de SQL contra la base de datos
-
-        # Simulaciones basadas en tipo de dato
-        if data_type == 'percentage':
-            return round(np.random.uniform(85, 98), 1)  # 85-98%
-        elif data_type == 'currency':
-            return round(np.random.uniform(500000, 2000000), 0)  # CLP
-        elif data_type == 'ratio':
-            return round(np.random.uniform(0.1, 5.0), 2)  # Tasa
-        elif data_type == 'count':
-            return int(np.random.uniform(10, 500))
-        else:  # number
-            return round(np.random.uniform(100, 10000), 2)
+    @staticmethod
+    def _dependency_closure(metric_ids: List[str], snapshot: MetricsSnapshot) -> List[str]:
+        """Métricas solicitadas más todas sus dependencias transitivas"""
+        closure, pending = [], list(metric_ids)
+        while pending:
+            metric_id = pending.pop()
+            if metric_id in closure:
+                continue
+            closure.append(metric_id)
+            pending.extend(d for d in snapshot.dependency_graph.get(metric_id, []) if d in snapshot.loaded_metrics)
+        return closure
+
+    @staticmethod
+    def _evaluate_node(metric_id: str, context: MetricContext, snapshot: MetricsSnapshot) -> None:
+        """Evalúa un nodo del DAG cuyas dependencias ya están resueltas en el contexto"""
+        if metric_id not in snapshot.loaded_metrics:
+            context.errors[metric_id] = f"Métrica no encontrada: {metric_id}"
+            return
+        if metric_id in snapshot.compile_errors:
+            context.errors[metric_id] = snapshot.compile_errors[metric_id]
+            return
+        if metric_id not in snapshot.compiled_plans:
+            context.errors[metric_id] = f"Métrica sin fórmula: {metric_id}"
+            return
+
+        failed = [d for d in snapshot.dependency_graph.get(metric_id, []) if d in context.errors]
+        if failed:
+            context.errors[metric_id] = f"Dependencia no calculable: {failed[0]} ({context.errors[failed[0]]})"
+            return
+
+        plan = snapshot.compiled_plans[metric_id]
+        context.values[metric_id] = plan.evaluate(
+            context.aggregate_values, {ref: context.values.get(ref) for ref in plan.references}
+        )
+
+    @staticmethod
+    def _format_value(value: Optional[float], data_type: Optional[str]):
+        """Redondea el valor según su tipo de dato"""
+        if value is None:
+            return None
+        if data_type == 'count':
+            return int(round(value))
+        if data_type == 'currency':
+            return round(value, 0)
+        return round(value, 2)
 
     def get_metrics_by_category(self) -> Dict[str, List[Dict]]:
         """Agrupa métricas por categoría"""
@@ -197,14 +481,8 @@ class MetricsDefinitionHub:
         return categories
 
     def get_metric_dependencies(self, metric_id: str) -> List[str]:
-        """Obtiene métricas dependientes de una métrica específica"""
-        dependencies = []
-        metric_def = self.get_metric_definition(metric_id)
-
-        if metric_def and 'depends_on' in metric_def:
-            dependencies.extend(metric_def['depends_on'])
-
-        return dependencies
+        """Obtiene métricas dependientes de una métrica específica (declaradas y referenciadas en la fórmula)"""
+        return list(self.dependency_graph.get(metric_id, []))
 
     def validate_metric_dependencies(self, metric_def: Dict) -> List[str]:
         """Valida que todas las dependencias de una métrica existan"""
@@ -267,8 +545,9 @@ class MetricsDefinitionHub:
             }
 
     def close(self):
-        """Cierra la sesión de base de datos"""
-        self.db.close()
+        """Cierra la sesión de base de datos (si es propia)"""
+        if self._owns_db:
+            self.db.close()
 
 
 # Funciones de utilidad globales
@@ -286,6 +565,17 @@ def create_sample_metrics():
             'formula': 'SUM(facturas.monto_total) WHERE estado = "Pagada"',
             'aggregation': 'sum'
         },
+        {
+            'id': 'clientes_activos',
+            'name': 'Clientes Activos',
+            'display_name': 'Clientes Activos',
+            'description': 'Clientes en el funnel que no se han perdido',
+            'category': 'ventas',
+            'data_type': 'count',
+            'unit': 'clientes',
+            'formula': 'COUNT(clientes WHERE estado_funnel != "Perdido")',
+            'aggregation': 'count'
+        },
         {
             'id': 'conversion_rate',
             'name': 'Tasa de Conversión',
@@ -0,0 +1,197 @@
+"""
+Model Registry - Agente 3 (PME)
+Registro de modelos entrenados: persiste los artefactos serializados con su metadata
+y los sirve para inferencia por lotes sin reentrenar
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from cache import TTLCache, MISSING
+from database import get_db
+from models import ModelArtifact
+import logging
+
+logger = logging.getLogger(__name__)
+
+MODEL_STORE_DIR = os.getenv('MODEL_STORE_DIR', 'model_store')
+
+# Modelos ya deserializados, por id de artefacto (compartidos por todo el proceso)
+_loaded_models: Dict[int, object] = {}
+_loaded_models_lock = threading.Lock()
+
+# Artefacto vigente por nombre de modelo; evita consultar la BD en cada predict
+_active_artifacts = TTLCache(maxsize=256, ttl=60)
+
+
+def compute_data_fingerprint(X: np.ndarray, y: Optional[np.ndarray] = None,
+                             feature_names: Optional[List[str]] = None) -> str:
+    """
+    Huella SHA-256 de los datos de entrenamiento (features, etiquetas y nombres de columnas)
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps(feature_names or []).encode('utf-8'))
+    digest.update(np.ascontiguousarray(X, dtype=float).tobytes())
+    if y is not None:
+        digest.update(np.ascontiguousarray(y).tobytes())
+    return digest.hexdigest()
+
+
+class ModelRegistry:
+    """
+    Registro de artefactos de modelos con carga diferida y cache en memoria
+    """
+
+    def __init__(self, db=None, store_dir: str = None):
+        self.db = db or get_db()
+        self.store_dir = Path(store_dir or MODEL_STORE_DIR)
+
+    def register(self, model_name: str, model, feature_names: List[str], X: np.ndarray,
+                 y: Optional[np.ndarray] = None, prediction_type: str = None,
+                 metric_ids: List[int] = None, parameters: Dict = None) -> Dict:
+        """
+        Serializa un modelo entrenado, registra su metadata y lo deja como versión vigente
+        """
+        try:
+            previous_version = self.db.query(ModelArtifact.version).filter(
+                ModelArtifact.model_name == model_name
+            ).order_by(ModelArtifact.version.desc()).first()
+            version = (previous_version[0] if previous_version else 0) + 1
+
+            model_dir = self.store_dir / model_name
+            model_dir.mkdir(parents=True, exist_ok=True)
+            artifact_path = model_dir / f"v{version}.pkl"
+
+            with open(artifact_path, 'wb') as artifact_file:
+                pickle.dump(model, artifact_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+            artifact = ModelArtifact(
+                model_name=model_name,
+                version=version,
+                prediction_type=prediction_type,
+                artifact_path=str(artifact_path),
+                feature_names=json.dumps(feature_names),
+                data_fingerprint=compute_data_fingerprint(X, y, feature_names),
+                dataset_size=len(X),
+                metric_ids=json.dumps(metric_ids or []),
+                parameters=json.dumps(parameters or {}, default=str),
+                is_active=1
+            )
+
+            self.db.query(ModelArtifact).filter(
+                ModelArtifact.model_name == model_name,
+                ModelArtifact.is_active == 1
+            ).update({ModelArtifact.is_active: 0}, synchronize_session=False)
+            self.db.add(artifact)
+            self.db.commit()
+
+            # El modelo recién entrenado queda cargado para servir sin volver a leer el archivo
+            with _loaded_models_lock:
+                _loaded_models[artifact.id] = model
+            _active_artifacts.invalidate(model_name)
+
+            return {"success": True, **self._artifact_to_dict(artifact)}
+
+        except Exception as e:
+            self.db.rollback()
+            logger.error(f"Error registrando modelo {model_name}: {str(e)}")
+            return {"success": False, "error": str(e)}
+
+    def get_model_info(self, model_name: str) -> Optional[Dict]:
+        """
+        Metadata de la versión vigente de un modelo, o None si no hay ninguna registrada
+        """
+        info = _active_artifacts.get(model_name)
+        if info is MISSING:
+            artifact = self.db.query(ModelArtifact).filter(
+                ModelArtifact.model_name == model_name,
+                ModelArtifact.is_active == 1
+            ).order_by(ModelArtifact.version.desc()).first()
+            info = self._artifact_to_dict(artifact) if artifact else None
+            _active_artifacts.set(model_name, info)
+        return info
+
+    def has_model(self, model_name: str) -> bool:
+        """Indica si existe una versión vigente del modelo"""
+        return self.get_model_info(model_name) is not None
+
+    def load(self, model_name: str) -> Tuple[Dict, object]:
+        """
+        Retorna (metadata, modelo) de la versión vigente; el artefacto se deserializa una
+        sola vez por proceso
+        """
+        info = self.get_model_info(model_name)
+        if info is None:
+            raise LookupError(f"No hay una versión registrada del modelo {model_name}")
+
+        with _loaded_models_lock:
+            model = _loaded_models.get(info["artifact_id"])
+            if model is None:
+                with open(info["artifact_path"], 'rb') as artifact_file:
+                    model = pickle.load(artifact_file)
+                _loaded_models[info["artifact_id"]] = model
+
+        return info, model
+
+    def predict(self, model_name: str, features_batch) -> np.ndarray:
+        """
+        Inferencia por lotes con la versión vigente del modelo.
+
+        `features_batch` puede ser una matriz NumPy (columnas en el orden registrado) o un
+        DataFrame / lista de dicts con las columnas por nombre. Para clasificadores retorna
+        la probabilidad de la clase positiva.
+        """
+        info, model = self.load(model_name)
+        feature_names = info["feature_names"]
+
+        if isinstance(features_batch, list) and features_batch and isinstance(features_batch[0], dict):
+            features_batch = pd.DataFrame(features_batch)
+        if isinstance(features_batch, pd.DataFrame):
+            features_batch = features_batch[feature_names].to_numpy(dtype=float)
+
+        X = np.asarray(features_batch, dtype=float)
+        if X.ndim == 1:
+            X = X.reshape(1, -1)
+        if X.shape[0] == 0:
+            return np.empty(0)
+        if X.shape[1] != len(feature_names):
+            raise ValueError(
+                f"El modelo {model_name} espera {len(feature_names)} features, se recibieron {X.shape[1]}"
+            )
+
+        if hasattr(model, 'predict_proba'):
+            return model.predict_proba(X)[:, 1]
+        return np.asarray(model.predict(X), dtype=float)
+
+    def list_models(self) -> List[Dict]:
+        """
+        Versiones vigentes de todos los modelos registrados
+        """
+        artifacts = self.db.query(ModelArtifact).filter(
+            ModelArtifact.is_active == 1
+        ).order_by(ModelArtifact.model_name).all()
+        return [self._artifact_to_dict(artifact) for artifact in artifacts]
+
+    def _artifact_to_dict(self, artifact: ModelArtifact) -> Dict:
+        """Serializa la metadata de un artefacto"""
+        return {
+            "artifact_id": artifact.id,
+            "model_name": artifact.model_name,
+            "version": artifact.version,
+            "prediction_type": artifact.prediction_type,
+            "artifact_path": artifact.artifact_path,
+            "feature_names": json.loads(artifact.feature_names) if artifact.feature_names else [],
+            "data_fingerprint": artifact.data_fingerprint,
+            "dataset_size": artifact.dataset_size,
+            "metric_ids": json.loads(artifact.metric_ids) if artifact.metric_ids else [],
+            "parameters": json.loads(artifact.parameters) if artifact.parameters else {},
+            "created_at": str(artifact.created_at)
+        }
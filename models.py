@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, Date, DateTime, ForeignKey, Enum, Text
+from sqlalchemy import Column, Integer, String, Float, Date, DateTime, ForeignKey, Enum, Text, Index
 from sqlalchemy.orm import relationship
 from database import Base
 from datetime import datetime
@@ -51,6 +51,7 @@ class Cliente(Base):
     estado_funnel = Column(Enum(EstadoFunnelEnum), default=EstadoFunnelEnum.prospecto)
     valor_estimado = Column(Float, default=0.0)
     fecha_ingreso = Column(Date, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
     
     vendedor = relationship("Vendedor", back_populates="clientes")
     facturas = relationship("Factura", back_populates="cliente")
@@ -81,6 +82,7 @@ class Factura(Base):
     monto_pagado = Column(Float, default=0.0)
     estado = Column(Enum(EstadoFacturaEnum), default=EstadoFacturaEnum.pendiente)
     descripcion = Column(Text)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
     
     cliente = relationship("Cliente", back_populates="facturas")
     cobranzas = relationship("Cobranza", back_populates="factura")
@@ -179,6 +181,15 @@ class ModelPrediction(Base):
     entity_id = Column(Integer)  # ID del cliente, vendedor, etc.
     entity_type = Column(String(50))  # 'cliente', 'vendedor', 'producto'
 
+    # Lote de entrenamiento/scoring: cada ejecución inserta un lote nuevo y desactiva el anterior
+    run_id = Column(String(32), index=True)
+    is_active = Column(Integer, default=1)  # 0=reemplazada por un lote posterior, 1=vigente
+
+    # Índice de servicio: última predicción vigente por (tipo, entidad) sin recorrer el historial
+    __table_args__ = (
+        Index('ix_model_predictions_serving', 'prediction_type', 'entity_type', 'entity_id', 'is_active'),
+    )
+
 # Agente PME: Tabla para métricas de modelos
 class ModelMetric(Base):
     __tablename__ = "model_metrics"
@@ -193,6 +204,62 @@ class ModelMetric(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     additional_info = Column(Text)  # JSON con detalles adicionales
 
+# Agente PME: Tabla para artefactos de modelos entrenados (registro de modelos)
+class ModelArtifact(Base):
+    __tablename__ = "model_artifacts"
+
+    id = Column(Integer, primary_key=True, index=True)
+    model_name = Column(String(100), nullable=False, index=True)
+    version = Column(Integer, nullable=False)
+    prediction_type = Column(String(50))
+    artifact_path = Column(String(500), nullable=False)  # Archivo serializado del modelo
+    feature_names = Column(Text)  # JSON array con el orden de columnas esperado
+    data_fingerprint = Column(String(64))  # SHA-256 de los datos de entrenamiento
+    dataset_size = Column(Integer)
+    metric_ids = Column(Text)  # JSON array de ids en model_metrics
+    parameters = Column(Text)  # JSON con hiperparámetros
+    is_active = Column(Integer, default=1)  # 1=versión servida para el modelo
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+# Agente PA: Tabla de recomendaciones precalculadas
+class Recommendation(Base):
+    __tablename__ = "recommendations"
+
+    id = Column(Integer, primary_key=True, index=True)
+    entity_type = Column(String(50), nullable=False)  # 'cliente', 'vendedor', 'equipo', 'finanzas'
+    entity_id = Column(Integer, nullable=False, default=0)  # 0 para recomendaciones globales
+    rec_type = Column(String(50), nullable=False)  # 'payment_followup', 'risk_mitigation', etc.
+    category = Column(String(50), index=True)
+    priority = Column(String(20), default="medium")  # 'low', 'medium', 'high', 'critical'
+    title = Column(String(300), nullable=False)
+    description = Column(Text)
+    action = Column(Text)
+    impact_score = Column(Float, default=0.0)
+    details = Column(Text)  # JSON con detalles específicos
+    status = Column(String(20), default="open")  # 'open', 'acknowledged', 'resolved', 'dismissed'
+    generated_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, index=True)
+
+    __table_args__ = (
+        Index('ux_recommendations_key', 'entity_type', 'entity_id', 'rec_type', unique=True),
+        Index('ix_recommendations_ranking', 'status', 'impact_score'),
+    )
+
+# Agente PA: Huella de los datos de entrada de cada entidad en la última generación
+class RecommendationWatermark(Base):
+    __tablename__ = "recommendation_watermarks"
+
+    id = Column(Integer, primary_key=True, index=True)
+    entity_type = Column(String(50), nullable=False)
+    entity_id = Column(Integer, nullable=False)
+    input_hash = Column(String(32), nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index('ux_recommendation_watermarks_entity', 'entity_type', 'entity_id', unique=True),
+    )
+
 # Agente AD: Tabla para alertas de anomalías
 class AnomalyAlert(Base):
     __tablename__ = "anomaly_alerts"
@@ -250,7 +317,7 @@ class UserDashboard(Base):
     id = Column(Integer, primary_key=True, index=True)
     title = Column(String(200), nullable=False)
     description = Column(Text)
-    user_id = Column(Integer, ForeignKey("usuarios.id"))
+    user_id = Column(Integer, ForeignKey("usuarios.id"), index=True)
     is_public = Column(Integer, default=0)  # 0=privado, 1=compartido en equipo, 2=público
     dashboard_type = Column(String(20), default='metabase')  # 'metabase', 'powerbi', 'streamlit'
     config = Column(Text)  # JSON con configuración del dashboard
@@ -277,6 +344,10 @@ class DashboardPermission(Base):
     granted_at = Column(DateTime, default=datetime.utcnow)
     expires_at = Column(DateTime)
 
+    __table_args__ = (
+        Index('ix_dashboard_permissions_user', 'user_id', 'dashboard_id'),
+    )
+
 # Agente SSBF: Tabla para plantillas de dashboards
 class DashboardTemplate(Base):
     __tablename__ = "dashboard_templates"
@@ -292,3 +363,59 @@ class DashboardTemplate(Base):
     is_public = Column(Integer, default=1)
     created_by = Column(String(100))
     created_at = Column(DateTime, default=datetime.utcnow)
+
+# Agente ARD: Reportes programados (horas locales); next_run_at es la próxima ejecución pendiente
+class ReportSchedule(Base):
+    __tablename__ = "report_schedules"
+
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String(200), nullable=False)
+    report_type = Column(String(50), nullable=False)
+    config = Column(Text, nullable=False)  # JSON con la configuración del reporte
+    frequency = Column(String(20), nullable=False)  # 'hourly', 'daily', 'weekly', 'monthly'
+    hour = Column(Integer, default=0)
+    minute = Column(Integer, default=0)
+    day_of_week = Column(Integer)  # 0=lunes (semanal)
+    day_of_month = Column(Integer)  # 1-31 (mensual; se ajusta al último día del mes)
+    active = Column(Integer, default=1)
+    next_run_at = Column(DateTime, nullable=False)
+    last_run_at = Column(DateTime)
+    locked_by = Column(String(100))  # Instancia que ejecuta el reporte
+    locked_until = Column(DateTime)  # Vencimiento del lease de ejecución
+    created_by = Column(Integer, ForeignKey("usuarios.id"))
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        Index('ix_report_schedules_due', 'active', 'next_run_at'),
+    )
+
+# Agente ARD: Historial de ejecuciones de reportes programados
+class ReportRun(Base):
+    __tablename__ = "report_runs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    schedule_id = Column(Integer, ForeignKey("report_schedules.id"), nullable=False)
+    scheduled_for = Column(DateTime, nullable=False)
+    missed_runs = Column(Integer, default=0)  # Ejecuciones omitidas que se agruparon en esta
+    worker_id = Column(String(100))
+    status = Column(String(20), default="running")  # 'running', 'success', 'failed'
+    started_at = Column(DateTime, default=datetime.now)
+    finished_at = Column(DateTime)
+    duration_seconds = Column(Float)
+    file_size_bytes = Column(Integer)
+    detail_rows = Column(Integer)
+    error = Column(Text)
+
+    __table_args__ = (
+        Index('ix_report_runs_schedule', 'schedule_id', 'started_at'),
+    )
+
+# Versión de datos por tabla, repartida en slots para que escritores concurrentes no
+# compartan fila; la versión de una tabla es la suma de sus slots (ver database.py)
+class DataVersion(Base):
+    __tablename__ = "data_versions"
+
+    table_name = Column(String(100), primary_key=True)
+    slot = Column(Integer, primary_key=True, autoincrement=False, default=0)
+    version = Column(Integer, nullable=False, default=0)
@@ -4,10 +4,14 @@ Módulo para generar recomendaciones accionables basadas en predicciones
 """
 
 import json
+import math
+import pandas as pd
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional
+from sqlalchemy import case, func, insert, or_, select, union, update
 from database import get_db
-from models import Cliente, Factura, Vendedor, ModelPrediction, ActividadVenta, MovimientoCaja, Cobranza
+from models import (Cliente, Factura, Vendedor, ModelPrediction, ActividadVenta, MovimientoCaja, Cobranza,
+                    EstadoFacturaEnum, EstadoFunnelEnum, Recommendation, RecommendationWatermark)
 from predictive_models import PredictiveModelEngine
 from auth import get_current_user
 import logging
@@ -16,6 +20,117 @@ import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Mapeo de roles a categorías permitidas
+ROLE_CATEGORIES = {
+    'admin': ['ventas', 'finanzas', 'cobranza', 'atención', 'productividad', 'habilidades', 'equipo', 'operaciones', 'costos', 'riesgo'],
+    'direccion': ['ventas', 'finanzas', 'cobranza', 'atención', 'productividad', 'habilidades', 'equipo', 'operaciones', 'costos', 'riesgo'],
+    'finanzas': ['finanzas', 'cobranza', 'costos', 'riesgo'],
+    'ventas': ['ventas', 'atención', 'productividad', 'habilidades', 'equipo'],
+    'operaciones': ['operaciones', 'productividad', 'atención']
+}
+
+# Estados de factura con saldo pendiente que pueden estar vencidas
+OVERDUE_STATES = [EstadoFacturaEnum.vencida, EstadoFacturaEnum.parcial]
+
+# Columnas cuyo cambio obliga a regenerar las recomendaciones de un cliente
+CLIENT_INPUT_COLUMNS = [
+    'client_name', 'estado_funnel', 'valor_estimado',
+    'risk_prob', 'conv_prob', 'overdue_count', 'overdue_amount'
+]
+
+# Vigencia de las recomendaciones almacenadas si el job diario deja de renovarlas
+RECOMMENDATION_TTL_DAYS = 7
+RECOMMENDATION_STATUSES = ['open', 'acknowledged', 'resolved', 'dismissed']
+
+# Tamaño máximo de las listas IN
+ID_BATCH_SIZE = 500
+
+# Marca de la última regeneración incremental de clientes (fila de recommendation_watermarks)
+CLIENT_REFRESH_MARK = "refresh:cliente"
+# Margen hacia atrás desde la última regeneración, para escrituras que confirmaron durante ella
+REFRESH_OVERLAP = timedelta(minutes=5)
+# Predicciones que forman parte del estado de un cliente
+CLIENT_PREDICTION_TYPES = ["risk_assessment", "conversion_probability"]
+
+CLIENT_FRAME_COLUMNS = [
+    'client_id', 'client_name', 'estado_funnel', 'valor_estimado',
+    'risk_prob', 'conv_prob', 'overdue_count', 'overdue_amount'
+]
+
+SELLER_FRAME_COLUMNS = [
+    'seller_id', 'seller_name', 'meta_mensual', 'activity_count',
+    'valued_activity_count', 'client_count', 'won_clients'
+]
+
+# Estados de factura con saldo por cobrar
+RECEIVABLE_STATES = [EstadoFacturaEnum.pendiente, EstadoFacturaEnum.parcial]
+
+# Tramos de antigüedad de cuentas por cobrar: (etiqueta, días vencidos mínimos); el resto es 'current'
+AGING_BUCKETS = [('overdue_60_plus', 61), ('overdue_31_60', 31), ('overdue_1_30', 1)]
+
+# Ventana de actividad comercial evaluada por vendedor
+SELLER_ACTIVITY_DAYS = 30
+
+# Reglas de recomendación por cliente, en orden de evaluación
+CLIENT_RULES = {
+    "risk_mitigation": {
+        "priority": "high",
+        "title": "Alto riesgo de morosidad detectado",
+        "description": "El cliente {name} tiene {risk_prob:.1%} de probabilidad de morosidad",
+        "action": "Revisar condiciones de pago y considerar reducción de crédito",
+        "impact_score": 9.0,
+        "category": "finanzas"
+    },
+    "risk_monitoring": {
+        "priority": "medium",
+        "title": "Monitorear riesgo de morosidad",
+        "description": "Cliente con riesgo moderado ({risk_prob:.1%}) de morosidad",
+        "action": "Programar seguimiento semanal de pagos",
+        "impact_score": 6.0,
+        "category": "finanzas"
+    },
+    "overdue_payments": {
+        "priority": "medium",
+        "title": "Facturas pendientes: {overdue_count} vencidas",
+        "description": "El cliente tiene {overdue_count} factura(s) vencida(s) sin predicción de riesgo disponible",
+        "action": "Revisar estado de pagos inmediatamente",
+        "impact_score": 7.0,
+        "category": "finanzas"
+    },
+    "conversion_acceleration": {
+        "priority": "high",
+        "title": "Alta probabilidad de cierre",
+        "description": "El cliente {name} tiene {conv_prob:.1%} de probabilidad de conversión",
+        "action": "Priorizar recursos de venta y acelerar proceso de cierre",
+        "impact_score": 8.5,
+        "category": "ventas"
+    },
+    "conversion_review": {
+        "priority": "medium",
+        "title": "Revisar estrategia de venta",
+        "description": "Baja probabilidad de conversión ({conv_prob:.1%}) en estado {estado}",
+        "action": "Evaluar cambio de enfoque o reasignación de vendedor",
+        "impact_score": 7.0,
+        "category": "ventas"
+    },
+    "payment_followup": {
+        "priority": "high",
+        "title": "Facturas vencidas: ${overdue_amount:,.0f}",
+        "description": "El cliente tiene {overdue_count} factura(s) vencida(s) por un total de ${overdue_amount:,.0f}",
+        "action": "Iniciar proceso de cobranza inmediata",
+        "impact_score": 9.5,
+        "category": "cobranza"
+    },
+    "high_value_client": {
+        "priority": "medium",
+        "title": "Cliente de alto valor",
+        "description": "Cliente con valor estimado de ${valor_estimado:,.0f}",
+        "action": "Asignar ejecutivo senior y beneficios preferenciales",
+        "impact_score": 7.5,
+        "category": "atención"
+    }
+}
+
 class PrescriptiveAdvisor:
     """
     Asesor prescriptivo que genera recomendaciones basadas en predicciones
@@ -28,233 +143,228 @@ class PrescriptiveAdvisor:
 
     def _filter_recommendations_by_role(self, recommendations: List[Dict]) -> List[Dict]:
         """Filtra recomendaciones según el rol del usuario."""
-        if not self.user or 'rol' not in self.user:
+        allowed_categories = self._allowed_categories()
+        if allowed_categories is None:
             return recommendations  # Si no hay usuario o rol, devolver todo
 
-        user_role = self.user['rol']
-        
-        # Mapeo de roles a categorías permitidas
-        role_permissions = {
-            'admin': ['ventas', 'finanzas', 'cobranza', 'atención', 'productividad', 'habilidades', 'equipo', 'operaciones', 'costos', 'riesgo'],
-            'direccion': ['ventas', 'finanzas', 'cobranza', 'atención', 'productividad', 'habilidades', 'equipo', 'operaciones', 'costos', 'riesgo'],
-            'finanzas': ['finanzas', 'cobranza', 'costos', 'riesgo'],
-            'ventas': ['ventas', 'atención', 'productividad', 'habilidades', 'equipo'],
-            'operaciones': ['operaciones', 'productividad', 'atención']
-        }
-
-        allowed_categories = role_permissions.get(user_role, [])
-        
         return [rec for rec in recommendations if rec.get('category') in allowed_categories]
 
     def generate_client_recommendations(self, client_id: int = None, limit: int = 10) -> Dict:
         """
         Genera recomendaciones para clientes específicos o todos
         """
-        try:
-            if client_id:
-                clients = [self.db.query(Cliente).filter(Cliente.id == client_id).first()]
-                if not clients[0]:
-                    return {"success": False, "error": f"Cliente {client_id} no encontrado"}
-            else:
-                # Si el rol es ventas, mostrar solo sus clientes
-                if self.user and self.user.get('rol') == 'ventas':
-                    vendedor = self.db.query(Vendedor).filter(Vendedor.email == self.user['email']).first()
-                    if vendedor:
-                        vendedor_id = vendedor.id
-                        clients = self.db.query(Cliente).filter(Cliente.vendedor_id == vendedor_id).limit(limit).all()
-                    else:
-                        logger.warning(f"No se encontró vendedor para el email: {self.user['email']}")
-                        clients = [] # No clients to recommend if seller not found
-                else:
-                    clients = self.db.query(Cliente).limit(limit).all()
+        if client_id:
+            if not self.db.query(Cliente.id).filter(Cliente.id == client_id).first():
+                return {"success": False, "error": f"Cliente {client_id} no encontrado"}
+            return self.generate_client_recommendations_batch(client_ids=[client_id], page_size=limit)
 
+        return self.generate_client_recommendations_batch(page_size=limit)
 
-            recommendations = []
+    def generate_client_recommendations_batch(self, client_ids: List[int] = None, page: int = 1,
+                                              page_size: int = 50) -> Dict:
+        """
+        Genera recomendaciones sobre toda la cartera (o los clientes indicados) de forma
+        vectorizada: carga estado de funnel, predicciones vigentes y facturas vencidas con
+        consultas agrupadas, evalúa las reglas por columnas y retorna la página solicitada
+        del ranking por impacto.
+        """
+        try:
+            clients = self._load_client_frame(client_ids)
+            if clients is None:
+                clients = pd.DataFrame(columns=CLIENT_FRAME_COLUMNS)
 
-            for client in clients:
-                client_recs = self._analyze_client_situation(client)
-                recommendations.extend(client_recs)
+            ranking = self._evaluate_client_rules(clients)
 
             # Filtrar por rol
-            filtered_recs = self._filter_recommendations_by_role(recommendations)
+            allowed_categories = self._allowed_categories()
+            if allowed_categories is not None:
+                ranking = ranking[ranking['category'].isin(allowed_categories)]
 
             # Ordenar por impacto esperado (descendente)
-            filtered_recs.sort(key=lambda x: x.get('impact_score', 0), reverse=True)
+            ranking = ranking.sort_values(
+                ['impact_score', 'client_id', 'rule_order'],
+                ascending=[False, True, True],
+                kind='mergesort'
+            )
+
+            total_generated = len(ranking)
+            page = max(1, page)
+            page_rows = ranking.iloc[(page - 1) * page_size:page * page_size]
 
             return {
                 "success": True,
-                "recommendations": filtered_recs[:limit],
-                "total_generated": len(filtered_recs)
+                "recommendations": self._build_client_recommendations(page_rows, clients),
+                "total_generated": total_generated,
+                "page": page,
+                "page_size": page_size,
+                "total_pages": math.ceil(total_generated / page_size) if page_size else 0
             }
 
         except Exception as e:
             logger.error(f"Error generando recomendaciones de clientes: {str(e)}")
             return {"success": False, "error": str(e)}
 
-    def _analyze_client_situation(self, client: Cliente) -> List[Dict]:
+    def _allowed_categories(self) -> Optional[List[str]]:
+        """Categorías visibles para el rol del usuario (None = todas)"""
+        if not self.user or 'rol' not in self.user:
+            return None
+        return ROLE_CATEGORIES.get(self.user['rol'], [])
+
+    def _load_client_frame(self, client_ids: List[int] = None, restrict_to_seller: bool = True) -> Optional[pd.DataFrame]:
         """
-        Analiza la situación de un cliente y genera recomendaciones
+        Carga en un DataFrame el estado de cada cliente: funnel, valor estimado, predicciones
+        vigentes de riesgo y conversión, y el agregado de facturas vencidas.
+        Retorna None si el usuario de ventas no tiene vendedor asociado.
         """
-        recommendations = []
-
-        try:
-            # Obtener predicciones del cliente
-            risk_predictions = self.pme.get_predictions(
-                prediction_type="risk_assessment",
-                entity_type="cliente",
-                entity_id=client.id
-            )
-
-            conversion_predictions = self.pme.get_predictions(
-                prediction_type="conversion_probability",
-                entity_type="cliente",
-                entity_id=client.id
-            )
-
-            # Analizar riesgo de morosidad (con fallback si no hay predicciones)
-            risk_recommendation = None
-            if risk_predictions["success"] and risk_predictions["predictions"] and len(risk_predictions["predictions"]) > 0:
-                risk_prob = risk_predictions["predictions"][0]["predicted_value"]
-
-                if risk_prob > 0.7:
-                    risk_recommendation = {
-                        "type": "risk_mitigation",
-                        "priority": "high",
-                        "client_id": client.id,
-                        "client_name": client.nombre,
-                        "title": "Alto riesgo de morosidad detectado",
-                        "description": f"El cliente {client.nombre} tiene {risk_prob:.1%} de probabilidad de morosidad",
-                        "action": "Revisar condiciones de pago y considerar reducción de crédito",
-                        "impact_score": 9.0,
-                        "category": "finanzas",
-                        "suggested_by": "PA"
-                    }
-
-                elif risk_prob > 0.4:
-                    risk_recommendation = {
-                        "type": "risk_monitoring",
-                        "priority": "medium",
-                        "client_id": client.id,
-                        "client_name": client.nombre,
-                        "title": "Monitorear riesgo de morosidad",
-                        "description": f"Cliente con riesgo moderado ({risk_prob:.1%}) de morosidad",
-                        "action": "Programar seguimiento semanal de pagos",
-                        "impact_score": 6.0,
-                        "category": "finanzas",
-                        "suggested_by": "PA"
-                    }
-            else:
-                # Fallback: analizar facturas vencidas directamente
-                overdue_invoices = self._get_overdue_invoices(client.id)
-                if overdue_invoices and len(overdue_invoices) > 0:
-                    risk_recommendation = {
-                        "type": "overdue_payments",
-                        "priority": "medium",
-                        "client_id": client.id,
-                        "client_name": client.nombre,
-                        "title": f"Facturas pendientes: {len(overdue_invoices)} vencidas",
-                        "description": f"El cliente tiene {len(overdue_invoices)} factura(s) vencida(s) sin predicción de riesgo disponible",
-                        "action": "Revisar estado de pagos inmediatamente",
-                        "impact_score": 7.0,
-                        "category": "finanzas",
-                        "suggested_by": "PA"
-                    }
-
-            if risk_recommendation:
-                recommendations.append(risk_recommendation)
+        clients_query = self.db.query(
+            Cliente.id, Cliente.nombre, Cliente.estado_funnel, Cliente.valor_estimado
+        )
+
+        # Si el rol es ventas, mostrar solo sus clientes
+        if client_ids is None and restrict_to_seller and self.user and self.user.get('rol') == 'ventas':
+            vendedor = self.db.query(Vendedor).filter(Vendedor.email == self.user['email']).first()
+            if not vendedor:
+                logger.warning(f"No se encontró vendedor para el email: {self.user['email']}")
+                return None
+            clients_query = clients_query.filter(Cliente.vendedor_id == vendedor.id)
+        elif client_ids is not None:
+            clients_query = clients_query.filter(Cliente.id.in_(client_ids))
+
+        clients = pd.DataFrame(
+            clients_query.order_by(Cliente.id).all(),
+            columns=['client_id', 'client_name', 'estado_funnel', 'valor_estimado']
+        )
+        clients['estado_funnel'] = clients['estado_funnel'].map(lambda e: getattr(e, 'value', e))
+
+        # Predicciones vigentes solo de los clientes cargados, servidas desde el cache de
+        # últimas predicciones del PME
+        entity_ids = clients['client_id'].tolist()
+        risk = self.pme.get_active_predictions_frame("risk_assessment", entity_ids=entity_ids).rename(
+            columns={'entity_id': 'client_id', 'predicted_value': 'risk_prob'}
+        )
+        conversion = self.pme.get_active_predictions_frame("conversion_probability", entity_ids=entity_ids).rename(
+            columns={'entity_id': 'client_id', 'predicted_value': 'conv_prob'}
+        )
+
+        overdue_query = self.db.query(
+            Factura.cliente_id,
+            func.count(Factura.id),
+            func.sum(Factura.monto_total - func.coalesce(Factura.monto_pagado, 0.0))
+        ).filter(
+            Factura.estado.in_(OVERDUE_STATES),
+            Factura.fecha_vencimiento < datetime.now().date()
+        )
+        if client_ids is not None:
+            overdue_query = overdue_query.filter(Factura.cliente_id.in_(client_ids))
+        overdue = pd.DataFrame(overdue_query.group_by(Factura.cliente_id).all(),
+                               columns=['client_id', 'overdue_count', 'overdue_amount'])
+
+        clients = clients.merge(risk, on='client_id', how='left')
+        clients = clients.merge(conversion, on='client_id', how='left')
+        clients = clients.merge(overdue, on='client_id', how='left')
+        clients[['overdue_count', 'overdue_amount']] = clients[['overdue_count', 'overdue_amount']].fillna(0)
+
+        return clients[CLIENT_FRAME_COLUMNS]
+
+    def _evaluate_client_rules(self, clients: pd.DataFrame) -> pd.DataFrame:
+        """
+        Evalúa las reglas de recomendación por columnas y retorna una fila por recomendación
+        (client_id, rule, category, impact_score), sin construir todavía los textos
+        """
+        risk_prob = clients['risk_prob']
+        conv_prob = clients['conv_prob']
+        has_overdue = clients['overdue_count'] > 0
+
+        rule_masks = {
+            # Riesgo de morosidad (con fallback a facturas vencidas si no hay predicción)
+            "risk_mitigation": risk_prob > 0.7,
+            "risk_monitoring": (risk_prob > 0.4) & (risk_prob <= 0.7),
+            "overdue_payments": risk_prob.isna() & has_overdue,
+            # Probabilidad de conversión
+            "conversion_acceleration": (conv_prob > 0.8) & (clients['estado_funnel'] != "Ganado"),
+            "conversion_review": (conv_prob < 0.3) & clients['estado_funnel'].isin(["Propuesta", "Negociación"]),
+            # Facturas vencidas
+            "payment_followup": has_overdue,
+            # Valor potencial: más de 1M
+            "high_value_client": clients['valor_estimado'].fillna(0) > 1000000
+        }
 
-            # Analizar probabilidad de conversión
-            if conversion_predictions["success"] and conversion_predictions["predictions"] and len(conversion_predictions["predictions"]) > 0:
-                conv_prob = conversion_predictions["predictions"][0]["predicted_value"]
+        frames = []
+        for rule_order, (rule, mask) in enumerate(rule_masks.items()):
+            matched = clients.loc[mask.fillna(False).astype(bool), ['client_id']].copy()
+            matched['rule'] = rule
+            matched['rule_order'] = rule_order
+            matched['category'] = CLIENT_RULES[rule]['category']
+            matched['impact_score'] = CLIENT_RULES[rule]['impact_score']
+            frames.append(matched)
 
-                if conv_prob > 0.8 and client.estado_funnel.value != "Ganado":
-                    recommendations.append({
-                        "type": "conversion_acceleration",
-                        "priority": "high",
-                        "client_id": client.id,
-                        "client_name": client.nombre,
-                        "title": "Alta probabilidad de cierre",
-                        "description": f"El cliente {client.nombre} tiene {conv_prob:.1%} de probabilidad de conversión",
-                        "action": "Priorizar recursos de venta y acelerar proceso de cierre",
-                        "impact_score": 8.5,
-                        "category": "ventas",
-                        "suggested_by": "PA"
-                    })
+        return pd.concat(frames, ignore_index=True)
 
-                elif conv_prob < 0.3 and client.estado_funnel.value in ["Propuesta", "Negociación"]:
-                    recommendations.append({
-                        "type": "conversion_review",
-                        "priority": "medium",
-                        "client_id": client.id,
-                        "client_name": client.nombre,
-                        "title": "Revisar estrategia de venta",
-                        "description": f"Baja probabilidad de conversión ({conv_prob:.1%}) en estado {client.estado_funnel.value}",
-                        "action": "Evaluar cambio de enfoque o reasignación de vendedor",
-                        "impact_score": 7.0,
-                        "category": "ventas",
-                        "suggested_by": "PA"
-                    })
+    def _build_client_recommendations(self, rows: pd.DataFrame, clients: pd.DataFrame) -> List[Dict]:
+        """
+        Construye los diccionarios de recomendación solo para las filas de la página
+        """
+        if rows.empty:
+            return []
 
-            # Analizar facturas vencidas
-            overdue_invoices = self._get_overdue_invoices(client.id)
-            if overdue_invoices:
-                total_overdue = sum(inv["monto_pendiente"] for inv in overdue_invoices)
+        client_state = clients.set_index('client_id')
+        followup_ids = rows.loc[rows['rule'] == "payment_followup", 'client_id'].tolist()
+        overdue_details = self._get_overdue_invoices(followup_ids) if followup_ids else {}
 
-                recommendations.append({
-                    "type": "payment_followup",
-                    "priority": "high",
-                    "client_id": client.id,
-                    "client_name": client.nombre,
-                    "title": f"Facturas vencidas: ${total_overdue:,.0f}",
-                    "description": f"El cliente tiene {len(overdue_invoices)} factura(s) vencida(s) por un total de ${total_overdue:,.0f}",
-                    "action": "Iniciar proceso de cobranza inmediata",
-                    "impact_score": 9.5,
-                    "category": "cobranza",
-                    "suggested_by": "PA",
-                    "details": overdue_invoices
-                })
+        recommendations = []
+        for client_id, rule in zip(rows['client_id'], rows['rule']):
+            client = client_state.loc[client_id]
+            spec = CLIENT_RULES[rule]
+            values = {
+                "name": client['client_name'],
+                "risk_prob": client['risk_prob'],
+                "conv_prob": client['conv_prob'],
+                "estado": client['estado_funnel'],
+                "overdue_count": int(client['overdue_count']),
+                "overdue_amount": client['overdue_amount'],
+                "valor_estimado": client['valor_estimado']
+            }
 
-            # Analizar valor potencial vs actual
-            if client.valor_estimado and client.valor_estimado > 1000000:  # Más de 1M
-                recommendations.append({
-                    "type": "high_value_client",
-                    "priority": "medium",
-                    "client_id": client.id,
-                    "client_name": client.nombre,
-                    "title": "Cliente de alto valor",
-                    "description": f"Cliente con valor estimado de ${client.valor_estimado:,.0f}",
-                    "action": "Asignar ejecutivo senior y beneficios preferenciales",
-                    "impact_score": 7.5,
-                    "category": "atención",
-                    "suggested_by": "PA"
-                })
+            recommendation = {
+                "type": rule,
+                "priority": spec['priority'],
+                "client_id": int(client_id),
+                "client_name": client['client_name'],
+                "title": spec['title'].format(**values),
+                "description": spec['description'].format(**values),
+                "action": spec['action'],
+                "impact_score": spec['impact_score'],
+                "category": spec['category'],
+                "suggested_by": "PA"
+            }
+            if rule == "payment_followup":
+                recommendation["details"] = overdue_details.get(client_id, [])
 
-        except Exception as e:
-            logger.error(f"Error analizando cliente {client.id}: {str(e)}")
+            recommendations.append(recommendation)
 
         return recommendations
 
-    def _get_overdue_invoices(self, client_id: int) -> List[Dict]:
+    def _get_overdue_invoices(self, client_ids: List[int]) -> Dict[int, List[Dict]]:
         """
-        Obtiene facturas vencidas de un cliente
+        Obtiene las facturas vencidas de varios clientes en una consulta, agrupadas por cliente
         """
         try:
-            overdue_invoices = self.db.query(Factura).filter(
-                Factura.cliente_id == client_id,
-                Factura.estado.in_(["Vencida", "Parcial"]),
-                Factura.fecha_vencimiento < datetime.now().date()
-            ).all()
-
-            result = []
+            today = datetime.now().date()
+            overdue_invoices = []
+            for start in range(0, len(client_ids), ID_BATCH_SIZE):
+                overdue_invoices.extend(self.db.query(Factura).filter(
+                    Factura.cliente_id.in_(client_ids[start:start + ID_BATCH_SIZE]),
+                    Factura.estado.in_(OVERDUE_STATES),
+                    Factura.fecha_vencimiento < today
+                ).all())
+
+            result = {}
             for invoice in overdue_invoices:
-                days_overdue = (datetime.now().date() - invoice.fecha_vencimiento).days
-                pendiente = invoice.monto_total - invoice.monto_pagado
-
-                result.append({
+                result.setdefault(invoice.cliente_id, []).append({
                     "numero_factura": invoice.numero_factura,
                     "monto_total": invoice.monto_total,
-                    "monto_pendiente": pendiente,
-                    "dias_vencida": days_overdue,
+                    "monto_pendiente": invoice.monto_total - (invoice.monto_pagado or 0.0),
+                    "dias_vencida": (today - invoice.fecha_vencimiento).days,
                     "fecha_vencimiento": str(invoice.fecha_vencimiento)
                 })
 
@@ -262,25 +372,14 @@ class PrescriptiveAdvisor:
 
         except Exception as e:
             logger.error(f"Error obteniendo facturas vencidas: {str(e)}")
-            return []
+            return {}
 
     def generate_sales_team_recommendations(self) -> Dict:
         """
         Genera recomendaciones para el equipo de ventas
         """
         try:
-            recommendations = []
-
-            # Analizar vendedores con bajo rendimiento
-            sellers = self.db.query(Vendedor).filter(Vendedor.activo == 1).all()
-
-            for seller in sellers:
-                seller_recs = self._analyze_seller_performance(seller)
-                recommendations.extend(seller_recs)
-
-            # Recomendaciones generales del equipo
-            team_recs = self._analyze_team_performance()
-            recommendations.extend(team_recs)
+            recommendations = self._collect_sales_team_recommendations()
 
             # Filtrar por rol
             filtered_recs = self._filter_recommendations_by_role(recommendations)
@@ -298,32 +397,73 @@ class PrescriptiveAdvisor:
             logger.error(f"Error generando recomendaciones de ventas: {str(e)}")
             return {"success": False, "error": str(e)}
 
-    def _analyze_seller_performance(self, seller: Vendedor) -> List[Dict]:
+    def _collect_sales_team_recommendations(self) -> List[Dict]:
         """
-        Analiza el rendimiento de un vendedor y genera recomendaciones
+        Recomendaciones de vendedores y del equipo, sin filtrar por rol
         """
-        recommendations = []
+        sellers = self._load_seller_frame()
 
-        try:
-            # Obtener actividades recientes (último mes)
-            cutoff_date = datetime.now() - timedelta(days=30)
-            recent_activities = self.db.query(ActividadVenta).filter(
-                ActividadVenta.vendedor_id == seller.id,
-                ActividadVenta.fecha >= cutoff_date
-            ).all()
+        # Analizar vendedores con bajo rendimiento
+        recommendations = self._evaluate_seller_rules(sellers)
+
+        # Recomendaciones generales del equipo
+        recommendations.extend(self._analyze_team_performance(sellers))
+
+        return recommendations
 
-            # Calcular métricas
-            total_activities = len(recent_activities)
-            activities_with_value = len([a for a in recent_activities if a.monto_estimado and a.monto_estimado > 0])
+    def _load_seller_frame(self) -> pd.DataFrame:
+        """
+        Carga en un DataFrame las métricas de todos los vendedores activos: actividades del
+        último mes (totales y con monto), clientes asignados y clientes ganados.
+        El número de consultas no depende del tamaño del equipo.
+        """
+        sellers = pd.DataFrame(self.db.query(
+            Vendedor.id, Vendedor.nombre, Vendedor.meta_mensual
+        ).filter(Vendedor.activo == 1).order_by(Vendedor.id).all(),
+            columns=['seller_id', 'seller_name', 'meta_mensual'])
+
+        cutoff_date = datetime.now() - timedelta(days=SELLER_ACTIVITY_DAYS)
+        activities = pd.DataFrame(self.db.query(
+            ActividadVenta.vendedor_id,
+            func.count(ActividadVenta.id),
+            func.count(ActividadVenta.id).filter(ActividadVenta.monto_estimado > 0)
+        ).filter(
+            ActividadVenta.fecha >= cutoff_date
+        ).group_by(ActividadVenta.vendedor_id).all(),
+            columns=['seller_id', 'activity_count', 'valued_activity_count'])
+
+        clients = pd.DataFrame(self.db.query(
+            Cliente.vendedor_id,
+            func.count(Cliente.id),
+            func.count(Cliente.id).filter(Cliente.estado_funnel == EstadoFunnelEnum.ganado)
+        ).filter(
+            Cliente.vendedor_id.isnot(None)
+        ).group_by(Cliente.vendedor_id).all(),
+            columns=['seller_id', 'client_count', 'won_clients'])
+
+        sellers = sellers.merge(activities, on='seller_id', how='left')
+        sellers = sellers.merge(clients, on='seller_id', how='left')
+        count_columns = ['activity_count', 'valued_activity_count', 'client_count', 'won_clients']
+        sellers[count_columns] = sellers[count_columns].fillna(0).astype(int)
+        sellers['meta_mensual'] = sellers['meta_mensual'].fillna(0.0)
+
+        return sellers[SELLER_FRAME_COLUMNS]
+
+    def _evaluate_seller_rules(self, sellers: pd.DataFrame) -> List[Dict]:
+        """
+        Evalúa las reglas de rendimiento sobre el frame de vendedores
+        """
+        recommendations = []
 
-            if total_activities < 5:
+        for seller in sellers.itertuples(index=False):
+            if seller.activity_count < 5:
                 recommendations.append({
                     "type": "activity_increase",
                     "priority": "high",
-                    "seller_id": seller.id,
-                    "seller_name": seller.nombre,
+                    "seller_id": int(seller.seller_id),
+                    "seller_name": seller.seller_name,
                     "title": "Baja actividad comercial",
-                    "description": f"El vendedor {seller.nombre} ha realizado solo {total_activities} actividades en el último mes",
+                    "description": f"El vendedor {seller.seller_name} ha realizado solo {seller.activity_count} actividades en el último mes",
                     "action": "Aumentar frecuencia de contacto con clientes (meta: 15 actividades/mes)",
                     "impact_score": 8.0,
                     "category": "productividad",
@@ -331,54 +471,43 @@ class PrescriptiveAdvisor:
                 })
 
             # Analizar conversión de oportunidades
-            seller_clients = self.db.query(Cliente).filter(Cliente.vendedor_id == seller.id).all()
-            won_clients = len([c for c in seller_clients if c.estado_funnel.value == "Ganado"])
-            total_opportunities = len(seller_clients)
-
-            if total_opportunities > 0:
-                conversion_rate = won_clients / total_opportunities
+            if seller.client_count > 0:
+                conversion_rate = seller.won_clients / seller.client_count
 
                 if conversion_rate < 0.2:
                     recommendations.append({
                         "type": "conversion_improvement",
                         "priority": "high",
-                        "seller_id": seller.id,
-                        "seller_name": seller.nombre,
+                        "seller_id": int(seller.seller_id),
+                        "seller_name": seller.seller_name,
                         "title": "Baja tasa de conversión",
-                        "description": f"Tasa de conversión: {conversion_rate:.1%} ({won_clients}/{total_opportunities} oportunidades)",
+                        "description": f"Tasa de conversión: {conversion_rate:.1%} ({seller.won_clients}/{seller.client_count} oportunidades)",
                         "action": "Capacitación en técnicas de cierre y calificación de prospectos",
                         "impact_score": 8.5,
                         "category": "habilidades",
                         "suggested_by": "PA"
                     })
 
-        except Exception as e:
-            logger.error(f"Error analizando vendedor {seller.id}: {str(e)}")
-
         return recommendations
 
-    def _analyze_team_performance(self) -> List[Dict]:
+    def _analyze_team_performance(self, sellers: pd.DataFrame) -> List[Dict]:
         """
-        Analiza el rendimiento general del equipo de ventas
+        Analiza el rendimiento general del equipo de ventas a partir del frame de vendedores
         """
         recommendations = []
 
         try:
             # Análisis de ventas mensuales
             current_month = datetime.now().replace(day=1)
-            monthly_sales = self.db.query(
-                Factura.fecha_emision,
-                Factura.monto_total
+            total_monthly_sales = self.db.query(
+                func.coalesce(func.sum(Factura.monto_total), 0.0)
             ).filter(
-                Factura.estado == "Pagada",
+                Factura.estado == EstadoFacturaEnum.pagada,
                 Factura.fecha_emision >= current_month
-            ).all()
-
-            total_monthly_sales = sum(sale[1] for sale in monthly_sales)
+            ).scalar()
 
             # Meta mensual estimada (suma de metas de vendedores activos)
-            sellers = self.db.query(Vendedor).filter(Vendedor.activo == 1).all()
-            total_team_target = sum(seller.meta_mensual for seller in sellers)
+            total_team_target = sellers['meta_mensual'].sum()
 
             if total_team_target > 0:
                 achievement_rate = total_monthly_sales / total_team_target
@@ -396,14 +525,11 @@ class PrescriptiveAdvisor:
                     })
 
             # Análisis de distribución de carga de trabajo
-            client_distribution = {}
-            for seller in sellers:
-                client_count = self.db.query(Cliente).filter(Cliente.vendedor_id == seller.id).count()
-                client_distribution[seller.nombre] = client_count
-
-            if client_distribution:
-                avg_clients = sum(client_distribution.values()) / len(client_distribution)
-                overloaded_sellers = [name for name, count in client_distribution.items() if count > avg_clients * 1.5]
+            if not sellers.empty:
+                avg_clients = sellers['client_count'].mean()
+                overloaded_sellers = sellers.loc[
+                    sellers['client_count'] > avg_clients * 1.5, 'seller_name'
+                ].tolist()
 
                 if overloaded_sellers:
                     recommendations.append({
@@ -452,19 +578,25 @@ class PrescriptiveAdvisor:
 
     def _analyze_cash_flow(self) -> List[Dict]:
         """
-        Analiza el flujo de caja y genera recomendaciones
+        Analiza el flujo de caja de los últimos 30 días con un único agregado por tipo y categoría
         """
         recommendations = []
 
         try:
-            # Obtener movimientos de caja de los últimos 30 días
             cutoff_date = datetime.now() - timedelta(days=30)
-            movements = self.db.query(MovimientoCaja).filter(
+            totals = pd.DataFrame(self.db.query(
+                MovimientoCaja.tipo,
+                func.coalesce(MovimientoCaja.categoria, "Sin categorizar"),
+                func.sum(MovimientoCaja.monto)
+            ).filter(
                 MovimientoCaja.fecha >= cutoff_date
-            ).all()
+            ).group_by(
+                MovimientoCaja.tipo, func.coalesce(MovimientoCaja.categoria, "Sin categorizar")
+            ).all(), columns=['tipo', 'categoria', 'monto'])
 
-            total_income = sum(m.monto for m in movements if m.tipo == "Ingreso")
-            total_expenses = sum(m.monto for m in movements if m.tipo == "Egreso")
+            total_income = totals.loc[totals['tipo'] == "Ingreso", 'monto'].sum()
+            expenses_by_category = totals[totals['tipo'] == "Egreso"].groupby('categoria')['monto'].sum()
+            total_expenses = expenses_by_category.sum()
 
             net_flow = total_income - total_expenses
 
@@ -480,13 +612,6 @@ class PrescriptiveAdvisor:
                     "suggested_by": "PA"
                 })
 
-            # Analizar gastos por categoría
-            expenses_by_category = {}
-            for movement in movements:
-                if movement.tipo == "Egreso":
-                    category = movement.categoria or "Sin categorizar"
-                    expenses_by_category[category] = expenses_by_category.get(category, 0) + movement.monto
-
             # Identificar categorías con gastos altos
             for category, amount in expenses_by_category.items():
                 if amount > total_expenses * 0.3:  # Más del 30% del total
@@ -498,6 +623,7 @@ class PrescriptiveAdvisor:
                         "action": "Revisar y optimizar gastos en esta categoría",
                         "impact_score": 6.5,
                         "category": "costos",
+                        "subject": category,
                         "suggested_by": "PA"
                     })
 
@@ -508,23 +634,29 @@ class PrescriptiveAdvisor:
 
     def _analyze_accounts_receivable(self) -> List[Dict]:
         """
-        Analiza cuentas por cobrar y genera recomendaciones
+        Analiza cuentas por cobrar con agregados por tramo de antigüedad y por cliente
         """
         recommendations = []
 
         try:
-            # Obtener facturas pendientes
-            pending_invoices = self.db.query(Factura).filter(
-                Factura.estado.in_(["Pendiente", "Parcial"])
-            ).all()
+            today = datetime.now().date()
+            outstanding = Factura.monto_total - func.coalesce(Factura.monto_pagado, 0.0)
+
+            # Tramo de antigüedad según fecha de vencimiento, comparando contra fechas de corte
+            aging_bucket = case(
+                *[(Factura.fecha_vencimiento <= today - timedelta(days=min_days), label)
+                  for label, min_days in AGING_BUCKETS],
+                else_='current'
+            )
 
-            total_pending = sum(inv.monto_total - inv.monto_pagado for inv in pending_invoices)
+            aging = dict((bucket, (count, amount)) for bucket, count, amount in self.db.query(
+                aging_bucket, func.count(Factura.id), func.sum(outstanding)
+            ).filter(
+                Factura.estado.in_(RECEIVABLE_STATES)
+            ).group_by(aging_bucket).all())
 
-            # Facturas por antigüedad
-            current = len([inv for inv in pending_invoices if (datetime.now().date() - inv.fecha_vencimiento).days <= 0])
-            overdue_1_30 = len([inv for inv in pending_invoices if 0 < (datetime.now().date() - inv.fecha_vencimiento).days <= 30])
-            overdue_31_60 = len([inv for inv in pending_invoices if 30 < (datetime.now().date() - inv.fecha_vencimiento).days <= 60])
-            overdue_60_plus = len([inv for inv in pending_invoices if (datetime.now().date() - inv.fecha_vencimiento).days > 60])
+            total_pending = sum(amount or 0 for _, amount in aging.values())
+            overdue_60_plus = aging.get('overdue_60_plus', (0, 0))[0]
 
             if overdue_60_plus > 0:
                 recommendations.append({
@@ -538,23 +670,21 @@ class PrescriptiveAdvisor:
                     "suggested_by": "PA"
                 })
 
-            # Análisis de concentración de riesgo
-            client_debt = {}
-            for invoice in pending_invoices:
-                if invoice.cliente:
-                    client_name = invoice.cliente.nombre
-                    debt = invoice.monto_total - invoice.monto_pagado
-                    client_debt[client_name] = client_debt.get(client_name, 0) + debt
-
-            # Clientes con mayor deuda pendiente
-            top_debtors = sorted(client_debt.items(), key=lambda x: x[1], reverse=True)[:3]
+            # Análisis de concentración de riesgo: cliente con mayor deuda pendiente
+            top_debtor = self.db.query(
+                Cliente.nombre, func.sum(outstanding).label('debt')
+            ).join(
+                Cliente, Factura.cliente_id == Cliente.id
+            ).filter(
+                Factura.estado.in_(RECEIVABLE_STATES)
+            ).group_by(Cliente.id, Cliente.nombre).order_by(func.sum(outstanding).desc()).first()
 
-            if top_debtors and top_debtors[0][1] > total_pending * 0.2:  # Más del 20% del total
+            if top_debtor and top_debtor.debt > total_pending * 0.2:  # Más del 20% del total
                 recommendations.append({
                     "type": "concentration_risk",
                     "priority": "medium",
                     "title": "Concentración de riesgo en clientes",
-                    "description": f"El cliente {top_debtors[0][0]} representa ${top_debtors[0][1]:,.0f} de deuda pendiente",
+                    "description": f"El cliente {top_debtor.nombre} representa ${top_debtor.debt:,.0f} de deuda pendiente",
                     "action": "Diversificar cartera de clientes y monitorear concentración",
                     "impact_score": 7.0,
                     "category": "riesgo",
@@ -566,53 +696,377 @@ class PrescriptiveAdvisor:
 
         return recommendations
 
-    def get_recommendations_summary(self, category: str = None, priority: str = None) -> Dict:
+    def refresh_recommendation_store(self, full: bool = False) -> Dict:
         """
-        Obtiene un resumen de todas las recomendaciones activas
+        Regenera las recomendaciones almacenadas de forma incremental.
+
+        Solo se cargan los clientes con datos de entrada escritos desde la regeneración
+        anterior (cliente o facturas modificados, facturas que vencieron o predicciones
+        nuevas), filtrados en SQL por updated_at. De ellos se reevalúan los que cambiaron
+        la huella de sus datos de entrada. Las recomendaciones de equipo y finanzas son
+        agregados globales y se recalculan siempre. Las filas se insertan, actualizan o
+        eliminan por diferencia, conservando el estado que haya asignado el usuario.
+
+        Args:
+            full: Cargar todos los clientes (p.ej. tras eliminar facturas, que no dejan rastro)
         """
         try:
-            # En un sistema real, las recomendaciones se almacenarían en BD
-            # Por ahora, generamos recomendaciones frescas
+            start_time = datetime.now()
+            refresh_started = datetime.utcnow()
+            results = {}
+
+            # Clientes: solo los que cambiaron desde la regeneración anterior
+            last_refresh = None if full else self.db.query(RecommendationWatermark.updated_at).filter(
+                RecommendationWatermark.entity_type == CLIENT_REFRESH_MARK
+            ).scalar()
+            if last_refresh is None:
+                candidate_ids = None
+                clients = self._load_client_frame(restrict_to_seller=False)
+            else:
+                candidate_ids = self._changed_client_ids(last_refresh - REFRESH_OVERLAP)
+                clients = pd.concat([
+                    self._load_client_frame(candidate_ids[start:start + ID_BATCH_SIZE], restrict_to_seller=False)
+                    for start in range(0, len(candidate_ids), ID_BATCH_SIZE)
+                ] or [pd.DataFrame(columns=CLIENT_FRAME_COLUMNS)], ignore_index=True)
+
+            clients['input_hash'] = pd.util.hash_pandas_object(
+                clients[CLIENT_INPUT_COLUMNS], index=False
+            ).astype(str)
+
+            stored_query = self.db.query(
+                RecommendationWatermark.entity_id,
+                RecommendationWatermark.input_hash
+            ).filter(RecommendationWatermark.entity_type == "cliente")
+            if candidate_ids is None:
+                stored_hashes = dict(stored_query.all())
+                removed_ids = list(set(stored_hashes) - set(clients['client_id']))
+            else:
+                stored_hashes = {}
+                for start in range(0, len(candidate_ids), ID_BATCH_SIZE):
+                    stored_hashes.update(stored_query.filter(
+                        RecommendationWatermark.entity_id.in_(candidate_ids[start:start + ID_BATCH_SIZE])
+                    ).all())
+                removed_ids = [entity_id for (entity_id,) in stored_query.with_entities(
+                    RecommendationWatermark.entity_id
+                ).filter(RecommendationWatermark.entity_id.notin_(select(Cliente.id))).all()]
+
+            changed = clients[clients['input_hash'] != clients['client_id'].map(stored_hashes)]
+            scope_ids = changed['client_id'].tolist() + removed_ids
+
+            ranking = self._evaluate_client_rules(changed)
+            client_recs = self._build_client_recommendations(ranking, changed)
+            for rec in client_recs:
+                rec['entity_type'], rec['entity_id'] = "cliente", rec['client_id']
+
+            results['clientes'] = self._sync_recommendations(["cliente"], client_recs, entity_ids=scope_ids)
+            self._save_watermarks("cliente", dict(zip(changed['client_id'], changed['input_hash'])), scope_ids)
+            self._save_watermarks(CLIENT_REFRESH_MARK, {0: "-"}, [0], updated_at=refresh_started)
+            results['clientes'].update({
+                "clients_total": self.db.query(func.count(Cliente.id)).scalar(),
+                "clients_loaded": len(clients),
+                "clients_reevaluated": len(changed)
+            })
+
+            # Equipo de ventas y finanzas: agregados globales
+            sales_recs = self._collect_sales_team_recommendations()
+            for rec in sales_recs:
+                if rec.get('seller_id'):
+                    rec['entity_type'], rec['entity_id'] = "vendedor", rec['seller_id']
+                else:
+                    rec['entity_type'], rec['entity_id'] = "equipo", 0
+            results['ventas'] = self._sync_recommendations(["vendedor", "equipo"], sales_recs)
+
+            finance_recs = self._analyze_cash_flow() + self._analyze_accounts_receivable()
+            for rec in finance_recs:
+                rec['entity_type'], rec['entity_id'] = "finanzas", 0
+            results['finanzas'] = self._sync_recommendations(["finanzas"], finance_recs)
+
+            # Las recomendaciones vigentes que no cambiaron siguen válidas: renovar su vencimiento
+            self.db.query(Recommendation).update(
+                {Recommendation.expires_at: start_time + timedelta(days=RECOMMENDATION_TTL_DAYS)},
+                synchronize_session=False
+            )
+            self.db.commit()
 
-            all_recommendations = []
+            return {
+                "success": True,
+                "results": results,
+                "execution_time_seconds": (datetime.now() - start_time).total_seconds()
+            }
 
-            # Generar recomendaciones de diferentes áreas
-            client_recs = self.generate_client_recommendations(limit=20)
-            if client_recs["success"]:
-                all_recommendations.extend(client_recs["recommendations"])
+        except Exception as e:
+            self.db.rollback()
+            logger.error(f"Error regenerando recomendaciones almacenadas: {str(e)}")
+            return {"success": False, "error": str(e)}
 
-            sales_recs = self.generate_sales_team_recommendations()
-            if sales_recs["success"]:
-                all_recommendations.extend(sales_recs["recommendations"])
+    def _changed_client_ids(self, since: datetime) -> List[int]:
+        """
+        Clientes cuyos datos de entrada pudieron cambiar desde `since` (UTC): el cliente o
+        alguna de sus facturas se escribió, una factura impaga venció o hay predicciones
+        nuevas. Las filas sin updated_at (escritas fuera del ORM) se incluyen siempre.
+        """
+        today = datetime.now().date()
+        changed = union(
+            select(Cliente.id).where(or_(Cliente.updated_at.is_(None), Cliente.updated_at >= since)),
+            select(Factura.cliente_id).where(
+                Factura.cliente_id.isnot(None),
+                or_(Factura.updated_at.is_(None), Factura.updated_at >= since)
+            ),
+            select(Factura.cliente_id).where(
+                Factura.cliente_id.isnot(None),
+                Factura.estado.in_(OVERDUE_STATES),
+                Factura.fecha_vencimiento >= since.date() - timedelta(days=1),
+                Factura.fecha_vencimiento < today
+            ),
+            select(ModelPrediction.entity_id).where(
+                ModelPrediction.entity_type == "cliente",
+                ModelPrediction.prediction_type.in_(CLIENT_PREDICTION_TYPES),
+                ModelPrediction.created_at >= since
+            )
+        ).subquery()
+        return sorted(
+            client_id for (client_id,) in self.db.query(Cliente.id).filter(Cliente.id.in_(select(changed))).all()
+        )
+
+    def _sync_recommendations(self, entity_types: List[str], recommendations: List[Dict],
+                              entity_ids: List[int] = None) -> Dict:
+        """
+        Sincroniza las recomendaciones almacenadas del alcance (tipos de entidad y, opcionalmente,
+        entidades) con las recién generadas: inserta las nuevas, actualiza las existentes y
+        elimina las que ya no aplican
+        """
+        existing_query = self.db.query(
+            Recommendation.id, Recommendation.entity_type, Recommendation.entity_id, Recommendation.rec_type
+        ).filter(Recommendation.entity_type.in_(entity_types))
+
+        if entity_ids is None:
+            existing_rows = existing_query.all()
+        else:
+            existing_rows = []
+            for start in range(0, len(entity_ids), ID_BATCH_SIZE):
+                existing_rows.extend(existing_query.filter(
+                    Recommendation.entity_id.in_(entity_ids[start:start + ID_BATCH_SIZE])
+                ).all())
+
+        existing = {(row.entity_type, row.entity_id, row.rec_type): row.id for row in existing_rows}
+
+        now = datetime.now()
+        expires_at = now + timedelta(days=RECOMMENDATION_TTL_DAYS)
+        inserts, updates, seen = [], [], set()
+
+        for rec in recommendations:
+            # Tipos que se repiten por entidad (p.ej. una categoría de gasto) se distinguen por su sujeto
+            rec_type = f"{rec['type']}:{rec['subject']}"[:50] if rec.get('subject') else rec['type']
+            key = (rec['entity_type'], int(rec['entity_id']), rec_type)
+            if key in seen:
+                continue
+            seen.add(key)
+
+            values = {
+                "category": rec.get('category'),
+                "priority": rec.get('priority', 'medium'),
+                "title": rec['title'],
+                "description": rec.get('description'),
+                "action": rec.get('action'),
+                "impact_score": rec.get('impact_score', 0.0),
+                "details": json.dumps(rec['details'], default=str) if rec.get('details') else None,
+                "updated_at": now,
+                "expires_at": expires_at
+            }
+
+            if key in existing:
+                updates.append({"id": existing[key], **values})
+            else:
+                inserts.append({
+                    "entity_type": key[0], "entity_id": key[1], "rec_type": key[2],
+                    "status": "open", "generated_at": now, **values
+                })
 
-            finance_recs = self.generate_finance_recommendations()
-            if finance_recs["success"]:
-                all_recommendations.extend(finance_recs["recommendations"])
+        deleted_ids = [rec_id for key, rec_id in existing.items() if key not in seen]
 
-            # Filtrar por categoría y prioridad
-            if category:
-                all_recommendations = [r for r in all_recommendations if r.get("category") == category]
+        if inserts:
+            self.db.execute(insert(Recommendation), inserts)
+        if updates:
+            self.db.execute(update(Recommendation), updates)
+        for start in range(0, len(deleted_ids), ID_BATCH_SIZE):
+            self.db.query(Recommendation).filter(
+                Recommendation.id.in_(deleted_ids[start:start + ID_BATCH_SIZE])
+            ).delete(synchronize_session=False)
 
-            if priority:
-                all_recommendations = [r for r in all_recommendations if r.get("priority") == priority]
+        self.db.commit()
+
+        return {"inserted": len(inserts), "updated": len(updates), "deleted": len(deleted_ids)}
+
+    def _save_watermarks(self, entity_type: str, hashes: Dict[int, str], scope_ids: List[int],
+                         updated_at: Optional[datetime] = None):
+        """
+        Reemplaza la huella de entrada de las entidades del alcance
+        """
+        for start in range(0, len(scope_ids), ID_BATCH_SIZE):
+            self.db.query(RecommendationWatermark).filter(
+                RecommendationWatermark.entity_type == entity_type,
+                RecommendationWatermark.entity_id.in_(scope_ids[start:start + ID_BATCH_SIZE])
+            ).delete(synchronize_session=False)
+
+        if hashes:
+            now = updated_at or datetime.utcnow()
+            self.db.execute(insert(RecommendationWatermark), [{
+                "entity_type": entity_type,
+                "entity_id": int(entity_id),
+                "input_hash": input_hash,
+                "updated_at": now
+            } for entity_id, input_hash in hashes.items()])
+
+        self.db.commit()
+
+    def get_stored_recommendations(self, entity_types: List[str] = None, category: str = None,
+                                   priority: str = None, status: str = "open",
+                                   page: int = 1, page_size: int = 50) -> Dict:
+        """
+        Lee las recomendaciones precalculadas, filtradas por rol y ordenadas por impacto
+        """
+        try:
+            self._ensure_store_populated()
+            query = self._stored_recommendations_query(entity_types, category, priority, status)
+
+            total = query.count()
+            page = max(1, page)
+            rows = query.order_by(
+                Recommendation.impact_score.desc(), Recommendation.id
+            ).offset((page - 1) * page_size).limit(page_size).all()
+
+            return {
+                "success": True,
+                "recommendations": [self._stored_recommendation_to_dict(row) for row in rows],
+                "total_generated": total,
+                "page": page,
+                "page_size": page_size,
+                "total_pages": math.ceil(total / page_size) if page_size else 0
+            }
+
+        except Exception as e:
+            logger.error(f"Error obteniendo recomendaciones almacenadas: {str(e)}")
+            return {"success": False, "error": str(e)}
+
+    def _ensure_store_populated(self):
+        """Primera ejecución: poblar el almacén antes de leerlo"""
+        if not self.db.query(RecommendationWatermark.id).filter(
+            RecommendationWatermark.entity_type == CLIENT_REFRESH_MARK
+        ).first():
+            self.refresh_recommendation_store()
+
+    def update_recommendation_status(self, recommendation_id: int, status: str) -> Dict:
+        """
+        Cambia el estado de una recomendación almacenada (p.ej. 'acknowledged', 'resolved')
+        """
+        if status not in RECOMMENDATION_STATUSES:
+            return {"success": False, "error": f"Estado inválido: {status}"}
+
+        try:
+            updated = self.db.query(Recommendation).filter(
+                Recommendation.id == recommendation_id
+            ).update({Recommendation.status: status, Recommendation.updated_at: datetime.now()},
+                     synchronize_session=False)
+            self.db.commit()
+
+            if not updated:
+                return {"success": False, "error": f"Recomendación {recommendation_id} no encontrada"}
+            return {"success": True, "recommendation_id": recommendation_id, "status": status}
+
+        except Exception as e:
+            self.db.rollback()
+            logger.error(f"Error actualizando recomendación {recommendation_id}: {str(e)}")
+            return {"success": False, "error": str(e)}
+
+    def _stored_recommendations_query(self, entity_types: List[str] = None, category: str = None,
+                                      priority: str = None, status: str = "open"):
+        """Consulta base de recomendaciones almacenadas vigentes y visibles para el rol"""
+        query = self.db.query(Recommendation).filter(
+            (Recommendation.expires_at.is_(None)) | (Recommendation.expires_at > datetime.now())
+        )
+
+        if status:
+            query = query.filter(Recommendation.status == status)
+        if entity_types:
+            query = query.filter(Recommendation.entity_type.in_(entity_types))
+        if category:
+            query = query.filter(Recommendation.category == category)
+        if priority:
+            query = query.filter(Recommendation.priority == priority)
+
+        allowed_categories = self._allowed_categories()
+        if allowed_categories is not None:
+            query = query.filter(Recommendation.category.in_(allowed_categories))
+
+        if self.user and self.user.get('rol') == 'ventas':
+            # Vendedores: solo sus clientes además de las recomendaciones no asociadas a clientes
+            vendedor = self.db.query(Vendedor).filter(Vendedor.email == self.user.get('email')).first()
+            own_clients = self.db.query(Cliente.id).filter(
+                Cliente.vendedor_id == (vendedor.id if vendedor else None)
+            )
+            query = query.filter(
+                (Recommendation.entity_type != "cliente") | (Recommendation.entity_id.in_(own_clients))
+            )
+
+        return query
+
+    def _stored_recommendation_to_dict(self, row: Recommendation) -> Dict:
+        """Serializa una recomendación almacenada con el formato de las generadas"""
+        rec = {
+            "id": row.id,
+            "type": row.rec_type.split(":", 1)[0],
+            "priority": row.priority,
+            "title": row.title,
+            "description": row.description,
+            "action": row.action,
+            "impact_score": row.impact_score,
+            "category": row.category,
+            "status": row.status,
+            "entity_type": row.entity_type,
+            "entity_id": row.entity_id,
+            "generated_at": str(row.generated_at),
+            "suggested_by": "PA"
+        }
+        if row.entity_type == "cliente":
+            rec["client_id"] = row.entity_id
+        elif row.entity_type == "vendedor":
+            rec["seller_id"] = row.entity_id
+        if row.details:
+            rec["details"] = json.loads(row.details)
+        return rec
+
+    def get_recommendations_summary(self, category: str = None, priority: str = None) -> Dict:
+        """
+        Obtiene un resumen de todas las recomendaciones activas desde el almacén precalculado
+        """
+        try:
+            self._ensure_store_populated()
+
+            query = self._stored_recommendations_query(category=category, priority=priority)
 
             # Agrupar por tipo
             by_type = {}
-            by_priority = {"high": 0, "medium": 0, "low": 0, "critical": 0}
+            for rec_type, count in query.with_entities(
+                Recommendation.rec_type, func.count(Recommendation.id)
+            ).group_by(Recommendation.rec_type).all():
+                base_type = rec_type.split(":", 1)[0]
+                by_type[base_type] = by_type.get(base_type, 0) + count
 
-            for rec in all_recommendations:
-                rec_type = rec.get("type", "unknown")
-                by_type[rec_type] = by_type.get(rec_type, 0) + 1
+            by_priority = {"high": 0, "medium": 0, "low": 0, "critical": 0}
+            by_priority.update(dict(query.with_entities(
+                Recommendation.priority, func.count(Recommendation.id)
+            ).group_by(Recommendation.priority).all()))
 
-                priority_level = rec.get("priority", "medium")
-                by_priority[priority_level] += 1
+            top_rows = query.order_by(
+                Recommendation.impact_score.desc(), Recommendation.id
+            ).limit(10).all()
 
             return {
                 "success": True,
-                "total_recommendations": len(all_recommendations),
+                "total_recommendations": sum(by_type.values()),
                 "by_type": by_type,
                 "by_priority": by_priority,
-                "top_recommendations": all_recommendations[:10]
+                "top_recommendations": [self._stored_recommendation_to_dict(row) for row in top_rows]
             }
 
         except Exception as e:
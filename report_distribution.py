@@ -0,0 +1,339 @@
+"""
+Report Distribution - Agente 5 (ARD)
+Envío asíncrono de reportes por email y webhooks. Los emails se reparten entre unas pocas
+conexiones SMTP reutilizadas (una por worker), con límite de envíos por segundo y reintentos
+con backoff. Para pruebas sin red, el sink 'file' escribe los mensajes como .eml y el sink
+'debug' los envía a un servidor SMTP local sin autenticación.
+"""
+
+import asyncio
+import os
+import random
+import smtplib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email import encoders
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import formatdate, make_msgid
+from typing import Dict, List, Optional
+
+import requests
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Destino de los emails: 'smtp' (servidor configurado), 'file' (.eml en disco) o 'debug'
+# (servidor SMTP local sin TLS ni login, p.ej. `python -m aiosmtpd -n -l localhost:1025`)
+REPORT_MAIL_SINK = os.getenv('REPORT_MAIL_SINK', 'smtp')
+REPORT_MAIL_SINK_DIR = os.getenv('REPORT_MAIL_SINK_DIR', 'generated_reports/outbox')
+REPORT_DEBUG_SMTP_PORT = int(os.getenv('REPORT_DEBUG_SMTP_PORT', '1025'))
+# Conexiones SMTP simultáneas (cada una envía muchos mensajes con un solo handshake)
+REPORT_SMTP_CONNECTIONS = int(os.getenv('REPORT_SMTP_CONNECTIONS', '4'))
+# Emails por segundo en total (0 = sin límite)
+REPORT_SEND_RATE = float(os.getenv('REPORT_SEND_RATE_PER_SECOND', '10'))
+REPORT_SEND_RETRIES = int(os.getenv('REPORT_SEND_RETRIES', '3'))
+REPORT_SEND_BACKOFF = float(os.getenv('REPORT_SEND_BACKOFF_SECONDS', '1.0'))
+REPORT_WEBHOOK_TIMEOUT = float(os.getenv('REPORT_WEBHOOK_TIMEOUT_SECONDS', '10'))
+# Adjuntos más grandes no se envían por email (el reporte queda en el servidor)
+REPORT_MAX_ATTACHMENT_BYTES = int(os.getenv('REPORT_MAX_ATTACHMENT_MB', '20')) * 1024 * 1024
+
+
+class PermanentDeliveryError(Exception):
+    """El destino rechazó el envío de forma definitiva; no se reintenta"""
+
+
+class SmtpAuthenticationError(Exception):
+    """El servidor SMTP rechazó las credenciales: se aborta toda la distribución de emails"""
+
+
+class RateLimiter:
+    """Token bucket asíncrono compartido por todos los workers de una distribución"""
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.capacity = burst or max(rate, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class SmtpTransport:
+    """
+    Conexión SMTP de un worker: se abre en el primer envío y se reutiliza para los siguientes;
+    si el servidor la cierra, se reconecta en el próximo intento
+    """
+
+    def __init__(self, server: str, port: int, username: str = '', password: str = '', use_tls: bool = True):
+        self.server = server
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self._smtp: Optional[smtplib.SMTP] = None
+        self.connections_opened = 0
+
+    def send(self, sender: str, recipient: str, message: bytes):
+        if self._smtp is None:
+            self._connect()
+        try:
+            self._smtp.sendmail(sender, [recipient], message)
+        except smtplib.SMTPRecipientsRefused as e:
+            code, reply = e.recipients[recipient]
+            if 500 <= code < 600:
+                raise PermanentDeliveryError(f"{code} {reply!r}")
+            raise
+        except smtplib.SMTPResponseException as e:
+            if 500 <= e.smtp_code < 600:
+                raise PermanentDeliveryError(f"{e.smtp_code} {e.smtp_error!r}")
+            self.close()
+            raise
+        except (smtplib.SMTPServerDisconnected, OSError):
+            self._smtp = None
+            raise
+
+    def _connect(self):
+        smtp = smtplib.SMTP(self.server, self.port, timeout=30)
+        try:
+            if self.use_tls:
+                smtp.starttls()
+            if self.username and self.password:
+                smtp.login(self.username, self.password)
+        except smtplib.SMTPAuthenticationError as e:
+            smtp.close()
+            raise SmtpAuthenticationError(f"Autenticación SMTP rechazada: {e.smtp_code}")
+        except Exception:
+            smtp.close()
+            raise
+        self._smtp = smtp
+        self.connections_opened += 1
+
+    def close(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except Exception:
+                self._smtp.close()
+            self._smtp = None
+
+
+class FileTransport:
+    """Sink local: guarda cada mensaje como .eml en `directory`"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.connections_opened = 1
+        os.makedirs(directory, exist_ok=True)
+
+    def send(self, sender: str, recipient: str, message: bytes):
+        safe_recipient = ''.join(ch if ch.isalnum() or ch in '@._-' else '_' for ch in recipient)
+        path = os.path.join(self.directory, f"{time.strftime('%Y%m%d_%H%M%S')}_{time.time_ns()}_{safe_recipient}.eml")
+        with open(path, 'wb') as f:
+            f.write(message)
+
+    def close(self):
+        pass
+
+
+class ReportDistributor:
+    """
+    Distribuye reportes: `distribute` recibe varias entregas (un reporte con sus destinatarios
+    y webhooks) y las envía todas en una sola pasada concurrente, compartiendo las conexiones
+    SMTP y el límite de envíos.
+    """
+
+    def __init__(self, smtp_server: str = None, smtp_port: int = None, sender_email: str = None,
+                 sender_password: str = None, sink: str = REPORT_MAIL_SINK,
+                 connections: int = REPORT_SMTP_CONNECTIONS, rate: float = REPORT_SEND_RATE,
+                 retries: int = REPORT_SEND_RETRIES, backoff: float = REPORT_SEND_BACKOFF):
+        self.smtp_server = smtp_server or os.getenv('SMTP_SERVER', 'smtp.gmail.com')
+        self.smtp_port = smtp_port or int(os.getenv('SMTP_PORT', '587'))
+        self.sender_email = sender_email if sender_email is not None else os.getenv('SENDER_EMAIL', '')
+        self.sender_password = sender_password if sender_password is not None else os.getenv('SENDER_PASSWORD', '')
+        self.sink = sink
+        self.connections = connections
+        self.rate = rate
+        self.retries = retries
+        self.backoff = backoff
+
+    def is_email_configured(self) -> bool:
+        """Los sinks locales no requieren credenciales"""
+        if self.sink in ('file', 'debug'):
+            return True
+        return bool(self.sender_email and self.sender_password)
+
+    def distribute(self, deliveries: List[Dict]) -> List[Dict]:
+        """
+        Envía las entregas y retorna, por cada una, {'email': [...], 'webhooks': [...]}
+
+        Cada entrega: subject, body, recipients, attachment_path, attachment_name y mime_type
+        (opcionales los tres últimos) y webhooks [{'name', 'url', 'payload'}].
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self.distribute_async(deliveries))
+
+        # Llamado desde un event loop (asyncio.run no se puede anidar): correr en otro thread
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="report-distribution") as executor:
+            return executor.submit(asyncio.run, self.distribute_async(deliveries)).result()
+
+    async def distribute_async(self, deliveries: List[Dict]) -> List[Dict]:
+        # Un lugar fijo por webhook: los resultados quedan en el orden de la entrega
+        results = [{'email': [], 'webhooks': [None] * len(delivery.get('webhooks', []))}
+                   for delivery in deliveries]
+
+        queue: asyncio.Queue = asyncio.Queue()
+        for index, delivery in enumerate(deliveries):
+            if not delivery.get('recipients'):
+                continue
+            if not self.is_email_configured():
+                results[index]['email'] = [{'recipient': recipient, 'status': 'skipped',
+                                            'error': 'Email no configurado'}
+                                           for recipient in delivery['recipients']]
+                continue
+            template = self._message_template(delivery)
+            for recipient in delivery['recipients']:
+                queue.put_nowait((index, recipient, template))
+
+        limiter = RateLimiter(self.rate)
+        abort = asyncio.Event()
+        workers = min(self.connections, queue.qsize())
+        email_tasks = [asyncio.create_task(self._email_worker(queue, limiter, results, abort))
+                       for _ in range(workers)]
+        webhook_tasks = [
+            asyncio.create_task(self._send_webhook(index, slot, webhook, results))
+            for index, delivery in enumerate(deliveries)
+            for slot, webhook in enumerate(delivery.get('webhooks', []))
+        ]
+        connections = await asyncio.gather(*email_tasks)
+        await asyncio.gather(*webhook_tasks)
+        if email_tasks:
+            logger.info(f"Reportes distribuidos: {sum(len(result['email']) for result in results)} emails "
+                        f"por {sum(connections)} conexiones")
+        return results
+
+    async def _email_worker(self, queue: asyncio.Queue, limiter: RateLimiter, results: List[Dict],
+                            abort: asyncio.Event) -> int:
+        """
+        Envía mensajes de la cola por una única conexión del worker; retorna las conexiones
+        abiertas. Si el servidor rechaza las credenciales, marca `abort` y da por fallidos los
+        mensajes pendientes (los demás workers se detienen al verlo).
+        """
+        transport = self._transport()
+        try:
+            while not queue.empty() and not abort.is_set():
+                index, recipient, template = queue.get_nowait()
+                message = self._render_message(template, recipient)
+                try:
+                    outcome = await self._with_retries(
+                        lambda: asyncio.to_thread(transport.send, self._sender(), recipient, message), limiter
+                    )
+                except SmtpAuthenticationError as e:
+                    if not abort.is_set():
+                        abort.set()
+                        logger.error(f"Distribución de emails abortada: {str(e)}")
+                    failed = {'status': 'failed', 'attempts': 1, 'error': str(e)}
+                    results[index]['email'].append({'recipient': recipient, 'subject': template['subject'], **failed})
+                    while not queue.empty():
+                        index, recipient, template = queue.get_nowait()
+                        results[index]['email'].append({'recipient': recipient, 'subject': template['subject'],
+                                                        **failed, 'attempts': 0})
+                    break
+                results[index]['email'].append({'recipient': recipient, 'subject': template['subject'], **outcome})
+        finally:
+            await asyncio.to_thread(transport.close)
+        return transport.connections_opened
+
+    async def _send_webhook(self, index: int, slot: int, webhook: Dict, results: List[Dict]):
+        def post():
+            response = requests.post(webhook['url'], json=webhook['payload'], timeout=REPORT_WEBHOOK_TIMEOUT)
+            if response.status_code == 429 or response.status_code >= 500:
+                response.raise_for_status()
+            if response.status_code >= 400:
+                raise PermanentDeliveryError(f"HTTP {response.status_code}")
+
+        outcome = await self._with_retries(lambda: asyncio.to_thread(post))
+        results[index]['webhooks'][slot] = {'name': webhook.get('name', 'webhook'), **outcome}
+
+    async def _with_retries(self, send, limiter: Optional[RateLimiter] = None) -> Dict:
+        """Ejecuta un envío con reintentos y backoff exponencial con jitter"""
+        attempts = 0
+        while True:
+            attempts += 1
+            if limiter is not None:
+                await limiter.acquire()
+            try:
+                await send()
+                return {'status': 'sent', 'attempts': attempts}
+            except PermanentDeliveryError as e:
+                return {'status': 'failed', 'attempts': attempts, 'error': str(e)}
+            except SmtpAuthenticationError:
+                raise
+            except Exception as e:
+                if attempts > self.retries:
+                    return {'status': 'failed', 'attempts': attempts, 'error': str(e)}
+                delay = self.backoff * 2 ** (attempts - 1)
+                await asyncio.sleep(delay + random.uniform(0, delay / 2))
+
+    def _transport(self):
+        if self.sink == 'file':
+            return FileTransport(REPORT_MAIL_SINK_DIR)
+        if self.sink == 'debug':
+            return SmtpTransport('localhost', REPORT_DEBUG_SMTP_PORT, use_tls=False)
+        return SmtpTransport(self.smtp_server, self.smtp_port, self.sender_email, self.sender_password)
+
+    def _sender(self) -> str:
+        return self.sender_email or 'reportes@localhost'
+
+    def _message_template(self, delivery: Dict) -> Dict:
+        """
+        Partes comunes a todos los destinatarios: el adjunto se lee y codifica una sola vez
+        """
+        attachment = None
+        path = delivery.get('attachment_path')
+        body = delivery.get('body', '')
+        if path:
+            if os.path.getsize(path) <= REPORT_MAX_ATTACHMENT_BYTES:
+                maintype, subtype = (delivery.get('mime_type') or 'application/octet-stream').split('/', 1)
+                attachment = MIMEBase(maintype, subtype)
+                with open(path, 'rb') as f:
+                    attachment.set_payload(f.read())
+                encoders.encode_base64(attachment)
+                attachment.add_header('Content-Disposition', 'attachment',
+                                      filename=delivery.get('attachment_name') or os.path.basename(path))
+            else:
+                body += "\n\nEl archivo supera el tamaño máximo para adjuntar; está disponible en el servidor."
+
+        return {
+            'subject': delivery['subject'],
+            'body': MIMEText(body, 'plain', 'utf-8'),
+            'attachment': attachment
+        }
+
+    def _render_message(self, template: Dict, recipient: str) -> bytes:
+        """Mensaje de un destinatario (se arma en el event loop; el worker solo recibe bytes)"""
+        message = MIMEMultipart()
+        message['From'] = self._sender()
+        message['To'] = recipient
+        message['Subject'] = template['subject']
+        message['Date'] = formatdate(localtime=True)
+        message['Message-ID'] = make_msgid()
+        message.attach(template['body'])
+        if template['attachment'] is not None:
+            message.attach(template['attachment'])
+        return message.as_bytes()
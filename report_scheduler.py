@@ -0,0 +1,464 @@
+"""
+Report Scheduler - Agente 5 (ARD)
+Ejecución durable de reportes programados: las programaciones viven en la tabla
+report_schedules y cualquier instancia de la aplicación puede ejecutarlas. Cada ejecución
+se reserva con un lease en la misma fila, por lo que un reporte no corre dos veces aunque
+haya varias instancias, y las ejecuciones perdidas durante una caída se agrupan en una sola.
+"""
+
+import calendar
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from sqlalchemy import func, or_, update
+
+from database import SessionLocal
+from models import ReportSchedule, ReportRun
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Espera máxima entre revisiones de la tabla (se revisa antes si la próxima ejecución es anterior)
+REPORT_SCHEDULER_POLL_SECONDS = float(os.getenv('REPORT_SCHEDULER_POLL_SECONDS', '60'))
+# Reportes programados que se ejecutan a la vez en cada instancia
+REPORT_SCHEDULER_WORKERS = int(os.getenv('REPORT_SCHEDULER_WORKERS', '2'))
+# Duración del lease de una ejecución: si la instancia cae, otra la retoma al vencer
+REPORT_SCHEDULER_LEASE_SECONDS = int(os.getenv('REPORT_SCHEDULER_LEASE_SECONDS', '3600'))
+
+FREQUENCIES = ('hourly', 'daily', 'weekly', 'monthly')
+# Tope de ejecuciones perdidas que se cuentan al agrupar (solo informativo)
+MAX_MISSED_COUNT = 10000
+
+
+def compute_next_run(frequency: str, after: datetime, hour: int = 0, minute: int = 0,
+                     day_of_week: Optional[int] = None, day_of_month: Optional[int] = None) -> datetime:
+    """Primera ocurrencia de la programación estrictamente posterior a `after`"""
+    if frequency == 'hourly':
+        candidate = after.replace(minute=minute, second=0, microsecond=0)
+        return candidate if candidate > after else candidate + timedelta(hours=1)
+
+    candidate = after.replace(hour=hour, minute=minute, second=0, microsecond=0)
+
+    if frequency == 'daily':
+        return candidate if candidate > after else candidate + timedelta(days=1)
+
+    if frequency == 'weekly':
+        candidate += timedelta(days=((day_of_week or 0) - after.weekday()) % 7)
+        return candidate if candidate > after else candidate + timedelta(days=7)
+
+    if frequency == 'monthly':
+        year, month = after.year, after.month
+        while True:
+            day = min(day_of_month or 1, calendar.monthrange(year, month)[1])
+            candidate = candidate.replace(year=year, month=month, day=day)
+            if candidate > after:
+                return candidate
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+    raise ValueError(f"Frecuencia no soportada: {frequency}")
+
+
+def _schedule_next_run(schedule: ReportSchedule, after: datetime) -> datetime:
+    return compute_next_run(schedule.frequency, after, schedule.hour or 0, schedule.minute or 0,
+                            schedule.day_of_week, schedule.day_of_month)
+
+
+class ReportScheduler:
+    """
+    Ejecuta los reportes cuya next_run_at ya pasó, en un pool acotado de threads. Revisa la
+    tabla con una consulta indexada y duerme hasta la próxima ejecución (o el intervalo máximo).
+    """
+
+    def __init__(self, max_workers: int = REPORT_SCHEDULER_WORKERS,
+                 lease_seconds: int = REPORT_SCHEDULER_LEASE_SECONDS,
+                 poll_seconds: float = REPORT_SCHEDULER_POLL_SECONDS):
+        self.max_workers = max_workers
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="report-scheduler")
+        self._running = set()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    # Programaciones
+
+    def schedule(self, report_config: Dict, schedule_config: Dict, created_by: Optional[int] = None) -> Dict:
+        """
+        Crea una programación. `schedule_config`: frequency ('hourly', 'daily', 'weekly',
+        'monthly'), hour, minute, day_of_week (0=lunes) y day_of_month.
+        """
+        frequency = schedule_config.get('frequency', 'daily')
+        if frequency not in FREQUENCIES:
+            raise ValueError(f"Frecuencia no soportada: {frequency}")
+
+        db = SessionLocal()
+        try:
+            schedule = ReportSchedule(
+                name=report_config.get('name', report_config['type']),
+                report_type=report_config['type'],
+                config=json.dumps(report_config, default=str),
+                frequency=frequency,
+                hour=int(schedule_config.get('hour', 9)),
+                minute=int(schedule_config.get('minute', 0)),
+                day_of_week=schedule_config.get('day_of_week'),
+                day_of_month=schedule_config.get('day_of_month'),
+                active=1,
+                created_by=created_by
+            )
+            schedule.next_run_at = _schedule_next_run(schedule, datetime.now())
+            db.add(schedule)
+            db.commit()
+            return self._schedule_to_dict(schedule)
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def set_active(self, schedule_id: int, active: bool) -> bool:
+        """Activa o pausa una programación; al reactivarla se agenda desde ahora (sin ponerse al día)"""
+        db = SessionLocal()
+        try:
+            schedule = db.get(ReportSchedule, schedule_id)
+            if schedule is None:
+                return False
+            schedule.active = 1 if active else 0
+            if active:
+                schedule.next_run_at = _schedule_next_run(schedule, datetime.now())
+            db.commit()
+            return True
+        finally:
+            db.close()
+
+    def list_schedules(self, include_inactive: bool = False) -> List[Dict]:
+        """Programaciones con su próxima ejecución"""
+        db = SessionLocal()
+        try:
+            query = db.query(ReportSchedule)
+            if not include_inactive:
+                query = query.filter(ReportSchedule.active == 1)
+            return [self._schedule_to_dict(schedule)
+                    for schedule in query.order_by(ReportSchedule.next_run_at).all()]
+        finally:
+            db.close()
+
+    def recent_runs(self, schedule_id: Optional[int] = None, limit: int = 20) -> List[Dict]:
+        """Últimas ejecuciones, con duración y tamaño del reporte generado"""
+        db = SessionLocal()
+        try:
+            query = db.query(ReportRun)
+            if schedule_id is not None:
+                query = query.filter(ReportRun.schedule_id == schedule_id)
+            return [{
+                'id': run.id,
+                'schedule_id': run.schedule_id,
+                'scheduled_for': run.scheduled_for.isoformat(),
+                'missed_runs': run.missed_runs,
+                'status': run.status,
+                'started_at': run.started_at.isoformat() if run.started_at else None,
+                'duration_seconds': run.duration_seconds,
+                'file_size_bytes': run.file_size_bytes,
+                'detail_rows': run.detail_rows,
+                'error': run.error
+            } for run in query.order_by(ReportRun.started_at.desc(), ReportRun.id.desc()).limit(limit).all()]
+        finally:
+            db.close()
+
+    # Ejecución
+
+    def run_due(self, wait_for_completion: bool = False) -> Dict:
+        """
+        Reserva y lanza los reportes vencidos que caben en el pool. Con `wait_for_completion`
+        espera a que terminen (para ejecutarlo desde una tarea de Celery).
+        """
+        with self._lock:
+            self._running = {future for future in self._running if not future.done()}
+            free_slots = self.max_workers - len(self._running)
+
+        claimed = self._claim_due(free_slots) if free_slots > 0 else []
+        futures = []
+        for schedule_id, scheduled_for, missed_runs in claimed:
+            future = self._executor.submit(self._execute, schedule_id, scheduled_for, missed_runs)
+            futures.append(future)
+            with self._lock:
+                self._running.add(future)
+
+        if wait_for_completion and futures:
+            wait(futures)
+
+        return {
+            'success': True,
+            'claimed': len(claimed),
+            'running': len(self._running),
+            'worker_id': self.worker_id
+        }
+
+    def _claim_due(self, limit: int) -> List[tuple]:
+        """
+        Reserva hasta `limit` programaciones vencidas. La reserva es un UPDATE condicionado a
+        que la fila siga libre, de modo que solo una instancia la obtiene.
+        """
+        now = datetime.now()
+        lease_until = now + timedelta(seconds=self.lease_seconds)
+        claimed = []
+
+        db = SessionLocal()
+        try:
+            candidates = db.query(ReportSchedule.id, ReportSchedule.next_run_at).filter(
+                ReportSchedule.active == 1,
+                ReportSchedule.next_run_at <= now,
+                or_(ReportSchedule.locked_until.is_(None), ReportSchedule.locked_until < now)
+            ).order_by(ReportSchedule.next_run_at).limit(limit).all()
+
+            for schedule_id, next_run_at in candidates:
+                result = db.execute(
+                    update(ReportSchedule).where(
+                        ReportSchedule.id == schedule_id,
+                        ReportSchedule.next_run_at == next_run_at,
+                        or_(ReportSchedule.locked_until.is_(None), ReportSchedule.locked_until < now)
+                    ).values(locked_by=self.worker_id, locked_until=lease_until)
+                )
+                db.commit()
+                if result.rowcount == 1:
+                    schedule = db.get(ReportSchedule, schedule_id)
+                    claimed.append((schedule_id, next_run_at, self._missed_runs(schedule, next_run_at, now)))
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Error reservando reportes programados: {str(e)}")
+        finally:
+            db.close()
+
+        return claimed
+
+    @staticmethod
+    def _missed_runs(schedule: ReportSchedule, scheduled_for: datetime, now: datetime) -> int:
+        """Ocurrencias posteriores a `scheduled_for` que también vencieron (se agrupan en esta ejecución)"""
+        missed, occurrence = 0, scheduled_for
+        while missed < MAX_MISSED_COUNT:
+            occurrence = _schedule_next_run(schedule, occurrence)
+            if occurrence > now:
+                break
+            missed += 1
+        return missed
+
+    def _execute(self, schedule_id: int, scheduled_for: datetime, missed_runs: int):
+        """Ejecuta una programación reservada, registra la ejecución y agenda la siguiente"""
+        db = SessionLocal()
+        run_id = None
+        # Mientras el reporte corre se extiende el lease, así otra instancia no lo retoma
+        stop_heartbeat = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(schedule_id, stop_heartbeat),
+                                     name=f"report-lease-{schedule_id}", daemon=True)
+        heartbeat.start()
+        try:
+            schedule = db.get(ReportSchedule, schedule_id)
+            run = ReportRun(
+                schedule_id=schedule_id,
+                scheduled_for=scheduled_for,
+                missed_runs=missed_runs,
+                worker_id=self.worker_id,
+                status='running',
+                started_at=datetime.now()
+            )
+            db.add(run)
+            db.commit()
+            run_id = run.id
+
+            start_time = time.time()
+            try:
+                result = self._run_report(json.loads(schedule.config))
+            except Exception as e:
+                result = {'success': False, 'error': str(e)}
+            finally:
+                stop_heartbeat.set()
+
+            run.finished_at = datetime.now()
+            run.duration_seconds = round(time.time() - start_time, 3)
+            run.status = 'success' if result.get('success') else 'failed'
+            run.error = result.get('error')
+            run.file_size_bytes, run.detail_rows = self._output_size(result)
+
+            # Se agenda desde ahora: las ocurrencias perdidas no se ejecutan una por una
+            db.execute(
+                update(ReportSchedule).where(
+                    ReportSchedule.id == schedule_id,
+                    ReportSchedule.locked_by == self.worker_id
+                ).values(
+                    next_run_at=_schedule_next_run(schedule, max(datetime.now(), scheduled_for)),
+                    last_run_at=run.started_at,
+                    locked_by=None,
+                    locked_until=None
+                )
+            )
+            db.commit()
+
+            if missed_runs:
+                logger.info(f"Reporte programado {schedule_id}: {missed_runs} ejecuciones perdidas agrupadas")
+            return run.status
+
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Error ejecutando reporte programado {schedule_id}: {str(e)}")
+            self._release_failed(schedule_id, scheduled_for, run_id, str(e))
+            return 'failed'
+        finally:
+            stop_heartbeat.set()
+            heartbeat.join()
+            db.close()
+
+    def _heartbeat(self, schedule_id: int, stop_event: threading.Event):
+        """Extiende el lease de una programación reservada cada tercio de su duración"""
+        interval = max(self.lease_seconds / 3, 1)
+        while not stop_event.wait(interval):
+            db = SessionLocal()
+            try:
+                result = db.execute(
+                    update(ReportSchedule).where(
+                        ReportSchedule.id == schedule_id,
+                        ReportSchedule.locked_by == self.worker_id
+                    ).values(locked_until=datetime.now() + timedelta(seconds=self.lease_seconds))
+                )
+                db.commit()
+                if result.rowcount == 0 and not stop_event.is_set():
+                    logger.warning(f"Reporte programado {schedule_id}: lease perdido por {self.worker_id}")
+                    return
+            except Exception as e:
+                db.rollback()
+                logger.error(f"Error extendiendo el lease del reporte programado {schedule_id}: {str(e)}")
+            finally:
+                db.close()
+
+    def _release_failed(self, schedule_id: int, scheduled_for: datetime, run_id: Optional[int], error: str):
+        """Marca la ejecución como fallida y libera la reserva (con una sesión nueva)"""
+        db = SessionLocal()
+        try:
+            now = datetime.now()
+            if run_id is not None:
+                db.execute(
+                    update(ReportRun).where(ReportRun.id == run_id).values(
+                        status='failed', error=error, finished_at=now
+                    )
+                )
+
+            values = {'locked_by': None, 'locked_until': None}
+            schedule = db.get(ReportSchedule, schedule_id)
+            if schedule is not None:
+                values['next_run_at'] = _schedule_next_run(schedule, max(now, scheduled_for))
+            db.execute(
+                update(ReportSchedule).where(
+                    ReportSchedule.id == schedule_id,
+                    ReportSchedule.locked_by == self.worker_id
+                ).values(**values)
+            )
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Error liberando el reporte programado {schedule_id}: {str(e)}")
+        finally:
+            db.close()
+
+    @staticmethod
+    def _run_report(report_config: Dict) -> Dict:
+        from automated_reporting_dispatcher import AutomatedReportingDispatcher
+
+        dispatcher = AutomatedReportingDispatcher()
+        try:
+            if report_config.get('partition_by'):
+                return dispatcher.generate_report_batch(report_config)
+            return dispatcher.generate_automated_report(report_config)
+        finally:
+            dispatcher.close()
+
+    @staticmethod
+    def _output_size(result: Dict) -> tuple:
+        """Tamaño y filas de detalle generados (sumando las variantes de un lote)"""
+        outputs = result.get('variants', [result])
+        return (
+            sum(output.get('file_size_bytes') or 0 for output in outputs),
+            sum(output.get('detail_rows') or 0 for output in outputs)
+        )
+
+    # Loop de fondo
+
+    def seconds_until_next_run(self) -> float:
+        """Espera hasta la próxima ejecución, acotada por el intervalo máximo de revisión"""
+        db = SessionLocal()
+        try:
+            next_run_at = db.query(func.min(ReportSchedule.next_run_at)).filter(
+                ReportSchedule.active == 1
+            ).scalar()
+        finally:
+            db.close()
+
+        if next_run_at is None:
+            return self.poll_seconds
+        return min(max((next_run_at - datetime.now()).total_seconds(), 1.0), self.poll_seconds)
+
+    def start(self) -> bool:
+        """Inicia el loop de revisión en un thread de fondo"""
+        if self._thread is not None and self._thread.is_alive():
+            return False
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._loop, name="report-scheduler-loop", daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self, timeout: float = 10):
+        """Detiene el loop; las ejecuciones en curso terminan (o retoman al vencer su lease)"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+
+    def _loop(self):
+        logger.info(f"Scheduler de reportes iniciado ({self.worker_id})")
+        while not self._stop_event.is_set():
+            try:
+                self.run_due()
+                delay = self.seconds_until_next_run()
+            except Exception as e:
+                logger.error(f"Error en el scheduler de reportes: {str(e)}")
+                delay = self.poll_seconds
+            self._stop_event.wait(delay)
+
+    def status(self) -> Dict:
+        """Estado del scheduler en esta instancia"""
+        with self._lock:
+            running = sum(1 for future in self._running if not future.done())
+        return {
+            'worker_id': self.worker_id,
+            'active': self._thread is not None and self._thread.is_alive(),
+            'running_reports': running,
+            'max_workers': self.max_workers
+        }
+
+    @staticmethod
+    def _schedule_to_dict(schedule: ReportSchedule) -> Dict:
+        config = json.loads(schedule.config)
+        return {
+            'id': schedule.id,
+            'name': schedule.name,
+            'type': schedule.report_type,
+            'frequency': schedule.frequency,
+            'hour': schedule.hour,
+            'minute': schedule.minute,
+            'day_of_week': schedule.day_of_week,
+            'day_of_month': schedule.day_of_month,
+            'recipients': config.get('recipients', []),
+            'active': bool(schedule.active),
+            'next_run_at': schedule.next_run_at.isoformat() if schedule.next_run_at else None,
+            'last_run_at': schedule.last_run_at.isoformat() if schedule.last_run_at else None,
+            'running': schedule.locked_by is not None and schedule.locked_until is not None
+                       and schedule.locked_until > datetime.now()
+        }
+
+
+report_scheduler = ReportScheduler()
@@ -0,0 +1,386 @@
+"""
+Report Writers - Agente 5 (ARD)
+Escritura de reportes a archivo en Excel, PDF, HTML y JSON. Las secciones de detalle
+(`detail_table`) se leen fila a fila desde la consulta y se escriben en streaming, por lo
+que la memoria no crece con la cantidad de filas.
+"""
+
+import enum
+import html
+import json
+import os
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Callable, Dict, Iterable, Iterator, List
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Filas de detalle que se incluyen en un PDF (el detalle completo va en Excel/HTML/JSON)
+PDF_MAX_DETAIL_ROWS = int(os.getenv('REPORT_PDF_MAX_DETAIL_ROWS', '5000'))
+# Límite de filas por hoja de Excel (incluye el encabezado)
+EXCEL_MAX_ROWS = 1048576
+
+MIME_TYPES = {
+    'pdf': 'application/pdf',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'html': 'text/html',
+    'json': 'application/json',
+}
+
+SEVERITY_ORDER = ['critical', 'high', 'medium', 'low']
+
+
+def cell_value(value):
+    """Valor de celda serializable: enums por su valor y Decimal como float"""
+    if isinstance(value, enum.Enum):
+        return value.value
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
+
+
+def display_value(value) -> str:
+    """Texto de un valor de sección; los dicts de métricas se formatean según su data_type"""
+    if isinstance(value, dict):
+        if 'value' not in value:
+            return str(value.get('error', 'N/A'))
+        number, data_type = value['value'], value.get('data_type')
+        if isinstance(number, (int, float)) and not isinstance(number, bool):
+            if data_type == 'currency':
+                return f"${number:,.0f}"
+            if data_type == 'percentage':
+                return f"{number:.1f}%"
+        return display_value(number)
+
+    value = cell_value(value)
+    if value is None:
+        return "N/A"
+    if isinstance(value, float):
+        return f"{value:,.2f}"
+    if isinstance(value, int) and not isinstance(value, bool):
+        return f"{value:,}"
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return str(value)
+
+
+def section_table(section: Dict) -> List[List]:
+    """
+    Filas (con encabezado) de una sección de resumen, para los formatos tabulares
+    """
+    data = section.get('data')
+
+    if section.get('type') == 'anomaly_list':
+        rows = [['Severidad', 'Métrica', 'Valor', 'Esperado', 'Desviación']]
+        for severity in sorted(data, key=lambda s: SEVERITY_ORDER.index(s) if s in SEVERITY_ORDER else 99):
+            for anomaly in data[severity]:
+                rows.append([severity, anomaly['metric'], anomaly['value'], anomaly['expected'], anomaly['deviation']])
+        return rows
+
+    if isinstance(data, dict):
+        return [['Indicador', 'Valor']] + [[key, display_value(value)] for key, value in data.items()]
+
+    if isinstance(data, list) and data and isinstance(data[0], dict):
+        columns = list(data[0].keys())
+        return [columns] + [[display_value(item.get(column)) for column in columns] for item in data]
+
+    if isinstance(data, list):
+        return [['Detalle']] + [[display_value(item)] for item in data]
+
+    return [['Valor'], [display_value(data)]]
+
+
+def detail_rows(section: Dict) -> Iterator[tuple]:
+    """Filas de una sección de detalle (la fuente puede ser un iterable o una función)"""
+    rows = section['rows']
+    return iter(rows() if callable(rows) else rows)
+
+
+class ExcelReportWriter:
+    """
+    Excel con openpyxl en modo write-only: una hoja de resumen y una hoja por sección de
+    detalle, escrita fila a fila
+    """
+
+    extension = 'xlsx'
+
+    def write(self, report_data: Dict, path: str) -> int:
+        from openpyxl import Workbook
+
+        workbook = Workbook(write_only=True)
+        used_titles = set()
+
+        summary = workbook.create_sheet(self._sheet_title('Resumen', used_titles))
+        summary.append([report_data.get('title', 'Reporte')])
+        summary.append(['Generado', report_data.get('generated_at')])
+        summary.append(['Período', report_data.get('period')])
+
+        detail_sections = []
+        for section in report_data.get('sections', []):
+            if section.get('type') == 'detail_table':
+                detail_sections.append(section)
+                continue
+            summary.append([])
+            summary.append([section['title']])
+            for row in section_table(section):
+                summary.append([cell_value(value) for value in row])
+
+        total_rows = 0
+        for section in detail_sections:
+            total_rows += self._write_detail(workbook, section, used_titles)
+
+        workbook.save(path)
+        return total_rows
+
+    def _write_detail(self, workbook, section: Dict, used_titles: set) -> int:
+        """Escribe una sección de detalle; continúa en otra hoja si supera el límite de Excel"""
+        sheet, sheet_rows, written = None, 0, 0
+        for row in detail_rows(section):
+            if sheet is None or sheet_rows >= EXCEL_MAX_ROWS:
+                sheet = workbook.create_sheet(self._sheet_title(section['title'], used_titles))
+                sheet.append(list(section['columns']))
+                sheet_rows = 1
+            sheet.append([cell_value(value) for value in row])
+            sheet_rows += 1
+            written += 1
+
+        if sheet is None:
+            sheet = workbook.create_sheet(self._sheet_title(section['title'], used_titles))
+            sheet.append(list(section['columns']))
+        return written
+
+    @staticmethod
+    def _sheet_title(title: str, used_titles: set) -> str:
+        """Nombre de hoja válido (máx. 31 caracteres, sin caracteres reservados) y único"""
+        clean = ''.join(ch for ch in title if ch.isalnum() or ch in ' _-().').strip()[:28] or 'Hoja'
+        candidate, suffix = clean, 2
+        while candidate.lower() in used_titles:
+            candidate = f"{clean[:26]} ({suffix})"
+            suffix += 1
+        used_titles.add(candidate.lower())
+        return candidate
+
+
+class PdfReportWriter:
+    """
+    PDF renderizado localmente con el canvas de reportlab; las tablas de detalle se dibujan
+    página a página desde el iterador de filas (hasta PDF_MAX_DETAIL_ROWS filas)
+    """
+
+    extension = 'pdf'
+    font = 'Helvetica'
+    font_bold = 'Helvetica-Bold'
+    margin = 40
+    line_height = 13
+
+    def write(self, report_data: Dict, path: str) -> int:
+        from reportlab.lib.pagesizes import A4, landscape
+        from reportlab.pdfgen import canvas
+
+        self._page_size = landscape(A4)
+        self._canvas = canvas.Canvas(path, pagesize=self._page_size, pageCompression=1)
+        self._canvas.setTitle(self._text(report_data.get('title', 'Reporte')))
+        self._page_number = 0
+        self._new_page()
+
+        self._line(report_data.get('title', 'Reporte'), size=16, bold=True, spacing=22)
+        self._line(f"Generado: {report_data.get('generated_at')}  |  Período: {report_data.get('period')}",
+                   size=9, spacing=20)
+
+        total_rows = 0
+        for section in report_data.get('sections', []):
+            self._line(section['title'], size=12, bold=True, spacing=18, keep_with=3)
+            if section.get('type') == 'detail_table':
+                total_rows += self._table(section['columns'], detail_rows(section), PDF_MAX_DETAIL_ROWS)
+            else:
+                table = section_table(section)
+                self._table(table[0], iter(table[1:]))
+            self._y -= 8
+
+        self._canvas.save()
+        return total_rows
+
+    def _new_page(self):
+        if self._page_number:
+            self._canvas.showPage()
+        self._page_number += 1
+        width, height = self._page_size
+        self._canvas.setFont(self.font, 8)
+        self._canvas.drawRightString(width - self.margin, self.margin / 2, f"Página {self._page_number}")
+        self._y = height - self.margin
+
+    def _ensure_space(self, needed: float):
+        if self._y - needed < self.margin:
+            self._new_page()
+
+    def _line(self, text: str, size: int = 9, bold: bool = False, spacing: float = None, keep_with: int = 0):
+        spacing = spacing or self.line_height
+        self._ensure_space(spacing + keep_with * self.line_height)
+        self._canvas.setFont(self.font_bold if bold else self.font, size)
+        self._canvas.drawString(self.margin, self._y - size, self._text(text))
+        self._y -= spacing
+
+    def _table(self, columns: List, rows: Iterable, max_rows: int = None) -> int:
+        """Dibuja una tabla repitiendo el encabezado en cada página; retorna las filas dibujadas"""
+        width = self._page_size[0] - 2 * self.margin
+        column_width = width / max(len(columns), 1)
+
+        self._ensure_space(2 * self.line_height)
+        self._row(columns, column_width, bold=True)
+
+        drawn = 0
+        for row in rows:
+            if max_rows is not None and drawn >= max_rows:
+                self._line(f"... detalle truncado en {max_rows:,} filas; ver el reporte en Excel para el detalle completo",
+                           size=8)
+                break
+            if self._y - self.line_height < self.margin:
+                self._new_page()
+                self._row(columns, column_width, bold=True)
+            self._row([display_value(value) if not isinstance(value, str) else value for value in row], column_width)
+            drawn += 1
+        return drawn
+
+    def _row(self, values: List, column_width: float, bold: bool = False):
+        from reportlab.pdfbase.pdfmetrics import stringWidth
+
+        font = self.font_bold if bold else self.font
+        self._canvas.setFont(font, 8)
+        for index, value in enumerate(values):
+            text = self._text(value)
+            while text and stringWidth(text, font, 8) > column_width - 4:
+                text = text[:-2] + '…' if len(text) > 2 else ''
+            self._canvas.drawString(self.margin + index * column_width, self._y - 8, text)
+        self._y -= self.line_height
+
+    @staticmethod
+    def _text(value) -> str:
+        """Texto representable con las fuentes estándar de PDF (Latin-1)"""
+        return str(value).encode('latin-1', 'ignore').decode('latin-1').strip()
+
+
+class HtmlReportWriter:
+    """HTML autocontenido; las filas de detalle se escriben a medida que se leen"""
+
+    extension = 'html'
+
+    def write(self, report_data: Dict, path: str) -> int:
+        title = html.escape(str(report_data.get('title', 'Reporte')))
+        total_rows = 0
+
+        with open(path, 'w', encoding='utf-8') as out:
+            out.write(f"""<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="utf-8">
+    <title>{title}</title>
+    <style>
+        body {{ font-family: Arial, sans-serif; margin: 40px; }}
+        .header {{ background: #f0f2f6; padding: 20px; border-radius: 8px; }}
+        .section {{ margin: 20px 0; padding: 15px; border: 1px solid #ddd; border-radius: 5px; }}
+        .metric {{ display: inline-block; margin: 10px; padding: 10px; background: white; border-radius: 5px; }}
+        table {{ border-collapse: collapse; font-size: 13px; }}
+        th, td {{ border: 1px solid #ddd; padding: 4px 8px; text-align: left; }}
+    </style>
+</head>
+<body>
+    <div class="header">
+        <h1>{title}</h1>
+        <p>Reporte generado automáticamente - {html.escape(str(report_data.get('generated_at')))}</p>
+    </div>
+""")
+            for section in report_data.get('sections', []):
+                out.write(f'    <div class="section">\n        <h2>{html.escape(section["title"])}</h2>\n')
+                if section.get('type') == 'detail_table':
+                    total_rows += self._write_table(out, section['columns'], detail_rows(section))
+                elif section.get('type') in ('metrics_summary', 'financial_summary', 'payment_status', 'kpi_grid',
+                                             'custom_metrics') and isinstance(section.get('data'), dict):
+                    for key, value in section['data'].items():
+                        out.write(f'        <div class="metric"><strong>{html.escape(str(key))}:</strong> '
+                                  f'{html.escape(display_value(value))}</div>\n')
+                else:
+                    table = section_table(section)
+                    self._write_table(out, table[0], iter(table[1:]))
+                out.write('    </div>\n')
+
+            out.write("""    <div class="footer" style="margin-top: 40px; padding: 20px; background: #f8f9fa; border-radius: 5px;">
+        <p>Reporte generado por OAPCE BI - Sistema de Inteligencia Artificial</p>
+    </div>
+</body>
+</html>
+""")
+        return total_rows
+
+    @staticmethod
+    def _write_table(out, columns: List, rows: Iterable) -> int:
+        out.write('        <table>\n            <tr>' +
+                  ''.join(f'<th>{html.escape(str(column))}</th>' for column in columns) + '</tr>\n')
+        written = 0
+        for row in rows:
+            out.write('            <tr>' +
+                      ''.join(f'<td>{html.escape(display_value(value))}</td>' for value in row) + '</tr>\n')
+            written += 1
+        out.write('        </table>\n')
+        return written
+
+
+class JsonReportWriter:
+    """JSON estructurado; las filas de detalle se serializan una a una"""
+
+    extension = 'json'
+
+    def write(self, report_data: Dict, path: str) -> int:
+        total_rows = 0
+        header = {key: value for key, value in report_data.items() if key != 'sections'}
+
+        with open(path, 'w', encoding='utf-8') as out:
+            out.write(json.dumps(header, indent=2, default=str)[:-2] + ',\n  "sections": [')
+            for index, section in enumerate(report_data.get('sections', [])):
+                out.write(',\n    ' if index else '\n    ')
+                if section.get('type') != 'detail_table':
+                    out.write(json.dumps(section, default=str))
+                    continue
+
+                meta = {key: value for key, value in section.items() if key != 'rows'}
+                out.write(json.dumps(meta, default=str)[:-1] + ', "rows": [')
+                for row_index, row in enumerate(detail_rows(section)):
+                    out.write((',\n      ' if row_index else '\n      ') +
+                              json.dumps([cell_value(value) for value in row], default=str))
+                    total_rows += 1
+                out.write('\n    ]}')
+            out.write('\n  ]\n}\n')
+        return total_rows
+
+
+REPORT_WRITERS: Dict[str, Callable[[], object]] = {
+    'excel': ExcelReportWriter,
+    'pdf': PdfReportWriter,
+    'html': HtmlReportWriter,
+    'json': JsonReportWriter,
+}
+
+
+def report_extension(report_format: str) -> str:
+    """Extensión del archivo que genera el formato indicado"""
+    return REPORT_WRITERS.get(report_format, JsonReportWriter).extension
+
+
+def write_report(report_format: str, report_data: Dict, path_for: Callable[[str], str]) -> Dict:
+    """
+    Escribe el reporte en el formato indicado (json por defecto) en la ruta que retorna
+    `path_for(extension)`
+    """
+    writer = REPORT_WRITERS.get(report_format, JsonReportWriter)()
+    path = path_for(writer.extension)
+    detail_row_count = writer.write(report_data, path)
+
+    return {
+        'format': report_format if report_format in REPORT_WRITERS else 'json',
+        'file_path': path,
+        'mime_type': MIME_TYPES[writer.extension],
+        'extension': writer.extension,
+        'size_bytes': os.path.getsize(path),
+        'detail_rows': detail_row_count
+    }
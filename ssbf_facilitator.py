@@ -4,12 +4,15 @@ Módulo para facilitar la creación autónoma de reportes por usuarios no técni
 """
 
 import json
+import math
 import requests
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional
 from database import get_db
 from models import PredefinedMetric, UserDashboard, DashboardPermission, DashboardTemplate, Usuario
-from sqlalchemy import text, func
+from metric_execution import metric_execution_service, format_metric_value
+from dashboard_tiles import dashboard_tile_renderer
+from sqlalchemy import and_, case, func, or_, text
 import logging
 import urllib.parse
 
@@ -17,6 +20,14 @@ import urllib.parse
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Columnas del listado de dashboards (la configuración se lee solo al abrir uno)
+DASHBOARD_LIST_COLUMNS = [
+    UserDashboard.id, UserDashboard.title, UserDashboard.description, UserDashboard.user_id,
+    UserDashboard.is_public, UserDashboard.dashboard_type, UserDashboard.thumbnail_url,
+    UserDashboard.tags, UserDashboard.view_count, UserDashboard.last_viewed,
+    UserDashboard.created_at, UserDashboard.updated_at
+]
+
 class SSBFFacilitator:
     """
     Facilitador de BI autoservicio para empoderamiento de usuarios
@@ -54,8 +65,9 @@ class SSBFFacilitator:
                 'formula': """
                     SELECT COALESCE(SUM(f.monto_total), 0) as valor
                     FROM facturas f
-                    WHERE f.estado = 'Pagada'
-                    AND strftime('%Y-%m', f.fecha_emision) = strftime('%Y-%m', 'now')
+                    WHERE f.estado = 'pagada'
+                    AND f.fecha_emision >= :month_start
+                    AND f.fecha_emision < :next_month_start
                 """,
                 'data_type': 'currency',
                 'unit': '$',
@@ -67,19 +79,13 @@ class SSBFFacilitator:
                 'description': 'Proyección de ventas para el mes actual basada en promedio histórico',
                 'category': 'ventas',
                 'formula': """
-                    SELECT
-                        ROUND(
-                            (SELECT AVG(mes_ventas) * 1.0
-                             FROM (SELECT SUM(f.monto_total) as mes_ventas
-                                   FROM facturas f
-                                   WHERE f.estado = 'Pagada'
-                                   GROUP BY strftime('%Y-%m', f.fecha_emision)
-                                   ORDER BY strftime('%Y-%m', f.fecha_emision) DESC
-                                   LIMIT 3)) *
-                            (strftime('%d', date('now', 'start of month', '+1 month', '-1 day')) -
-                             strftime('%d', 'now') + 1) /
-                            strftime('%d', date('now', 'start of month', '+1 month', '-1 day')), 2
-                        ) as valor
+                    SELECT ROUND(CAST(
+                        COALESCE(SUM(f.monto_total), 0) / 3.0 * :days_left_in_month / :days_in_month
+                    AS NUMERIC), 2) as valor
+                    FROM facturas f
+                    WHERE f.estado = 'pagada'
+                    AND f.fecha_emision >= :three_months_start
+                    AND f.fecha_emision < :next_month_start
                 """,
                 'data_type': 'currency',
                 'unit': '$',
@@ -91,10 +97,10 @@ class SSBFFacilitator:
                 'description': 'Porcentaje de oportunidades convertidas a ventas',
                 'category': 'ventas',
                 'formula': """
-                    SELECT ROUND(
-                        (SELECT COUNT(*) FROM clientes WHERE estado_funnel = 'Ganado') * 100.0 /
-                        NULLIF((SELECT COUNT(*) FROM clientes), 0), 2
-                    ) as valor
+                    SELECT ROUND(CAST(
+                        COUNT(CASE WHEN estado_funnel = 'ganado' THEN 1 END) * 100.0 / NULLIF(COUNT(*), 0)
+                    AS NUMERIC), 2) as valor
+                    FROM clientes
                 """,
                 'data_type': 'percentage',
                 'unit': '%',
@@ -110,8 +116,9 @@ class SSBFFacilitator:
                     FROM vendedores v
                     JOIN clientes c ON v.id = c.vendedor_id
                     JOIN facturas f ON c.id = f.cliente_id
-                    WHERE f.estado = 'Pagada'
-                    AND strftime('%Y-%m', f.fecha_emision) = strftime('%Y-%m', 'now')
+                    WHERE f.estado = 'pagada'
+                    AND f.fecha_emision >= :month_start
+                    AND f.fecha_emision < :next_month_start
                     GROUP BY v.id, v.nombre
                     ORDER BY SUM(f.monto_total) DESC
                     LIMIT 1
@@ -130,7 +137,8 @@ class SSBFFacilitator:
                 'formula': """
                     SELECT COALESCE(SUM(c.monto), 0) as valor
                     FROM cobranzas c
-                    WHERE strftime('%Y-%m', c.fecha_pago) = strftime('%Y-%m', 'now')
+                    WHERE c.fecha_pago >= :month_start
+                    AND c.fecha_pago < :next_month_start
                 """,
                 'data_type': 'currency',
                 'unit': '$',
@@ -144,7 +152,7 @@ class SSBFFacilitator:
                 'formula': """
                     SELECT COALESCE(SUM(f.monto_total - f.monto_pagado), 0) as valor
                     FROM facturas f
-                    WHERE f.estado IN ('Pendiente', 'Parcial')
+                    WHERE f.estado IN ('pendiente', 'parcial')
                 """,
                 'data_type': 'currency',
                 'unit': '$',
@@ -156,7 +164,7 @@ class SSBFFacilitator:
                 'description': 'Promedio de días que tardan en pagar las facturas',
                 'category': 'cobranza',
                 'formula': """
-                    SELECT ROUND(AVG(julianday(c.fecha_pago) - julianday(f.fecha_emision)), 1) as valor
+                    SELECT ROUND(CAST(AVG({days_between(c.fecha_pago, f.fecha_emision)}) AS NUMERIC), 1) as valor
                     FROM cobranzas c
                     JOIN facturas f ON c.factura_id = f.id
                     WHERE c.fecha_pago >= '2024-01-01'
@@ -174,9 +182,12 @@ class SSBFFacilitator:
                 'category': 'finanzas',
                 'formula': """
                     SELECT
-                        (SELECT COALESCE(SUM(monto), 0) FROM movimientos_caja WHERE tipo = 'Ingreso' AND strftime('%Y-%m', fecha) = strftime('%Y-%m', 'now')) -
-                        (SELECT COALESCE(SUM(monto), 0) FROM movimientos_caja WHERE tipo = 'Egreso' AND strftime('%Y-%m', fecha) = strftime('%Y-%m', 'now'))
+                        COALESCE(SUM(CASE WHEN tipo = 'Ingreso' THEN monto ELSE 0 END), 0) -
+                        COALESCE(SUM(CASE WHEN tipo = 'Egreso' THEN monto ELSE 0 END), 0)
                     as valor
+                    FROM movimientos_caja
+                    WHERE fecha >= :month_start
+                    AND fecha < :next_month_start
                 """,
                 'data_type': 'currency',
                 'unit': '$',
@@ -188,10 +199,11 @@ class SSBFFacilitator:
                 'description': 'Margen bruto aproximado (estimado)',
                 'category': 'finanzas',
                 'formula': """
-                    SELECT ROUND(
-                        (SELECT COALESCE(SUM(f.monto_total), 0) FROM facturas f WHERE f.estado = 'Pagada') * 0.25 /
-                        NULLIF((SELECT COALESCE(SUM(f.monto_total), 0) FROM facturas f WHERE f.estado = 'Pagada'), 0) * 100, 1
-                    ) as valor
+                    SELECT ROUND(CAST(
+                        COALESCE(SUM(f.monto_total), 0) * 0.25 / NULLIF(COALESCE(SUM(f.monto_total), 0), 0) * 100
+                    AS NUMERIC), 1) as valor
+                    FROM facturas f
+                    WHERE f.estado = 'pagada'
                 """,
                 'data_type': 'percentage',
                 'unit': '%',
@@ -208,7 +220,7 @@ class SSBFFacilitator:
                     SELECT COUNT(DISTINCT c.id) as valor
                     FROM clientes c
                     JOIN facturas f ON c.id = f.cliente_id
-                    WHERE f.fecha_emision >= date('now', '-90 days')
+                    WHERE f.fecha_emision >= :days_90_ago
                 """,
                 'data_type': 'number',
                 'unit': '',
@@ -222,7 +234,7 @@ class SSBFFacilitator:
                 'formula': """
                     SELECT COUNT(*) as valor
                     FROM actividades_venta
-                    WHERE date(fecha) = date('now')
+                    WHERE fecha = :today
                 """,
                 'data_type': 'number',
                 'unit': '',
@@ -231,6 +243,7 @@ class SSBFFacilitator:
         ]
 
         created_count = 0
+        updated_count = 0
         for metric_data in default_metrics:
             try:
                 # Verificar si ya existe
@@ -242,12 +255,17 @@ class SSBFFacilitator:
                     metric = PredefinedMetric(**metric_data)
                     self.db.add(metric)
                     created_count += 1
+                elif existing.created_by == 'admin' and existing.formula != metric_data['formula']:
+                    # Métricas del sistema: actualizar a la fórmula portable vigente
+                    existing.formula = metric_data['formula']
+                    updated_count += 1
 
             except Exception as e:
                 logger.warning(f"Error creando métrica {metric_data['name']}: {str(e)}")
 
         try:
             self.db.commit()
+            metric_execution_service.invalidate()
         except Exception as e:
             logger.error(f"Error guardando métricas: {str(e)}")
             self.db.rollback()
@@ -255,6 +273,7 @@ class SSBFFacilitator:
         return {
             "success": True,
             "metrics_created": created_count,
+            "metrics_updated": updated_count,
             "total_default_metrics": len(default_metrics)
         }
 
@@ -293,47 +312,46 @@ class SSBFFacilitator:
             logger.error(f"Error obteniendo métricas predefinidas: {str(e)}")
             return []
 
-    def calculate_metric_value(self, metric_id: int) -> Dict:
+    def calculate_metric_value(self, metric_id: int, params: Dict = None) -> Dict:
         """
         Calcula el valor actual de una métrica específica
         """
-        try:
-            metric = self.db.query(PredefinedMetric).filter(PredefinedMetric.id == metric_id).first()
-            if not metric:
-                return {"success": False, "error": "Métrica no encontrada"}
-
-            # Ejecutar consulta SQL directamente usando text()
-            result = self.db.execute(text(metric.formula)).fetchone()
-
-            if result is None or len(result) == 0:
-                value = 0
-            else:
-                value = result[0]
-
-            # Formatear según tipo de datos
-            if metric.data_type == 'currency' and isinstance(value, (int, float)):
-                formatted_value = f"${value:,.0f}"
-            elif metric.data_type == 'percentage' and isinstance(value, (int, float)):
-                formatted_value = f"{value:.1f}%"
-            elif metric.data_type == 'number' and isinstance(value, (int, float)):
-                formatted_value = f"{value:,.0f}"
-            else:
-                formatted_value = str(value) if value is not None else "N/A"
+        return self.calculate_metric_values([metric_id], params)[metric_id]
 
-            return {
-                "success": True,
-                "metric_id": metric_id,
-                "metric_name": metric.name,
-                "raw_value": value,
-                "formatted_value": formatted_value,
-                "unit": metric.unit,
-                "data_type": metric.data_type,
-                "calculated_at": datetime.now()
-            }
+    def calculate_metric_values(self, metric_ids: List[int], params: Dict = None) -> Dict[int, Dict]:
+        """
+        Calcula el valor actual de varias métricas en un solo lote (en paralelo y con cache
+        por métrica, parámetros y versión de los datos)
+        """
+        try:
+            executions = metric_execution_service.execute_many(metric_ids, params)
+            definitions = metric_execution_service.get_definitions(list(executions))
+
+            results = {}
+            for metric_id, execution in executions.items():
+                if not execution['success']:
+                    results[metric_id] = execution
+                    continue
+
+                metric = definitions[metric_id]
+                value = execution['value']
+                results[metric_id] = {
+                    "success": True,
+                    "metric_id": metric_id,
+                    "metric_name": metric['name'],
+                    "raw_value": value,
+                    "formatted_value": format_metric_value(value, metric['data_type']),
+                    "unit": metric['unit'],
+                    "data_type": metric['data_type'],
+                    "cached": execution['cached'],
+                    "calculated_at": datetime.now()
+                }
+
+            return results
 
         except Exception as e:
-            logger.error(f"Error calculando valor de métrica {metric_id}: {str(e)}")
-            return {"success": False, "error": str(e)}
+            logger.error(f"Error calculando valores de métricas {metric_ids}: {str(e)}")
+            return {metric_id: {"success": False, "error": str(e)} for metric_id in metric_ids}
 
     # =========== PLANTILLAS DE DASHBOARDS ===========
 
@@ -519,67 +537,132 @@ class SSBFFacilitator:
             self.db.rollback()
             return {"success": False, "error": str(e)}
 
-    def get_user_dashboards(self, user_id: int) -> List[Dict]:
+    def get_user_dashboards(self, user_id: int, page: int = 1, page_size: int = 50) -> Dict:
         """
-        Obtiene dashboards accesibles para un usuario
+        Obtiene los dashboards accesibles para un usuario (propios, compartidos con él y
+        públicos o de equipo), paginados.
+
+        Una sola consulta resuelve el acceso y el nivel de permiso; la configuración no se
+        decodifica en el listado (ver get_dashboard).
         """
         try:
-            # Dashboards propios
-            owned_dashboards = self.db.query(UserDashboard).filter(
-                UserDashboard.user_id == user_id
-            ).all()
+            permission_rank = func.max(case(
+                (DashboardPermission.permission_level == 'admin', 3),
+                (DashboardPermission.permission_level == 'edit', 2),
+                else_=1
+            ))
+            user_permission = case(
+                (UserDashboard.user_id == user_id, 'admin'),
+                (permission_rank == 3, 'admin'),
+                (permission_rank == 2, 'edit'),
+                else_='view'
+            ).label('user_permission')
+
+            query = self.db.query(
+                *DASHBOARD_LIST_COLUMNS, user_permission
+            ).outerjoin(
+                DashboardPermission,
+                and_(DashboardPermission.dashboard_id == UserDashboard.id,
+                     DashboardPermission.user_id == user_id)
+            ).filter(
+                or_(UserDashboard.user_id == user_id, DashboardPermission.id.isnot(None),
+                    UserDashboard.is_public > 0)
+            ).group_by(UserDashboard.id)
+
+            total = query.count()
+            page = max(1, page)
+            rows = query.order_by(
+                UserDashboard.updated_at.desc(), UserDashboard.id.desc()
+            ).offset((page - 1) * page_size).limit(page_size).all()
 
-            # Dashboards compartidos
-            shared_permissions = self.db.query(DashboardPermission).filter(
-                DashboardPermission.user_id == user_id
-            ).all()
-
-            shared_dashboard_ids = [p.dashboard_id for p in shared_permissions]
+            return {
+                "success": True,
+                "dashboards": [self._dashboard_to_dict(row) for row in rows],
+                "total": total,
+                "page": page,
+                "page_size": page_size,
+                "total_pages": math.ceil(total / page_size) if page_size else 0
+            }
 
-            shared_dashboards = []
-            if shared_dashboard_ids:
-                shared_dashboards = self.db.query(UserDashboard).filter(
-                    UserDashboard.id.in_(shared_dashboard_ids)
-                ).all()
+        except Exception as e:
+            logger.error(f"Error obteniendo dashboards del usuario {user_id}: {str(e)}")
+            return {"success": False, "error": str(e), "dashboards": []}
 
-            # Combinar y eliminar duplicados
-            all_dashboards = owned_dashboards + shared_dashboards
-            unique_dashboards = list(set(all_dashboards))
+    def get_dashboard(self, dashboard_id: int, user_id: int) -> Dict:
+        """
+        Abre un dashboard accesible para el usuario: retorna su configuración decodificada
+        y registra la visita
+        """
+        try:
+            dashboard = self.db.query(UserDashboard).filter(UserDashboard.id == dashboard_id).first()
+            if not dashboard:
+                return {"success": False, "error": "Dashboard no encontrado"}
 
-            result = []
-            for dashboard in unique_dashboards:
-                # Obtener permisos del usuario para este dashboard
-                user_permissions = self.db.query(DashboardPermission).filter(
-                    DashboardPermission.dashboard_id == dashboard.id,
+            if dashboard.user_id == user_id:
+                permission_level = 'admin'
+            else:
+                levels = [level for (level,) in self.db.query(DashboardPermission.permission_level).filter(
+                    DashboardPermission.dashboard_id == dashboard_id,
                     DashboardPermission.user_id == user_id
-                ).first()
+                ).all()]
+                if levels:
+                    permission_level = 'admin' if 'admin' in levels else ('edit' if 'edit' in levels else 'view')
+                elif (dashboard.is_public or 0) > 0:
+                    # Dashboards de equipo (1) y públicos (2): lectura para todos
+                    permission_level = 'view'
+                else:
+                    return {"success": False, "error": "Sin permisos para ver este dashboard"}
+
+            dashboard.view_count = (dashboard.view_count or 0) + 1
+            dashboard.last_viewed = datetime.utcnow()
+            self.db.commit()
 
-                permission_level = 'admin' if dashboard.user_id == user_id else (
-                    user_permissions.permission_level if user_permissions else 'view'
-                )
+            return {
+                "success": True,
+                **self._dashboard_to_dict(dashboard, permission_level),
+                "config": json.loads(dashboard.config) if dashboard.config else {},
+                "metabase_dashboard_id": dashboard.metabase_dashboard_id
+            }
 
-                result.append({
-                    'id': dashboard.id,
-                    'title': dashboard.title,
-                    'description': dashboard.description,
-                    'user_id': dashboard.user_id,
-                    'is_public': bool(dashboard.is_public),
-                    'dashboard_type': dashboard.dashboard_type,
-                    'config': json.loads(dashboard.config) if dashboard.config else {},
-                    'thumbnail_url': dashboard.thumbnail_url,
-                    'tags': json.loads(dashboard.tags) if dashboard.tags else [],
-                    'view_count': dashboard.view_count,
-                    'last_viewed': str(dashboard.last_viewed) if dashboard.last_viewed else None,
-                    'user_permission': permission_level,
-                    'created_at': str(dashboard.created_at),
-                    'updated_at': str(dashboard.updated_at)
-                })
+        except Exception as e:
+            self.db.rollback()
+            logger.error(f"Error abriendo dashboard {dashboard_id}: {str(e)}")
+            return {"success": False, "error": str(e)}
 
-            return result
+    def render_dashboard(self, dashboard_id: int, user_id: int, params: Dict = None) -> Dict:
+        """
+        Abre un dashboard y calcula sus tiles de métricas; los tiles se comparten en cache
+        entre todos los usuarios que ven el mismo dashboard con los mismos filtros
+        """
+        dashboard = self.get_dashboard(dashboard_id, user_id)
+        if not dashboard['success']:
+            return dashboard
 
+        try:
+            rendered = dashboard_tile_renderer.render(dashboard['config'], params)
+            return {**dashboard, **rendered}
         except Exception as e:
-            logger.error(f"Error obteniendo dashboards del usuario {user_id}: {str(e)}")
-            return []
+            logger.error(f"Error renderizando dashboard {dashboard_id}: {str(e)}")
+            return {"success": False, "error": str(e)}
+
+    @staticmethod
+    def _dashboard_to_dict(dashboard, permission_level: str = None) -> Dict:
+        """Datos de listado de un dashboard (sin su configuración)"""
+        return {
+            'id': dashboard.id,
+            'title': dashboard.title,
+            'description': dashboard.description,
+            'user_id': dashboard.user_id,
+            'is_public': bool(dashboard.is_public),
+            'dashboard_type': dashboard.dashboard_type,
+            'thumbnail_url': dashboard.thumbnail_url,
+            'tags': json.loads(dashboard.tags) if dashboard.tags else [],
+            'view_count': dashboard.view_count,
+            'last_viewed': str(dashboard.last_viewed) if dashboard.last_viewed else None,
+            'user_permission': permission_level or dashboard.user_permission,
+            'created_at': str(dashboard.created_at),
+            'updated_at': str(dashboard.updated_at)
+        }
 
     def update_dashboard_config(self, dashboard_id: int, user_id: int, config: dict) -> Dict:
         """
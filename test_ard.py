@@ -0,0 +1,670 @@
+#!/usr/bin/env python3
+"""
+Script de prueba para Automated Reporting Dispatcher (ARD): escritura de reportes, datos
+de las secciones de cada tipo de reporte, lotes particionados por vendedor, scheduler durable
+y distribución por email y webhooks
+"""
+
+import asyncio
+import email
+import json
+import os
+import shutil
+import socketserver
+import tempfile
+import threading
+import time
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import testing_env  # noqa: F401
+from automated_reporting_dispatcher import AutomatedReportingDispatcher, attach_detail_rows
+from database import SessionLocal
+from models import (AnomalyAlert, Cliente, Cobranza, EstadoFacturaEnum, Factura, MovimientoCaja,
+                    Recommendation, ReportRun, ReportSchedule, Vendedor)
+from report_distribution import FileTransport, PermanentDeliveryError, ReportDistributor, SmtpTransport
+from report_scheduler import ReportScheduler, compute_next_run
+from report_writers import write_report
+
+TEST_USER = {'nombre': 'Prueba', 'email': 'prueba@oapce.cl', 'rol': 'admin'}
+
+
+def _sample_report(detail_count=250):
+    return {
+        'title': 'Reporte de Prueba - Ñandú',
+        'generated_at': datetime(2024, 3, 1, 9, 30).isoformat(),
+        'period': '2024-02',
+        'sections': [
+            {'title': 'Resumen', 'type': 'metrics_summary', 'data': {
+                'Ingresos': {'value': 1500000.0, 'data_type': 'currency'},
+                'Conversión': {'value': 20.5, 'data_type': 'percentage'},
+                'Clientes': 170
+            }},
+            {'title': 'Vendedores', 'type': 'table', 'data': [
+                {'vendedor': 'Ana', 'ventas': 10}, {'vendedor': 'Luis', 'ventas': 7}
+            ]},
+            {'title': 'Anomalías', 'type': 'anomaly_list', 'data': {
+                'high': [{'metric': 'ventas', 'value': 1, 'expected': 10, 'deviation': -0.9}]
+            }},
+            {'title': 'Detalle de facturas', 'type': 'detail_table',
+             'columns': ['numero', 'cliente', 'monto', 'fecha'],
+             'rows': [(f"F-{i}", f"Cliente {i}", i * 1000.5, date(2024, 2, 1 + i % 28))
+                      for i in range(detail_count)]}
+        ]
+    }
+
+
+def test_report_writers():
+    print("🧪 Probando escritura de reportes en cada formato")
+    from openpyxl import load_workbook
+
+    output_dir = tempfile.mkdtemp(prefix="ard_test_")
+    try:
+        outputs = {}
+        for report_format in ('excel', 'pdf', 'html', 'json', 'desconocido'):
+            result = write_report(report_format, _sample_report(),
+                                  lambda extension: os.path.join(output_dir, f"{report_format}.{extension}"))
+            assert result['detail_rows'] == 250, result
+            assert result['size_bytes'] == os.path.getsize(result['file_path']) > 0
+            outputs[report_format] = result
+
+        workbook = load_workbook(outputs['excel']['file_path'], read_only=True)
+        assert workbook.sheetnames == ['Resumen', 'Detalle de facturas']
+        detail = list(workbook['Detalle de facturas'].iter_rows(values_only=True))
+        assert detail[0] == ('numero', 'cliente', 'monto', 'fecha') and len(detail) == 251
+        workbook.close()
+
+        with open(outputs['pdf']['file_path'], 'rb') as f:
+            content = f.read()
+        assert content.startswith(b'%PDF') and content.rstrip().endswith(b'%%EOF')
+
+        with open(outputs['html']['file_path'], encoding='utf-8') as f:
+            page = f.read()
+        assert page.startswith('<!DOCTYPE html>') and page.rstrip().endswith('</html>')
+        assert 'Ñandú' in page and '$1,500,000' in page and page.count('<tr>') == 250 + 1 + 3 + 2
+
+        with open(outputs['json']['file_path'], encoding='utf-8') as f:
+            data = json.load(f)
+        assert data['title'] == 'Reporte de Prueba - Ñandú'
+        assert len(data['sections'][3]['rows']) == 250 and data['sections'][3]['rows'][1][2] == 1000.5
+        assert outputs['desconocido']['format'] == 'json'
+
+        empty = write_report('json', _sample_report(detail_count=0),
+                             lambda extension: os.path.join(output_dir, f"vacio.{extension}"))
+        with open(empty['file_path'], encoding='utf-8') as f:
+            assert json.load(f)['sections'][3]['rows'] == []
+        print("   ✅ Excel, PDF, HTML y JSON válidos con 250 filas de detalle")
+    finally:
+        shutil.rmtree(output_dir)
+
+
+def _section(sections, title):
+    return next(section for section in sections if section['title'] == title)
+
+
+def _detail_rows(section):
+    return list(attach_detail_rows({'sections': [section]})['sections'][0]['rows']())
+
+
+def _seed_seller(db, suffix):
+    """Vendedor propio con un cliente, para leer sus totales sin depender del resto de la BD"""
+    vendedor = Vendedor(nombre=f"Vendedor {suffix}", email=f"v{suffix}@oapce.cl", activo=1)
+    db.add(vendedor)
+    db.flush()
+    cliente = Cliente(nombre=f"Cliente {suffix}", rut=f"ARD-{suffix}", vendedor_id=vendedor.id,
+                      fecha_ingreso=date.today())
+    db.add(cliente)
+    db.flush()
+    return vendedor, cliente
+
+
+def _add_invoice(db, cliente, number, emitted, total, paid=0.0, estado=EstadoFacturaEnum.pendiente, due=None):
+    factura = Factura(numero_factura=number, cliente_id=cliente.id, fecha_emision=emitted,
+                      fecha_vencimiento=due or emitted + timedelta(days=30), monto_total=total,
+                      monto_pagado=paid, estado=estado)
+    db.add(factura)
+    db.flush()
+    return factura
+
+
+def _cleanup(db, cliente_ids, vendedor_ids, cash_ids=()):
+    factura_ids = [factura_id for (factura_id,) in
+                   db.query(Factura.id).filter(Factura.cliente_id.in_(cliente_ids)).all()]
+    db.query(Cobranza).filter(Cobranza.factura_id.in_(factura_ids)).delete(synchronize_session=False)
+    db.query(Factura).filter(Factura.id.in_(factura_ids)).delete(synchronize_session=False)
+    db.query(Cliente).filter(Cliente.id.in_(cliente_ids)).delete(synchronize_session=False)
+    db.query(Vendedor).filter(Vendedor.id.in_(vendedor_ids)).delete(synchronize_session=False)
+    db.query(MovimientoCaja).filter(MovimientoCaja.id.in_(list(cash_ids))).delete(synchronize_session=False)
+    db.commit()
+
+
+def test_weekly_dataset():
+    print("🧪 Probando datos del resumen semanal")
+
+    suffix = time.time_ns()
+    today = date.today()
+    db = SessionLocal()
+    dispatcher = AutomatedReportingDispatcher(user=TEST_USER)
+    vendedor, cliente = _seed_seller(db, suffix)
+
+    try:
+        # Semana actual: 2 facturas y 1 cobranza; semana anterior: 1 y 1; fuera de ventana: 1
+        current = _add_invoice(db, cliente, f"W{suffix}-1", today, 1000.0)
+        _add_invoice(db, cliente, f"W{suffix}-2", today - timedelta(days=3), 500.0)
+        previous = _add_invoice(db, cliente, f"W{suffix}-3", today - timedelta(days=10), 2000.0)
+        _add_invoice(db, cliente, f"W{suffix}-4", today - timedelta(days=20), 9000.0)
+        db.add_all([
+            Cobranza(factura_id=current.id, fecha_pago=today, monto=300.0),
+            Cobranza(factura_id=previous.id, fecha_pago=today - timedelta(days=9), monto=2000.0)
+        ])
+        db.commit()
+
+        dataset = dispatcher._load_weekly_dataset()
+        assert dataset['by_seller'][vendedor.id] == {
+            'invoices': 2, 'invoices_prev': 1, 'billed': 1500.0, 'billed_prev': 2000.0,
+            'collected': 300.0, 'collected_prev': 2000.0, 'new_clients': 1, 'new_clients_prev': 0
+        }, dataset['by_seller'][vendedor.id]
+
+        sections = dispatcher._generate_weekly_summary({}, dataset, vendedor.id)
+        summary = _section(sections, '📊 Resumen Ejecutivo')['data']
+        assert summary['revenue_week']['value'] == 1500.0 and summary['collections_week']['value'] == 300.0
+        kpis = {kpi['name']: kpi for kpi in _section(sections, '🎯 KPIs Principales')['data']}
+        assert kpis['Ventas Facturadas']['change'] == '-25.0%' and kpis['Facturas Emitidas']['change'] == '+1'
+        assert len(_detail_rows(_section(sections, '📄 Facturas de la Semana'))) == 2
+        print("   ✅ Totales por vendedor, variación semanal y detalle de facturas")
+
+    finally:
+        _cleanup(db, [cliente.id], [vendedor.id])
+        db.close()
+        dispatcher.close()
+
+
+def test_monthly_dataset():
+    print("🧪 Probando datos del reporte financiero mensual")
+
+    # Un mes futuro sin otros datos en la base de prueba
+    period, month_start = '2091-03', date(2091, 3, 1)
+    suffix = time.time_ns()
+    db = SessionLocal()
+    dispatcher = AutomatedReportingDispatcher(user=TEST_USER)
+    vendedor, cliente = _seed_seller(db, suffix)
+
+    try:
+        _add_invoice(db, cliente, f"M{suffix}-1", month_start, 1000.0, paid=1000.0, estado=EstadoFacturaEnum.pagada)
+        _add_invoice(db, cliente, f"M{suffix}-2", month_start + timedelta(days=5), 3000.0, paid=500.0,
+                     estado=EstadoFacturaEnum.parcial)
+        _add_invoice(db, cliente, f"M{suffix}-3", month_start + timedelta(days=9), 1000.0,
+                     due=date.today() - timedelta(days=1))
+        _add_invoice(db, cliente, f"M{suffix}-4", month_start + timedelta(days=31), 7000.0)  # abril
+        cash = [
+            MovimientoCaja(fecha=month_start, tipo='Ingreso', concepto='Venta', monto=4000.0),
+            MovimientoCaja(fecha=month_start + timedelta(days=10), tipo='Ingreso', concepto='Venta', monto=1000.0),
+            MovimientoCaja(fecha=month_start + timedelta(days=20), tipo='Egreso', concepto='Arriendo', monto=2000.0),
+            MovimientoCaja(fecha=month_start - timedelta(days=1), tipo='Egreso', concepto='Febrero', monto=99.0)
+        ]
+        db.add_all(cash)
+        db.commit()
+
+        config = {'period': period}
+        dataset = dispatcher._load_monthly_dataset(config)
+        assert dataset['income'] == 5000.0 and dataset['expenses'] == 2000.0
+        assert dataset['by_seller'] == {vendedor.id: {
+            'paid_count': 1, 'pending_count': 1, 'overdue_count': 1, 'billed': 5000.0, 'paid_amount': 1500.0
+        }}, dataset['by_seller']
+
+        sections = dispatcher._generate_monthly_finance(config, dataset)
+        finance = _section(sections, '💰 Situación Financiera')['data']
+        assert finance['net_profit']['value'] == 3000.0 and finance['margin']['value'] == 60.0
+        status = _section(sections, '📊 Estado de Cobranzas')['data']
+        assert status['payment_rate']['value'] == 30.0
+        assert len(_detail_rows(_section(sections, '📄 Facturas del Mes'))) == 3
+        assert len(_detail_rows(_section(sections, '🏦 Movimientos de Caja'))) == 3
+
+        # La versión del vendedor no incluye la caja de la empresa
+        seller_titles = [section['title'] for section in dispatcher._generate_monthly_finance(config, dataset, vendedor.id)]
+        assert '💰 Situación Financiera' not in seller_titles and '🏦 Movimientos de Caja' not in seller_titles
+        print("   ✅ Caja, estado de cobranzas y detalle del mes")
+
+    finally:
+        _cleanup(db, [cliente.id], [vendedor.id], [movement.id for movement in cash])
+        db.close()
+        dispatcher.close()
+
+
+def test_anomaly_alert_sections():
+    print("🧪 Probando la alerta de anomalías")
+
+    metric = f"test_metrica_{time.time_ns()}"
+    now = datetime.utcnow()
+    db = SessionLocal()
+    dispatcher = AutomatedReportingDispatcher(user=TEST_USER)
+
+    alerts = [
+        AnomalyAlert(metric_name=metric, metric_value=150.0, expected_range_min=50.0, expected_range_max=100.0,
+                     severity='high', status='open', timestamp=now),
+        AnomalyAlert(metric_name=metric, metric_value=10.0, expected_range_min=50.0, expected_range_max=100.0,
+                     severity='critical', status='acknowledged', timestamp=now - timedelta(days=2)),
+        AnomalyAlert(metric_name=metric, metric_value=0.0, severity='high', status='resolved', timestamp=now),
+        AnomalyAlert(metric_name=metric, metric_value=0.0, severity='low', status='open',
+                     timestamp=now - timedelta(days=30))
+    ]
+    recommendations = [
+        Recommendation(entity_type='cliente', entity_id=-1 - i, rec_type=metric, title=f"{metric} {i}",
+                       status=status, impact_score=10 ** 9 - i)
+        for i, status in enumerate(['open', 'open', 'dismissed'])
+    ]
+    db.add_all(alerts + recommendations)
+    db.commit()
+
+    try:
+        sections = dispatcher._generate_anomaly_alert({'lookback_days': 7})
+        anomalies = {
+            severity: [item for item in items if item['metric'] == metric]
+            for severity, items in _section(sections, '🚨 Anomalías Detectadas')['data'].items()
+        }
+        assert [len(anomalies[severity]) for severity in ('critical', 'high', 'medium', 'low')] == [1, 1, 0, 0]
+        assert anomalies['high'][0]['deviation'] == '+50%' and anomalies['critical'][0]['deviation'] == '-80%'
+        assert anomalies['high'][0]['expected'] == '50.00 - 100.00'
+
+        titles = _section(sections, '🎯 Recomendaciones')['data']
+        assert titles[:2] == [f"{metric} 0", f"{metric} 1"] and f"{metric} 2" not in titles
+        print("   ✅ Anomalías vigentes por severidad y recomendaciones abiertas")
+
+    finally:
+        for row in alerts + recommendations:
+            db.delete(row)
+        db.commit()
+        db.close()
+        dispatcher.close()
+
+
+def test_partitioned_batch():
+    print("🧪 Probando un lote particionado por vendedor")
+
+    period, month_start = '2091-05', date(2091, 5, 1)
+    suffix = time.time_ns()
+    output_dir = tempfile.mkdtemp(prefix="ard_batch_")
+    db = SessionLocal()
+    dispatcher = AutomatedReportingDispatcher(user=TEST_USER)
+    dispatcher.output_dir = output_dir
+    # Sin credenciales SMTP los destinatarios quedan como 'skipped'
+    dispatcher.distributor = ReportDistributor(sender_email='', sender_password='', sink='smtp')
+
+    sellers = []
+    try:
+        for index, invoices in enumerate([[1000.0, 2000.0], [500.0]]):
+            vendedor, cliente = _seed_seller(db, f"{suffix}{index}")
+            for number, total in enumerate(invoices):
+                _add_invoice(db, cliente, f"B{suffix}-{index}-{number}", month_start + timedelta(days=number),
+                             total, paid=total, estado=EstadoFacturaEnum.pagada)
+            sellers.append((vendedor, cliente, invoices))
+        db.commit()
+
+        result = dispatcher.generate_report_batch(
+            {'type': 'monthly_finance', 'name': 'Lote de prueba', 'title': 'Finanzas', 'period': period,
+             'format': 'json', 'partition_by': 'vendedor'},
+            max_workers=2
+        )
+        assert result['success'], result
+
+        # Una variante por vendedor activo y ninguna global (no hay destinatarios globales)
+        active = db.query(Vendedor).filter(Vendedor.activo == 1).count()
+        assert len(result['variants']) == result['generated'] == active
+        variants = {variant['key']: variant for variant in result['variants']}
+        assert 'global' not in variants
+
+        for vendedor, _, invoices in sellers:
+            variant = variants[f"vendedor_{vendedor.id}"]
+            file_name = os.path.basename(variant['file_generated'])
+            assert file_name.startswith(f"monthly_finance_vendedor_{vendedor.id}_") and file_name.endswith('.json')
+            assert variant['title'] == f"Finanzas - {vendedor.nombre}"
+            assert variant['distribution_status']['email'][0]['status'] == 'skipped'
+            assert variant['detail_rows'] == len(invoices)
+
+            with open(variant['file_generated'], encoding='utf-8') as f:
+                sections = json.load(f)['sections']
+            status = _section(sections, '📊 Estado de Cobranzas')['data']
+            assert status['paid_invoices'] == len(invoices) and status['pending_invoices'] == 0
+            detail = _section(sections, '📄 Facturas del Mes')
+            assert sum(row[5] for row in detail['rows']) == sum(invoices)
+        print(f"   ✅ {len(result['variants'])} variantes con sus archivos y totales por vendedor")
+
+    finally:
+        _cleanup(db, [cliente.id for _, cliente, _ in sellers], [vendedor.id for vendedor, _, _ in sellers])
+        db.close()
+        dispatcher.close()
+        shutil.rmtree(output_dir)
+
+
+def test_compute_next_run():
+    print("🧪 Probando cálculo de la próxima ejecución")
+
+    assert compute_next_run('hourly', datetime(2024, 1, 1, 10, 15), minute=30) == datetime(2024, 1, 1, 10, 30)
+    assert compute_next_run('hourly', datetime(2024, 1, 1, 10, 30), minute=30) == datetime(2024, 1, 1, 11, 30)
+    assert compute_next_run('daily', datetime(2024, 1, 1, 9, 0), hour=9) == datetime(2024, 1, 2, 9, 0)
+    assert compute_next_run('daily', datetime(2024, 12, 31, 23, 0), hour=8) == datetime(2025, 1, 1, 8, 0)
+    # 2024-01-03 es miércoles; day_of_week 0 = lunes
+    assert compute_next_run('weekly', datetime(2024, 1, 3, 12, 0), hour=9, day_of_week=0) == datetime(2024, 1, 8, 9, 0)
+
+    # Fin de mes: el día 31 se ajusta al último día de los meses más cortos
+    assert compute_next_run('monthly', datetime(2024, 1, 31, 10, 0), hour=9, day_of_month=31) == datetime(2024, 2, 29, 9, 0)
+    assert compute_next_run('monthly', datetime(2025, 1, 31, 10, 0), hour=9, day_of_month=31) == datetime(2025, 2, 28, 9, 0)
+    assert compute_next_run('monthly', datetime(2025, 2, 28, 9, 0), hour=9, day_of_month=31) == datetime(2025, 3, 31, 9, 0)
+    assert compute_next_run('monthly', datetime(2025, 1, 31, 8, 0), hour=9, day_of_month=31) == datetime(2025, 1, 31, 9, 0)
+    assert compute_next_run('monthly', datetime(2024, 12, 15), hour=9, day_of_month=1) == datetime(2025, 1, 1, 9, 0)
+
+    try:
+        compute_next_run('yearly', datetime(2024, 1, 1))
+        assert False, "Se esperaba error por frecuencia no soportada"
+    except ValueError:
+        pass
+    print("   ✅ Frecuencias horaria, diaria, semanal y mensual (fin de mes)")
+
+
+def test_scheduler_single_claim():
+    print("🧪 Probando que una programación vencida se reserva una sola vez")
+
+    instances = [ReportScheduler(lease_seconds=60) for _ in range(4)]
+    schedule = instances[0].schedule({'type': 'weekly_summary', 'name': f"test_{time.time_ns()}"},
+                                     {'frequency': 'daily', 'hour': 9})
+    db = SessionLocal()
+    try:
+        # Vencida hace más de 3 días: las 3 ocurrencias diarias siguientes también vencieron
+        overdue = compute_next_run('daily', datetime.now() - timedelta(days=4), hour=9)
+        db.query(ReportSchedule).filter(ReportSchedule.id == schedule['id']).update({'next_run_at': overdue})
+        db.commit()
+
+        barrier = threading.Barrier(len(instances))
+        claims = {}
+
+        def claim(instance):
+            barrier.wait()
+            claims[instance.worker_id] = [c for c in instance._claim_due(10) if c[0] == schedule['id']]
+
+        threads = [threading.Thread(target=claim, args=(instance,)) for instance in instances]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        winners = [worker_id for worker_id, claimed in claims.items() if claimed]
+        assert len(winners) == 1, claims
+        (_, _, missed_runs), = claims[winners[0]]
+        assert missed_runs == 3
+
+        row = db.get(ReportSchedule, schedule['id'])
+        assert row.locked_by == winners[0] and row.locked_until > datetime.now()
+        # Con el lease vigente ninguna otra instancia la obtiene
+        assert not [c for c in ReportScheduler()._claim_due(10) if c[0] == schedule['id']]
+        print(f"   ✅ Reservada solo por {winners[0]} ({missed_runs} ejecuciones perdidas agrupadas)")
+    finally:
+        db.query(ReportRun).filter(ReportRun.schedule_id == schedule['id']).delete()
+        db.query(ReportSchedule).filter(ReportSchedule.id == schedule['id']).delete()
+        db.commit()
+        db.close()
+
+
+class _SlowScheduler(ReportScheduler):
+    """Scheduler cuyo reporte tarda `duration` segundos y falla al registrar su resultado si `broken`"""
+
+    def __init__(self, duration, broken=False, **kwargs):
+        super().__init__(**kwargs)
+        self.duration = duration
+        self.broken = broken
+        self.leases = []
+
+    def _run_report(self, report_config):
+        deadline = time.time() + self.duration
+        while time.time() < deadline:
+            db = SessionLocal()
+            try:
+                self.leases.append(db.query(ReportSchedule.locked_until).filter(
+                    ReportSchedule.locked_by == self.worker_id).scalar())
+            finally:
+                db.close()
+            time.sleep(0.5)
+        return {'success': True}
+
+    def _output_size(self, result):
+        if self.broken:
+            raise RuntimeError("fallo al registrar la ejecución")
+        return super()._output_size(result)
+
+
+def test_scheduler_lease_heartbeat():
+    print("🧪 Probando la renovación y liberación del lease")
+
+    db = SessionLocal()
+    schedule_ids = []
+    try:
+        for broken in (False, True):
+            scheduler = _SlowScheduler(duration=2.5 if not broken else 0, broken=broken, lease_seconds=3)
+            schedule = scheduler.schedule({'type': 'weekly_summary', 'name': f"test_{time.time_ns()}"},
+                                          {'frequency': 'daily', 'hour': 9})
+            schedule_ids.append(schedule['id'])
+            db.query(ReportSchedule).filter(ReportSchedule.id == schedule['id']).update(
+                {'next_run_at': datetime.now() - timedelta(minutes=1)})
+            db.commit()
+
+            [(schedule_id, scheduled_for, missed_runs)] = [
+                claim for claim in scheduler._claim_due(10) if claim[0] == schedule['id']
+            ]
+            status = scheduler._execute(schedule_id, scheduled_for, missed_runs)
+
+            db.expire_all()
+            row = db.get(ReportSchedule, schedule_id)
+            run = db.query(ReportRun).filter(ReportRun.schedule_id == schedule_id).one()
+            # Terminada o fallida, la programación queda libre y agendada hacia adelante
+            assert row.locked_by is None and row.locked_until is None and row.next_run_at > datetime.now()
+            if broken:
+                assert status == 'failed' and run.status == 'failed'
+                assert run.error == "fallo al registrar la ejecución"
+            else:
+                assert status == 'success' and run.status == 'success'
+                # El lease de 3 s se extendió mientras el reporte corría
+                assert len(set(scheduler.leases)) > 1 and scheduler.leases[-1] > scheduler.leases[0], scheduler.leases
+        print("   ✅ Lease extendido durante la ejecución y liberado al terminar o fallar")
+    finally:
+        db.query(ReportRun).filter(ReportRun.schedule_id.in_(schedule_ids)).delete(synchronize_session=False)
+        db.query(ReportSchedule).filter(ReportSchedule.id.in_(schedule_ids)).delete(synchronize_session=False)
+        db.commit()
+        db.close()
+
+
+class _TestDistributor(ReportDistributor):
+    """Distribuidor cuyos workers usan el transporte que entrega `transport_factory`"""
+
+    def __init__(self, transport_factory, **kwargs):
+        super().__init__(sender_email='reportes@test.local', sender_password='x', sink='file', **kwargs)
+        self.transport_factory = transport_factory
+
+    def _transport(self):
+        return self.transport_factory()
+
+
+class _FlakyTransport:
+    """Falla de forma transitoria las primeras veces por destinatario; rechaza 'rechazado@'"""
+
+    failures = {}
+
+    def __init__(self):
+        self.connections_opened = 1
+
+    def send(self, sender, recipient, message):
+        if recipient.startswith('rechazado@'):
+            raise PermanentDeliveryError("550 buzón inexistente")
+        count = self.failures.get(recipient, 0)
+        if count < 2:
+            self.failures[recipient] = count + 1
+            raise OSError("conexión reiniciada")
+
+    def close(self):
+        pass
+
+
+class _AuthRejectingSmtpHandler(socketserver.StreamRequestHandler):
+    """Servidor SMTP mínimo que rechaza toda autenticación"""
+
+    def handle(self):
+        self.wfile.write(b"220 test\r\n")
+        for line in self.rfile:
+            command = line.decode().strip().upper()
+            if command.startswith("EHLO"):
+                self.wfile.write(b"250-test\r\n250 AUTH PLAIN LOGIN\r\n")
+            elif command.startswith("AUTH"):
+                self.wfile.write(b"535 5.7.8 credenciales rechazadas\r\n")
+            elif command.startswith("QUIT"):
+                self.wfile.write(b"221 bye\r\n")
+                return
+            else:
+                self.wfile.write(b"250 ok\r\n")
+
+
+class _WebhookHandler(BaseHTTPRequestHandler):
+    """Webhook local: /lento responde después que /rapido"""
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path == '/lento':
+            time.sleep(0.3)
+        self.send_response(404 if self.path == '/no_existe' else 200)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def _deliveries(count, recipients_each, **extra):
+    return [{'subject': f"Reporte {i}", 'body': 'cuerpo',
+             'recipients': [f"usuario{i}_{j}@test.local" for j in range(recipients_each)], **extra}
+            for i in range(count)]
+
+
+def test_distribution_file_sink_and_retries():
+    print("🧪 Probando distribución con sink de archivos, reintentos y límite de envíos")
+
+    outbox = tempfile.mkdtemp(prefix="ard_outbox_")
+    try:
+        attachment = os.path.join(outbox, 'reporte.json')
+        with open(attachment, 'w', encoding='utf-8') as f:
+            f.write('{"ok": true}')
+
+        distributor = _TestDistributor(lambda: FileTransport(outbox), connections=3, rate=0)
+        results = distributor.distribute(_deliveries(2, 3, attachment_path=attachment,
+                                                     attachment_name='semanal.json', mime_type='application/json'))
+        assert [len(result['email']) for result in results] == [3, 3]
+        assert all(outcome['status'] == 'sent' for result in results for outcome in result['email'])
+        messages = [name for name in os.listdir(outbox) if name.endswith('.eml')]
+        assert len(messages) == 6
+        with open(os.path.join(outbox, messages[0]), 'rb') as f:
+            message = email.message_from_bytes(f.read())
+        attachments = [part.get_filename() for part in message.walk() if part.get_filename()]
+        assert attachments == ['semanal.json']
+
+        # Errores transitorios se reintentan con backoff; los permanentes no
+        _FlakyTransport.failures = {}
+        distributor = _TestDistributor(_FlakyTransport, connections=2, rate=0, retries=3, backoff=0.01)
+        deliveries = _deliveries(1, 2)
+        deliveries[0]['recipients'].append('rechazado@test.local')
+        outcomes = {o['recipient']: o for o in distributor.distribute(deliveries)[0]['email']}
+        assert all(outcomes[f"usuario0_{j}@test.local"]['attempts'] == 3 for j in range(2))
+        assert outcomes['rechazado@test.local']['status'] == 'failed'
+        assert outcomes['rechazado@test.local']['attempts'] == 1
+
+        # Sin reintentos suficientes el envío queda fallido
+        _FlakyTransport.failures = {}
+        distributor = _TestDistributor(_FlakyTransport, connections=1, rate=0, retries=1, backoff=0.01)
+        outcome = distributor.distribute(_deliveries(1, 1))[0]['email'][0]
+        assert outcome['status'] == 'failed' and outcome['attempts'] == 2
+
+        # Límite de 5 envíos por segundo (ráfaga de 5): 10 envíos toman al menos ~1 s
+        distributor = _TestDistributor(lambda: FileTransport(outbox), connections=4, rate=5)
+        start = time.time()
+        results = distributor.distribute(_deliveries(2, 5))
+        elapsed = time.time() - start
+        assert sum(len(result['email']) for result in results) == 10
+        assert elapsed >= 0.9, elapsed
+        print(f"   ✅ Adjuntos, reintentos y límite de envíos (10 emails en {elapsed:.1f} s)")
+    finally:
+        shutil.rmtree(outbox)
+
+
+def test_distribution_auth_failure_aborts():
+    print("🧪 Probando que el rechazo de credenciales SMTP aborta la distribución")
+
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), _AuthRejectingSmtpHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+    try:
+        distributor = _TestDistributor(lambda: SmtpTransport('127.0.0.1', port, 'usuario', 'clave', use_tls=False),
+                                       connections=3, rate=0, retries=3, backoff=1)
+        start = time.time()
+        results = distributor.distribute(_deliveries(3, 5))
+        outcomes = [outcome for result in results for outcome in result['email']]
+        assert len(outcomes) == 15
+        assert all(outcome['status'] == 'failed' and 'Autenticación SMTP rechazada' in outcome['error']
+                   for outcome in outcomes)
+        # Sin reintentos ni backoff: los pendientes se marcan fallidos sin intentar enviarlos
+        assert time.time() - start < 1
+        assert max(outcome['attempts'] for outcome in outcomes) == 1
+        assert sum(1 for outcome in outcomes if outcome['attempts'] == 0) >= 15 - 3
+        print("   ✅ 15 destinatarios marcados fallidos con un solo intento de login por worker")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_distribution_webhooks_and_running_loop():
+    print("🧪 Probando orden de webhooks, Slack y llamada desde un event loop")
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _WebhookHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    outbox = tempfile.mkdtemp(prefix="ard_outbox_")
+    dispatcher = AutomatedReportingDispatcher(user=TEST_USER)
+    try:
+        dispatcher.distributor = _TestDistributor(lambda: FileTransport(outbox), rate=0, retries=0)
+        dispatcher.default_config['webhook_slack'] = f"{base_url}/lento"
+
+        report_path = os.path.join(outbox, 'reporte.json')
+        formatted = write_report('json', _sample_report(detail_count=3), lambda extension: report_path)
+        config = {'type': 'weekly_summary', 'title': 'Semanal', 'recipients': ['a@test.local'],
+                  'slack_notification': True,
+                  'webhook_urls': [f"{base_url}/lento", f"{base_url}/no_existe", f"{base_url}/rapido"]}
+
+        with_slack, without_slack = dispatcher._distribute_reports([
+            (formatted, config),
+            (formatted, {**config, 'slack_notification': False, 'webhook_urls': []})
+        ])
+        assert with_slack['slack']['name'] == 'slack' and with_slack['slack']['status'] == 'sent'
+        assert [webhook['name'] for webhook in with_slack['webhooks']] == config['webhook_urls']
+        assert [webhook['status'] for webhook in with_slack['webhooks']] == ['sent', 'failed', 'sent']
+        assert without_slack['slack'] is None and without_slack['webhooks'] == []
+        assert with_slack['email'][0]['status'] == 'sent'
+
+        async def from_running_loop():
+            return dispatcher.distributor.distribute(_deliveries(1, 2))
+
+        results = asyncio.run(from_running_loop())
+        assert [outcome['status'] for outcome in results[0]['email']] == ['sent', 'sent']
+        print("   ✅ Resultados en el orden configurado y distribución segura dentro de un loop")
+    finally:
+        dispatcher.close()
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(outbox)
+
+
+if __name__ == "__main__":
+    test_report_writers()
+    test_weekly_dataset()
+    test_monthly_dataset()
+    test_anomaly_alert_sections()
+    test_partitioned_batch()
+    test_compute_next_run()
+    test_scheduler_single_claim()
+    test_scheduler_lease_heartbeat()
+    test_distribution_file_sink_and_retries()
+    test_distribution_auth_failure_aborts()
+    test_distribution_webhooks_and_running_loop()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+Script de prueba para Generative Data Assistant (GDA)
+"""
+
+import random
+import re
+import time
+from datetime import date
+
+import testing_env  # noqa: F401
+from generative_assistant import classify_intent, GenerativeDataAssistant, INTENT_PATTERNS, parse_date_range
+from llm_providers import DRAFT_MARKER, FakeLLMProvider, LLMProvider, LLMTimeoutError, llm_runtime
+
+
+def _reference_classify(query):
+    """Clasificación original (un re.search por patrón y findall de fechas y números)"""
+    query_type = 'general'
+    max_matches = 0
+    for tipo, patterns_list in INTENT_PATTERNS.items():
+        matches = sum(1 for pattern in patterns_list if re.search(pattern, query))
+        if matches > max_matches:
+            max_matches = matches
+            query_type = tipo
+
+    date_pattern = (r'\b(?:\d{1,2}/\d{1,2}/\d{4}|enero|febrero|marzo|abril|mayo|junio|julio|agosto|septiembre'
+                    r'|octubre|noviembre|diciembre|(?:19|20)\d{2})\b')
+    number_pattern = r'\d+(?:\.\d+)?'
+    entities = re.findall(date_pattern, query, re.IGNORECASE) + re.findall(number_pattern, query)
+    return query_type, entities
+
+
+def _query_corpus(size=5000, seed=36):
+    """Consultas escritas a mano más combinaciones aleatorias de palabras clave, fechas y números"""
+    corpus = [
+        'clientes con valor mayor a 1000000',
+        'facturas de 150000',
+        'monto promedio 1500.5',
+        'extrañ comparar usuario',
+        'valor de vida del cliente versus ventas',
+        'ventas de marzo 2024',
+        'facturas vencidas entre 01/02/2024 y 15/03/2024',
+        'cómo está el rendimiento general',
+        'comparar la facturación del año pasado',
+        'hay alguna anomalía en las cobranzas',
+        '',
+    ]
+    words = sorted({re.sub(r'[.*]', '', p) for patterns in INTENT_PATTERNS.values() for p in patterns})
+    words += ['comparar', 'valor', 'vida', 'de', 'la', 'del', 'rendimiento', 'Marzo', 'agosto', 'total']
+    rng = random.Random(seed)
+    for _ in range(size):
+        tokens = []
+        for _ in range(rng.randint(1, 6)):
+            kind = rng.random()
+            if kind < 0.6:
+                tokens.append(rng.choice(words))
+            elif kind < 0.75:
+                tokens.append(str(rng.randint(0, 10 ** rng.randint(1, 9))))
+            elif kind < 0.85:
+                tokens.append(f"{rng.randint(0, 99999)}.{rng.randint(0, 99)}")
+            else:
+                tokens.append(f"{rng.randint(1, 28)}/{rng.randint(1, 12)}/{rng.randint(2000, 2030)}")
+        corpus.append(rng.choice(['', ' ']).join(tokens))
+    return corpus
+
+
+def test_classify_intent_matches_reference():
+    print("🧪 Comparando classify_intent con la clasificación original")
+
+    assert classify_intent('clientes con valor mayor a 1000000') == ('clientes', ('1000000',))
+    assert classify_intent('facturas de 150000')[1] == ('150000',)
+    assert classify_intent('monto promedio 1500.5')[1] == ('1500.5',)
+    assert classify_intent('extrañ comparar usuario')[0] == 'anomalias'
+
+    corpus = _query_corpus()
+    differences = []
+    for query in corpus:
+        query_type, entities = classify_intent(query)
+        expected = _reference_classify(query)
+        if (query_type, list(entities)) != expected:
+            differences.append((query, (query_type, entities), expected))
+
+    assert not differences, f"{len(differences)} consultas difieren, p.ej. {differences[:3]}"
+    print(f"   ✅ {len(corpus)} consultas clasificadas igual que la versión original")
+
+
+def test_date_range_whole_tokens():
+    print("🧪 Probando que las fechas se reconocen solo como palabras completas")
+
+    today = date(2026, 6, 15)
+    for query in ('facturas con monto mayor a 2000000', 'clientes con valor mayor a 500000',
+                  'ventas de 20150 clp'):
+        entities = list(classify_intent(query)[1])
+        assert parse_date_range(entities, today) is None, (query, entities)
+
+    def date_range(query):
+        return parse_date_range(list(classify_intent(query)[1]), today)
+
+    assert date_range('ventas de mayo') == (date(2026, 5, 1), date(2026, 6, 1))
+    assert date_range('ventas de Mayo 2024 mayores a 1000') == (date(2024, 5, 1), date(2024, 6, 1))
+    assert date_range('facturación del 2023') == (date(2023, 1, 1), date(2024, 1, 1))
+    assert date_range('facturas entre 01/02/2024 y 15/03/2024') == (date(2024, 2, 1), date(2024, 3, 16))
+    assert date_range('clientes 1500 y 3000') is None
+    print("   ✅ 'mayor' no es mayo y los montos no se leen como años")
+
+
+class _FailingProvider(LLMProvider):
+    """Proveedor que falla antes del primer token"""
+
+    name = "failing"
+
+    async def stream(self, prompt, system=None):
+        raise RuntimeError("proveedor caído")
+        yield  # pragma: no cover
+
+
+def test_fake_provider_streams_words():
+    print("🧪 Probando FakeLLMProvider")
+
+    prompt = f"Contexto\n{DRAFT_MARKER}\nLas ventas  de marzo suman 1500."
+    tokens = list(llm_runtime.stream(FakeLLMProvider(), prompt))
+    assert tokens == ['Las ', 'ventas  ', 'de ', 'marzo ', 'suman ', '1500.']
+
+    tokens = list(llm_runtime.stream(FakeLLMProvider(), "hola"))
+    assert "".join(tokens) == "Respuesta de prueba para: hola"
+
+    answer = llm_runtime.run(FakeLLMProvider().complete(prompt))
+    assert answer == "Las ventas  de marzo suman 1500."
+    print("   ✅ Tokens palabra por palabra a partir del borrador")
+
+
+def test_stream_timeouts():
+    print("🧪 Probando timeouts del runtime LLM")
+    prompt = f"{DRAFT_MARKER} " + " ".join(f"palabra{i}" for i in range(50))
+
+    start = time.time()
+    try:
+        list(llm_runtime.stream(FakeLLMProvider(first_token_delay=1.0), prompt,
+                                first_token_timeout=0.1, timeout=5))
+        assert False, "Se esperaba LLMTimeoutError por el primer token"
+    except LLMTimeoutError as e:
+        assert "primer token" in str(e)
+    assert time.time() - start < 0.8
+
+    received = []
+    start = time.time()
+    try:
+        for token in llm_runtime.stream(FakeLLMProvider(token_delay=0.05), prompt,
+                                        first_token_timeout=1, timeout=0.3):
+            received.append(token)
+        assert False, "Se esperaba LLMTimeoutError por la respuesta completa"
+    except LLMTimeoutError as e:
+        assert "respuesta" in str(e)
+    assert 0 < len(received) < 50
+    assert time.time() - start < 1.0
+    print(f"   ✅ Primer token y respuesta completa cortados a tiempo ({len(received)} tokens recibidos)")
+
+
+def test_stream_query_events():
+    print("🧪 Probando stream_query con el proveedor fake")
+    query = f"cuántos clientes hay {time.time_ns()}"
+
+    expected = GenerativeDataAssistant(llm_provider='mock').process_query(query)
+    assert expected['success'], expected
+
+    events = list(GenerativeDataAssistant(llm_provider='fake').stream_query(query))
+    assert [e['event'] for e in events[:-1]] == ['token'] * (len(events) - 1)
+    assert len(events) > 2
+    done = events[-1]
+    assert done['event'] == 'done'
+    assert done['result']['success'] and not done['result']['cached']
+    assert "".join(e['text'] for e in events[:-1]) == done['result']['response'] == expected['response']
+
+    # Segunda vez: respuesta cacheada en un solo evento
+    events = list(GenerativeDataAssistant(llm_provider='fake').stream_query(query))
+    assert len(events) == 2 and events[-1]['result']['cached']
+
+    # Proveedor caído: se responde con el borrador basado en reglas y no se cachea
+    assistant = GenerativeDataAssistant(llm_provider='fake')
+    assistant.provider = _FailingProvider()
+    events = list(assistant.stream_query(query + " otra vez"))
+    result = events[-1]['result']
+    assert result['success'] and 'proveedor caído' in result['llm_error']
+    assert events[0]['text'] == result['response']
+    print("   ✅ Tokens seguidos de 'done', cache y respaldo por reglas")
+
+
+if __name__ == "__main__":
+    test_classify_intent_matches_reference()
+    test_date_range_whole_tokens()
+    test_fake_provider_streams_words()
+    test_stream_timeouts()
+    test_stream_query_events()
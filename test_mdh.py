@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Script de prueba para Metrics Definition Hub (MDH): DSL de fórmulas, DAG de dependencias
+y métricas de ejemplo
+"""
+
+import os
+import shutil
+import tempfile
+
+import yaml
+from sqlalchemy import select
+
+import testing_env  # noqa: F401
+from metric_dsl import MetricCompileError, compile_formula
+from metrics_hub import MetricsRegistry
+
+
+def _assert_compile_error(formula, expected):
+    try:
+        compile_formula(formula)
+    except MetricCompileError as e:
+        assert expected in str(e), f"{formula!r}: {e}"
+        return
+    raise AssertionError(f"Se esperaba error de compilación para {formula!r}")
+
+
+def test_dsl_compile():
+    print("🧪 Probando compilación del DSL de métricas")
+
+    plan = compile_formula('SUM(facturas.monto_total) WHERE estado = "Pagada"')
+    assert plan.tables == ['facturas']
+    assert plan.references == []
+    assert len(plan.aggregates) == 1
+
+    plan = compile_formula('(COUNT(clientes WHERE estado_funnel = "Ganado") / clientes_activos) * 100')
+    assert plan.tables == ['clientes']
+    assert plan.references == ['clientes_activos']
+    aggregate_key = next(iter(plan.aggregates))
+    assert plan.evaluate({aggregate_key: 5}, {'clientes_activos': 20}) == 25.0
+    # División por cero y valores faltantes no lanzan excepción
+    assert plan.evaluate({aggregate_key: 5}, {'clientes_activos': 0}) is None
+    assert plan.evaluate({aggregate_key: None}, {'clientes_activos': 20}) is None
+
+    assert compile_formula('-SUM(cobranzas.monto) + 10 * 2').tables == ['cobranzas']
+    print("   ✅ Fórmulas válidas compiladas y evaluadas")
+
+
+def test_dsl_errors():
+    print("🧪 Probando errores de parseo y compilación del DSL")
+
+    _assert_compile_error('SUM(facturas.monto_total', "Fin inesperado")
+    _assert_compile_error('SUM(facturas.no_existe)', "Columna inexistente: facturas.no_existe")
+    _assert_compile_error('AVG(encuestas.score)', "Tabla inexistente: encuestas")
+    _assert_compile_error('COUNT(clientes WHERE estado_funnel = "Inexistente")', "inválido para estado_funnel")
+    _assert_compile_error('SUM(facturas.monto_total) WHERE estado ~ 1', "Símbolo inesperado")
+    _assert_compile_error('FOO(facturas.monto_total)', "Símbolo inesperado")
+    _assert_compile_error('1 +', "Expresión inválida")
+    print("   ✅ Errores reportados con MetricCompileError")
+
+
+def test_dependency_graph():
+    print("🧪 Probando DAG de dependencias entre métricas")
+
+    metrics_dir = tempfile.mkdtemp(prefix="mdh_test_")
+    try:
+        metrics = [
+            {'id': 'base', 'formula': 'COUNT(clientes)'},
+            {'id': 'derivada', 'formula': 'base * 2'},
+            {'id': 'ciclo_a', 'formula': 'ciclo_b + 1'},
+            {'id': 'ciclo_b', 'formula': 'ciclo_a + 1'},
+            {'id': 'huerfana', 'formula': 'no_definida / 2'},
+            {'id': 'declarada', 'formula': 'COUNT(facturas)', 'depends_on': ['tampoco_existe']},
+            {'id': 'rota', 'formula': 'SUM(clientes.active)'},
+        ]
+        with open(os.path.join(metrics_dir, 'test.yaml'), 'w', encoding='utf-8') as f:
+            yaml.safe_dump({'version': '1.0', 'metrics': metrics}, f, allow_unicode=True)
+
+        registry = MetricsRegistry(metrics_dir)
+        registry.refresh(force=True)
+        snapshot = registry.snapshot()
+        errors = snapshot.compile_errors
+
+        assert 'base' not in errors and 'derivada' not in errors
+        assert snapshot.evaluation_order['base'] < snapshot.evaluation_order['derivada']
+        assert errors['ciclo_a'].startswith("Dependencia circular")
+        assert errors['ciclo_b'].startswith("Dependencia circular")
+        assert errors['huerfana'] == "Dependencia no encontrada: no_definida"
+        assert errors['declarada'] == "Dependencia no encontrada: tampoco_existe"
+        assert errors['rota'] == "Columna inexistente: clientes.active"
+        print(f"   ✅ {len(errors)} métricas marcadas como no calculables")
+    finally:
+        shutil.rmtree(metrics_dir)
+
+
+def test_date_windows_fused():
+    print("🧪 Probando ventanas DATE_SUB distintas en un mismo SELECT")
+
+    aggregates = []
+    for days in ('7', '7.5', '30'):
+        plan = compile_formula(f'COUNT(facturas WHERE fecha_emision >= DATE_SUB(NOW(), {days}))')
+        aggregates.extend(plan.aggregates.values())
+
+    params = select(*[aggregate.sql_expression() for aggregate in aggregates]).compile().params
+    windows = sorted(value for name, value in params.items() if name.startswith('now_minus_'))
+    assert len(windows) == 3, params
+    assert round((windows[2] - windows[1]).total_seconds()) == 12 * 3600  # 7 vs 7.5 días
+    print("   ✅ Cada ventana conserva su propio parámetro")
+
+
+def test_sample_metrics_compile():
+    print("🧪 Probando la compilación de las métricas de ejemplo")
+
+    registry = MetricsRegistry('metrics/')
+    registry.refresh(force=True)
+    snapshot = registry.snapshot()
+    assert snapshot.loaded_metrics, "No se cargaron métricas de ejemplo"
+
+    # Las definiciones que dependen de datos fuera del esquema quedan cargadas pero marcadas
+    # como no calculables en lugar de desaparecer del catálogo
+    assert snapshot.compile_errors == {
+        'client_lifetime_value': "Columna inexistente: clientes.active",
+        'customer_satisfaction': "Tabla inexistente: encuestas",
+    }, snapshot.compile_errors
+    for metric_id in snapshot.compile_errors:
+        assert metric_id in snapshot.loaded_metrics
+    for metric_id in ('revenue_total', 'conversion_rate', 'clientes_activos', 'churn_rate'):
+        assert metric_id in snapshot.loaded_metrics and metric_id not in snapshot.compile_errors
+    print(f"   ✅ {len(snapshot.loaded_metrics)} métricas cargadas, "
+          f"{len(snapshot.compile_errors)} marcadas como no calculables")
+
+
+if __name__ == "__main__":
+    test_dsl_compile()
+    test_dsl_errors()
+    test_dependency_graph()
+    test_date_windows_fused()
+    test_sample_metrics_compile()
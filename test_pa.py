@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Script de prueba para el Prescriptive Advisor (PA): almacén de recomendaciones y
+regeneración incremental por cliente
+"""
+
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import update
+
+import testing_env  # noqa: F401
+from database import SessionLocal
+from models import Cliente, Factura, RecommendationWatermark
+from prescriptive_advisor import CLIENT_REFRESH_MARK, PrescriptiveAdvisor
+
+
+def _refresh(pa, **kwargs):
+    result = pa.refresh_recommendation_store(**kwargs)
+    assert result['success'], result
+    return result['results']['clientes']
+
+
+def test_incremental_refresh():
+    print("🧪 Probando la regeneración incremental de recomendaciones")
+
+    suffix = time.time_ns()
+    db = SessionLocal()
+    pa = PrescriptiveAdvisor()
+    clientes = [Cliente(nombre=f"Cliente {i}", rut=f"PA-{suffix}-{i}", valor_estimado=500.0) for i in range(3)]
+    db.add_all(clientes)
+    db.commit()
+
+    try:
+        # Almacén sin regenerar: la primera lectura lo puebla
+        db.query(RecommendationWatermark).filter(
+            RecommendationWatermark.entity_type == CLIENT_REFRESH_MARK
+        ).delete()
+        db.commit()
+        assert pa.get_stored_recommendations(entity_types=["cliente"])['success']
+        assert db.query(RecommendationWatermark).filter(
+            RecommendationWatermark.entity_type == CLIENT_REFRESH_MARK
+        ).count() == 1
+
+        # Sin escrituras desde la regeneración anterior no se recarga el estado de los clientes
+        yesterday = datetime.utcnow() - timedelta(days=1)
+        db.execute(update(Cliente).values(updated_at=yesterday))
+        db.execute(update(Factura).values(updated_at=yesterday))
+        db.commit()
+        unchanged = _refresh(pa)
+        assert unchanged['clients_reevaluated'] == 0, unchanged
+        assert unchanged['clients_loaded'] < unchanged['clients_total'], unchanged
+
+        # Un cliente nuevo o modificado se carga y reevalúa
+        cliente = Cliente(nombre="Cliente de prueba", rut=f"PA-{suffix}", valor_estimado=1000.0)
+        db.add(cliente)
+        db.commit()
+        clientes.append(cliente)
+        assert _refresh(pa)['clients_reevaluated'] == 1
+
+        cliente.valor_estimado = 2000.0
+        db.commit()
+        modified = _refresh(pa)
+        assert modified['clients_reevaluated'] == 1 and modified['clients_loaded'] < modified['clients_total']
+
+        # Un cliente eliminado pierde su huella
+        client_id = cliente.id
+        db.delete(clientes.pop())
+        db.commit()
+        _refresh(pa)
+        assert not db.query(RecommendationWatermark).filter(
+            RecommendationWatermark.entity_type == "cliente",
+            RecommendationWatermark.entity_id == client_id
+        ).count()
+
+        full = _refresh(pa, full=True)
+        assert full['clients_loaded'] == full['clients_total'] and full['clients_reevaluated'] == 0, full
+        print(f"   ✅ {unchanged['clients_loaded']} de {unchanged['clients_total']} clientes cargados sin cambios")
+
+    finally:
+        for cliente in clientes:
+            db.delete(cliente)
+        db.commit()
+        db.close()
+        pa.close()
+
+
+if __name__ == "__main__":
+    test_incremental_refresh()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Script de prueba para el Predictive Modeling Engine (PME): cache de predicciones vigentes
+y registro de modelos
+"""
+
+import shutil
+import tempfile
+import time
+from datetime import date
+
+import numpy as np
+from sklearn.linear_model import LinearRegression, LogisticRegression
+
+import testing_env  # noqa: F401
+from cache import TTLCache, MISSING
+from database import SessionLocal
+from model_registry import ModelRegistry, compute_data_fingerprint
+from models import ModelArtifact
+from predictive_models import PredictiveModelEngine, _latest_predictions_cache
+
+
+def test_ttl_cache():
+    print("🧪 Probando TTLCache")
+
+    cache = TTLCache(maxsize=2, ttl=0.2)
+    assert cache.get('a') is MISSING
+    cache.set('a', None)
+    assert cache.get('a') is None  # None cacheado se distingue de MISSING
+
+    # LRU: al leer 'a', la entrada más antigua pasa a ser 'b'
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert cache.get('b') is MISSING and cache.get('a') is None and cache.get('c') == 3
+
+    # Expiración por TTL y TTL propio por entrada
+    cache.set('eterna', 1, ttl=None)
+    time.sleep(0.25)
+    assert cache.get('c') is MISSING
+    assert cache.get('eterna') == 1
+
+    calls = []
+    assert cache.get_or_set('x', lambda: calls.append(1) or 'cargado') == 'cargado'
+    assert cache.get_or_set('x', lambda: calls.append(1) or 'otro') == 'cargado'
+    assert len(calls) == 1
+
+    cache.set(('m', 1), 1)
+    assert cache.invalidate_where(lambda key: isinstance(key, tuple)) == 1
+    cache.clear()
+    assert len(cache) == 0
+    stats = cache.stats()
+    assert stats['hits'] > 0 and stats['misses'] > 0 and 0 < stats['hit_rate'] < 1
+    print("   ✅ LRU, TTL, get_or_set e invalidación")
+
+
+def _risk_records(values):
+    return [{
+        "target_date": date.today(),
+        "predicted_value": value,
+        "entity_id": entity_id,
+        "entity_type": "cliente"
+    } for entity_id, value in values.items()]
+
+
+def test_latest_predictions_cache():
+    print("🧪 Probando el cache de predicciones vigentes")
+
+    pme = PredictiveModelEngine()
+    prediction_type = f"test_riesgo_{time.time_ns()}"
+    _latest_predictions_cache.clear()
+
+    try:
+        pme._save_predictions_batch("test_modelo", prediction_type, _risk_records({1: 0.2, 2: 0.7}))
+
+        frame = pme.get_active_predictions_frame(prediction_type, entity_ids=[1, 2, 3])
+        assert dict(zip(frame['entity_id'], frame['predicted_value'])) == {1: 0.2, 2: 0.7}
+
+        # La segunda lectura, incluida la ausencia de la entidad 3, sale del cache
+        hits = _latest_predictions_cache.stats()['hits']
+        latest = pme.get_latest_predictions(prediction_type, [1, 2, 3])
+        assert latest['success'] and set(latest['predictions']) == {1, 2}
+        assert _latest_predictions_cache.stats()['hits'] == hits + 3
+
+        # Un lote parcial invalida solo las entidades reemplazadas
+        pme._save_predictions_batch("test_modelo", prediction_type, _risk_records({2: 0.9}), entity_ids=[2])
+        assert _latest_predictions_cache.get((prediction_type, "cliente", 1)) is not MISSING
+        assert _latest_predictions_cache.get((prediction_type, "cliente", 2)) is MISSING
+        frame = pme.get_active_predictions_frame(prediction_type, entity_ids=[1, 2])
+        assert dict(zip(frame['entity_id'], frame['predicted_value'])) == {1: 0.2, 2: 0.9}
+
+        # Sin entity_ids se recorre el tipo completo
+        frame = pme.get_active_predictions_frame(prediction_type)
+        assert sorted(frame['entity_id']) == [1, 2]
+        print("   ✅ Lecturas cacheadas e invalidadas al activar un lote nuevo")
+
+    finally:
+        pme.close()
+
+
+def test_model_registry():
+    print("🧪 Probando registro y servicio de modelos")
+
+    store_dir = tempfile.mkdtemp(prefix="pme_test_")
+    model_name = f"test_modelo_{time.time_ns()}"
+    db = SessionLocal()
+    registry = ModelRegistry(db=db, store_dir=store_dir)
+
+    try:
+        rng = np.random.default_rng(7)
+        X = rng.normal(size=(200, 3))
+        y = (X[:, 0] + X[:, 1] > 0).astype(int)
+        features = ['dias_mora', 'monto', 'facturas']
+
+        fingerprint = compute_data_fingerprint(X, y, features)
+        assert fingerprint == compute_data_fingerprint(X.copy(), y.copy(), features)
+        assert fingerprint != compute_data_fingerprint(X, y, list(reversed(features)))
+
+        assert not registry.has_model(model_name)
+        try:
+            registry.load(model_name)
+            assert False, "Se esperaba LookupError sin modelo registrado"
+        except LookupError:
+            pass
+
+        first = registry.register(model_name, LogisticRegression().fit(X, y), features, X, y,
+                                  prediction_type='pago')
+        assert first['success'] and first['version'] == 1, first
+        assert first['data_fingerprint'] == fingerprint
+
+        # Matriz, DataFrame (lista de dicts con columnas por nombre) y fila suelta
+        probabilities = registry.predict(model_name, X[:5])
+        assert probabilities.shape == (5,) and ((probabilities >= 0) & (probabilities <= 1)).all()
+        rows = [dict(zip(reversed(features), reversed(row))) for row in X[:5]]
+        assert np.allclose(registry.predict(model_name, rows), probabilities)
+        assert registry.predict(model_name, X[0]).shape == (1,)
+        assert registry.predict(model_name, np.empty((0, 3))).shape == (0,)
+        try:
+            registry.predict(model_name, X[:, :2])
+            assert False, "Se esperaba error por cantidad de features"
+        except ValueError:
+            pass
+
+        # Una nueva versión reemplaza a la vigente; sin predict_proba se usa predict
+        second = registry.register(model_name, LinearRegression().fit(X, X[:, 0]), features, X)
+        assert second['version'] == 2
+        assert registry.get_model_info(model_name)['artifact_id'] == second['artifact_id']
+        assert np.allclose(registry.predict(model_name, X[:3]), X[:3, 0])
+        active = [info for info in registry.list_models() if info['model_name'] == model_name]
+        assert [info['version'] for info in active] == [2]
+        print(f"   ✅ {model_name}: versiones 1 y 2 registradas y servidas")
+
+    finally:
+        db.query(ModelArtifact).filter(ModelArtifact.model_name == model_name).delete()
+        db.commit()
+        db.close()
+        shutil.rmtree(store_dir)
+
+
+if __name__ == "__main__":
+    test_ttl_cache()
+    test_latest_predictions_cache()
+    test_model_registry()
@@ -78,10 +78,11 @@ def test_ssbf():
 
         # Probar obtener dashboards del usuario
         print("\n📋 Probando obtención de dashboards de usuario...")
-        user_dashboards = ssbf.get_user_dashboards(user_id=1)
+        listing = ssbf.get_user_dashboards(user_id=1)
+        user_dashboards = listing['dashboards']
 
         if user_dashboards:
-            print(f"   📊 Total dashboards encontrados: {len(user_dashboards)}")
+            print(f"   📊 Total dashboards encontrados: {listing['total']}")
             for i, dashboard in enumerate(user_dashboards[:3], 1):
                 visibility = "Público" if dashboard['is_public'] else "Privado"
                 print(f"   {i}. {dashboard['title']} ({visibility}) - Permiso: {dashboard['user_permission']}")
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+Script de prueba para la ejecución de métricas predefinidas (SSBF): fórmulas por dialecto,
+parámetros, las versiones de datos que invalidan su cache y los tiles de dashboards
+"""
+
+import time
+from datetime import date
+
+from sqlalchemy import delete, insert, update
+
+import testing_env  # noqa: F401
+import data_versions
+from dashboard_tiles import DashboardTileRenderer, extract_tiles
+from database import SessionLocal
+from metric_execution import MetricExecutionService, date_parameters, format_metric_value, render_formula
+from models import Cliente, PredefinedMetric
+
+
+def _clientes_version():
+    data_versions.clear()
+    return data_versions.table_versions(['clientes'])[0]
+
+
+def test_data_versions():
+    print("🧪 Probando versiones de datos por sentencia")
+
+    suffix = time.time_ns()
+    db = SessionLocal()
+
+    try:
+        start = _clientes_version()
+        assert start[1] == 'v', start
+
+        # Un lote de filas es una sola sentencia: un solo incremento
+        db.execute(insert(Cliente), [{'nombre': f"Lote {i}", 'rut': f"L-{suffix}-{i}"} for i in range(200)])
+        db.commit()
+        assert _clientes_version()[2] == start[2] + 1
+
+        # Sin filas afectadas o con rollback la versión no cambia
+        db.execute(update(Cliente).where(Cliente.id < 0).values(nombre="Nadie"))
+        db.commit()
+        db.execute(delete(Cliente).where(Cliente.rut.like(f"L-{suffix}-%")))
+        db.rollback()
+        assert _clientes_version()[2] == start[2] + 1
+
+        db.execute(delete(Cliente).where(Cliente.rut.like(f"L-{suffix}-%")))
+        db.commit()
+        assert _clientes_version()[2] == start[2] + 2
+        print("   ✅ Incremento por sentencia, transaccional")
+
+    finally:
+        db.execute(delete(Cliente).where(Cliente.rut.like(f"L-{suffix}-%")))
+        db.commit()
+        db.close()
+        data_versions.clear()
+
+
+def test_formula_helpers():
+    print("🧪 Probando parámetros de fecha y traducción de fórmulas")
+
+    params = date_parameters(date(2024, 1, 31))
+    assert params['month_start'] == date(2024, 1, 1)
+    assert params['next_month_start'] == date(2024, 2, 1)
+    assert params['three_months_start'] == date(2023, 11, 1)
+    assert params['days_in_month'] == 31 and params['days_left_in_month'] == 1
+    assert date_parameters(date(2024, 2, 29))['days_in_month'] == 29
+
+    formula = "SELECT AVG({days_between(fecha_pago, fecha_emision)}) FROM facturas"
+    assert "julianday(fecha_pago) - julianday(fecha_emision)" in render_formula(formula, 'sqlite')
+    assert "CAST(fecha_pago AS DATE) - CAST(fecha_emision AS DATE)" in render_formula(formula, 'postgresql')
+    for bad_formula, dialect in (("{no_existe(a)}", 'sqlite'), (formula, 'oracle')):
+        try:
+            render_formula(bad_formula, dialect)
+            assert False, f"Se esperaba error para {bad_formula} en {dialect}"
+        except ValueError:
+            pass
+
+    definition = {'param_names': ['month_start', 'vendedor_id'], 'default_params': {}}
+    try:
+        MetricExecutionService._bind_parameters(definition)
+        assert False, "Se esperaba error por parámetro sin valor"
+    except ValueError as e:
+        assert 'vendedor_id' in str(e)
+    assert MetricExecutionService._bind_parameters(definition, {'vendedor_id': 3})['vendedor_id'] == 3
+
+    assert format_metric_value(1234567.8, 'currency') == "$1,234,568"
+    assert format_metric_value(12.345, 'percentage') == "12.3%"
+    assert format_metric_value(None, 'number') == "N/A"
+    print("   ✅ Períodos, dialectos y parámetros requeridos")
+
+
+def test_execution_cache():
+    print("🧪 Probando ejecución cacheada de métricas")
+
+    suffix = time.time_ns()
+    service = MetricExecutionService()
+
+    db = SessionLocal()
+    metric = PredefinedMetric(
+        name=f"test_clientes_{suffix}",
+        display_name="Clientes (prueba)",
+        category='ventas',
+        formula="SELECT COUNT(*) FROM clientes WHERE id >= :min_id",
+        parameters='{"min_id": 0}',
+        data_type='number'
+    )
+    db.add(metric)
+    db.commit()
+    cliente = None
+
+    try:
+        first = service.execute(metric.id)
+        assert first['success'] and not first['cached'], first
+        assert service.execute(metric.id)['cached']
+        assert service.execute(metric.id, {'min_id': 10 ** 12})['value'] == 0
+        assert service.execute(10 ** 9) == {"success": False, "error": "Métrica no encontrada"}
+
+        # Una escritura en la tabla cambia la versión de datos e invalida el resultado
+        cliente = Cliente(nombre="Cliente de prueba", rut=f"T-{suffix}")
+        db.add(cliente)
+        db.commit()
+        data_versions.clear()
+
+        after = service.execute(metric.id)
+        assert not after['cached'] and after['value'] == first['value'] + 1, after
+        print(f"   ✅ Cache por versión de datos ({first['value']} -> {after['value']} clientes)")
+
+    finally:
+        if cliente is not None:
+            db.delete(cliente)
+        db.delete(metric)
+        db.commit()
+        db.close()
+        service.invalidate()
+        data_versions.clear()
+
+
+def test_dashboard_tiles():
+    print("🧪 Probando tiles de dashboards")
+
+    suffix = time.time_ns()
+    metric_name = f"test_tiles_{suffix}"
+    service = MetricExecutionService()
+    renderer = DashboardTileRenderer()
+
+    db = SessionLocal()
+    metric = PredefinedMetric(
+        name=metric_name,
+        display_name="Clientes (prueba)",
+        category='ventas',
+        formula="SELECT COUNT(*) FROM clientes WHERE id >= :min_id",
+        parameters='{"min_id": 0}',
+        data_type='number'
+    )
+    db.add(metric)
+    db.commit()
+    cliente = None
+
+    try:
+        config = {'sections': [{'title': 'Prueba', 'metrics': [
+            metric_name,
+            {'metric': metric_name, 'params': {'min_id': 10 ** 12}},
+            'metrica_inexistente'
+        ]}]}
+        assert [tile['metric'] for tile in extract_tiles(config)] == [metric_name, metric_name, 'metrica_inexistente']
+
+        rendered = renderer.render(config)
+        tiles = rendered['tiles']
+        expected = service.execute(metric.id)['value']
+        assert tiles[0]['raw_value'] == expected and tiles[1]['raw_value'] == 0
+        assert not tiles[2]['success'] and tiles[2]['error'] == "Métrica no encontrada"
+        assert renderer.render(config)['tiles_cached'] == 2
+
+        # Una escritura en la tabla cambia la versión de datos e invalida los tiles
+        cliente = Cliente(nombre="Cliente de prueba", rut=f"TT-{suffix}")
+        db.add(cliente)
+        db.commit()
+        data_versions.clear()
+
+        rendered = renderer.render(config)
+        assert rendered['tiles_cached'] == 0 and rendered['tiles'][0]['raw_value'] == expected + 1
+        print(f"   ✅ Tiles cacheados e invalidados ({expected} -> {expected + 1} clientes)")
+
+    finally:
+        if cliente is not None:
+            db.delete(cliente)
+        db.delete(metric)
+        db.commit()
+        db.close()
+        service.invalidate()
+        data_versions.clear()
+
+
+if __name__ == "__main__":
+    test_formula_helpers()
+    test_data_versions()
+    test_execution_cache()
+    test_dashboard_tiles()
@@ -0,0 +1,28 @@
+"""
+Entorno aislado para los scripts de prueba: base de datos SQLite y directorio de logs en
+una carpeta temporal, para que las pruebas no modifiquen oapce_multitrans.db ni logs/.
+Debe importarse antes que cualquier módulo que abra la base de datos (conftest.py lo
+hace para pytest; los scripts lo importan al inicio).
+"""
+
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+
+if 'database' in sys.modules and not os.getenv('OAPCE_TEST_DIR'):
+    raise RuntimeError("testing_env debe importarse antes que database")
+
+if not os.getenv('OAPCE_TEST_DIR'):
+    TEST_DIR = tempfile.mkdtemp(prefix="oapce_test_")
+    os.environ['OAPCE_TEST_DIR'] = TEST_DIR
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(TEST_DIR, 'test.db')}"
+    os.environ['LOG_DIR'] = os.path.join(TEST_DIR, 'logs')
+    atexit.register(shutil.rmtree, TEST_DIR, ignore_errors=True)
+else:
+    TEST_DIR = os.environ['OAPCE_TEST_DIR']
+
+from database import init_db  # noqa: E402
+
+init_db()
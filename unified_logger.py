@@ -16,9 +16,9 @@ class UnifiedLogger:
     Logger unificado para todos los agentes del sistema OAPCE
     """
 
-    def __init__(self, log_dir: str = "logs", max_bytes: int = 10*1024*1024, backup_count: int = 5):
-        self.log_dir = Path(log_dir)
-        self.log_dir.mkdir(exist_ok=True)
+    def __init__(self, log_dir: str = None, max_bytes: int = 10*1024*1024, backup_count: int = 5):
+        self.log_dir = Path(log_dir or os.getenv('LOG_DIR', 'logs'))
+        self.log_dir.mkdir(parents=True, exist_ok=True)
 
         # Configurar logger principal
         self.logger = logging.getLogger('oapce_unified')